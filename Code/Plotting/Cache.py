@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict
+from filters import get_filter_state
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Memory limit of the cache in bytes, the least recently used plot data is
+# evicted first
+CACHE_LIMIT = 300e6
+# Plot data, key -> (dictionary of arrays, size in bytes)
+cache = OrderedDict()
+# The cache is shared by the request threads of the histogram server
+lock = threading.Lock()
+
+
+# =============================================================================
+# Cache
+# =============================================================================
+
+
+def get_cached(window, name, compute, *settings):
+    """
+    Returns the plot data (a dictionary of numpy arrays) computed by
+    'compute()', cached under the dataset version, a snapshot of all filters
+    and the plot settings, e.g. the number of bins. Re-opening a plot with
+    unchanged data and filters does not recompute anything.
+    """
+    key = (name, window.data_version, get_filter_key(window), settings)
+    return get_cached_key(key, compute)
+
+
+def get_cached_key(key, compute):
+    """
+    Returns the values cached under 'key', or computes and caches them.
+    Thread safe, 'compute()' runs outside of the lock.
+    """
+    with lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key][0]
+    values = compute()
+    nbytes = sum(getattr(value, 'nbytes', 0) for value in values.values())
+    with lock:
+        cache[key] = (values, nbytes)
+        # Evict least recently used
+        while len(cache) > 1 and get_cache_nbytes() > CACHE_LIMIT:
+            cache.popitem(last=False)
+    return values
+
+
+def get_filter_key(window):
+    """Returns the filter state as a hashable, canonical tuple."""
+    return get_state_key(get_filter_state(window))
+
+
+def get_state_key(state):
+    """Returns a filter state as a hashable, canonical tuple."""
+    return tuple((par, tuple(state[par])) for par in sorted(state))
+
+
+def get_cache_nbytes():
+    return sum(nbytes for values, nbytes in cache.values())
+
+
+def clear_cache():
+    with lock:
+        cache.clear()
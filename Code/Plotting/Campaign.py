@@ -0,0 +1,170 @@
+import matplotlib.pyplot as plt
+import numpy as np
+from Plotting.HelperFunctions import (plot_histogram_1d, plot_histogram_2d,
+                                      describe_filter_state)
+from Plotting.Coincidences import Coincidences_3D_render
+
+# =============================================================================
+# Campaign overview
+# =============================================================================
+
+
+def Campaign_plot(histograms, data_sets, state=None):
+    """
+    Plots the merged histograms of an out-of-core campaign (see
+    campaign.run_campaign): PHS (1D and 2D), coincidences and rates. The
+    filters in 'state', used to fill the histograms, are shown in the title.
+    """
+    def PHS_1D_plot_bus(counts, sub_title, facecolor='lightgrey'):
+        plt.title(sub_title)
+        plt.xlabel('Collected charge [ADC channels]')
+        plt.ylabel('Counts')
+        plt.grid(True, which='major', zorder=0)
+        plt.grid(True, which='minor', linestyle='--', zorder=0)
+        plot_histogram_1d(counts, [0, 1050], histtype='stepfilled',
+                          facecolor=facecolor, ec='black', zorder=5)
+
+    def rate_plot_bus(counts, time_span, sub_title, color):
+        duration = (time_span[1] - time_span[0]) * 1e-9
+        plt.title(sub_title)
+        plt.xlabel('Channel')
+        plt.ylabel('Rate [Hz]')
+        plt.grid(True, which='major', zorder=0)
+        plt.scatter(np.arange(len(counts)), counts / duration, color=color,
+                    zorder=2)
+
+    number_bins = histograms['number_bins']
+    # Prepare figure
+    fig = plt.figure()
+    title = 'Campaign\n(%s, ...)' % data_sets.splitlines()[0]
+    if state is not None:
+        title += '\nFilters: %s' % describe_filter_state(state)
+    fig.suptitle(title, x=0.5, y=0.99)
+    fig.set_figheight(11)
+    fig.set_figwidth(15)
+    # PHS (1D) per VMM chip
+    for i, VMM in enumerate([2, 3, 4, 5]):
+        plt.subplot(3, 4, i+1)
+        PHS_1D_plot_bus(histograms['PHS_1D_VMM'][i], 'PHS -- VMM: %d' % VMM)
+    # PHS (1D and 2D) for grids and wires
+    for i, w_or_g in enumerate(['Grids', 'Wires']):
+        plt.subplot(3, 4, i+5)
+        PHS_1D_plot_bus(histograms['PHS_1D_MG'][i], 'PHS -- %s' % w_or_g)
+    for i, (key, limit) in enumerate([['PHS_2D_MG_grids', [-0.5, 11.5]],
+                                      ['PHS_2D_MG_wires', [-0.5, 79.5]]]):
+        plt.subplot(3, 4, i+7)
+        plt.title('PHS (2D) -- %s' % ['Grids', 'Wires'][i])
+        plt.xlabel('Channel')
+        plt.ylabel('Charge [ADC channels]')
+        plot_histogram_2d(histograms[key], [limit, [0, 1050]])
+        plt.colorbar()
+    # Coincidences
+    for i, (layers, wires) in enumerate([[20, 80], [16, 64]]):
+        plt.subplot(3, 4, i+9)
+        plt.title('Coincidences -- %d layers' % layers)
+        plt.xlabel('Wire [Channel number]')
+        plt.ylabel('Grid [Channel number]')
+        plot_histogram_2d(histograms['Coincidences'][:wires, :12],
+                          [[-0.5, wires - 0.5], [-0.5, 11.5]])
+        plt.colorbar()
+    # Rates of neutrons (clusters)
+    plt.subplot(3, 4, 11)
+    rate_plot_bus(histograms['clusters_gCh'], histograms['clusters_time'],
+                  'Neutron rate -- Grids', 'darkorange')
+    plt.subplot(3, 4, 12)
+    rate_plot_bus(histograms['clusters_wCh'], histograms['clusters_time'],
+                  'Neutron rate -- Wires', 'crimson')
+    plt.subplots_adjust(left=0.05, right=0.97, top=0.9, bottom=0.06,
+                        wspace=0.35, hspace=0.45)
+    return fig
+
+
+def Campaign_3D_plot(histograms, data_sets):
+    """Coincidences (3D) of an out-of-core campaign."""
+    H = histograms['Coincidences']
+    Coincidences_3D_render(H, H[:, :12], data_sets.splitlines()[0])
+
+
+# =============================================================================
+# Run comparison
+# =============================================================================
+
+
+def Runs_comparison_plot(stacked, mode='overlay', reference=0):
+    """
+    Compares the runs of campaign.compare_runs: wire and grid PHS and
+    neutron rates per channel, as rates so that runs of different length
+    compare, the coincidences of the last run, and the total rates per run.
+    'mode' is 'overlay', or 'ratio' or 'difference' to the run 'reference'.
+    """
+    def compare(values):
+        if mode == 'ratio':
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return values / values[reference]
+        elif mode == 'difference':
+            return values - values[reference]
+        return values
+
+    def runs_plot_bus(x, values, sub_title, xlabel, ylabel):
+        plt.title(sub_title)
+        plt.xlabel(xlabel)
+        plt.ylabel(ylabel)
+        plt.grid(True, which='major', zorder=0)
+        for k, name in enumerate(names):
+            plt.step(x, values[k], where='mid', color=colors[k], zorder=5,
+                     label=name, lw=2 if k == reference and mode != 'overlay' else 1)
+        if len(names) <= 10:
+            plt.legend(fontsize='small')
+
+    names = stacked['runs']
+    colors = plt.cm.viridis(np.linspace(0, 1, len(names)))
+    events_duration = np.maximum(stacked['events_duration'], 1e-9)
+    clusters_duration = np.maximum(stacked['clusters_duration'], 1e-9)
+    unit = {'overlay': 'Rate [Hz]', 'ratio': 'Ratio to %s' % names[reference],
+            'difference': 'Rate - rate of %s [Hz]' % names[reference]}[mode]
+    edges = np.linspace(0, 1050, stacked['number_bins'] + 1)
+    adc = (edges[:-1] + edges[1:]) / 2
+    # Prepare figure
+    fig = plt.figure()
+    fig.suptitle('Run comparison (%s)\n%s, ..., %s' % (mode, names[0], names[-1]),
+                 x=0.5, y=0.99)
+    fig.set_figheight(9)
+    fig.set_figwidth(15)
+    # PHS
+    for i, w_or_g in enumerate(['Grids', 'Wires']):
+        plt.subplot(2, 3, i+1)
+        rates = stacked['PHS_1D_MG'][:, i] / events_duration[:, None]
+        runs_plot_bus(adc, compare(rates), 'PHS -- %s' % w_or_g,
+                      'Collected charge [ADC channels]', unit)
+    # Coincidences of the last run
+    plt.subplot(2, 3, 3)
+    rates = stacked['Coincidences'][:, :, :12] / clusters_duration[:, None, None]
+    plt.title('Coincidences -- %s' % names[-1])
+    plt.xlabel('Wire [Channel number]')
+    plt.ylabel('Grid [Channel number]')
+    plt.imshow(compare(rates)[-1].T, origin='lower', aspect='auto',
+               extent=[-0.5, 79.5, -0.5, 11.5], cmap='jet')
+    plt.colorbar(label=unit)
+    # Neutron rates per channel
+    for i, (w_or_g, key) in enumerate([['Grids', 'clusters_gCh'],
+                                       ['Wires', 'clusters_wCh']]):
+        plt.subplot(2, 3, i+4)
+        rates = stacked[key] / clusters_duration[:, None]
+        runs_plot_bus(np.arange(rates.shape[1]), compare(rates),
+                      'Neutron rate -- %s' % w_or_g, 'Channel', unit)
+    # Total rates per run
+    plt.subplot(2, 3, 6)
+    plt.title('Total rates')
+    plt.ylabel('Rate [Hz]')
+    plt.grid(True, which='major', zorder=0)
+    runs = np.arange(len(names))
+    plt.plot(runs, (stacked['events_gCh'].sum(axis=1) + stacked['events_wCh'].sum(axis=1))
+             / events_duration, 'o-', color='black', zorder=5, label='Hits')
+    plt.plot(runs, stacked['Coincidences'].sum(axis=(1, 2)) / clusters_duration,
+             'o-', color='crimson', zorder=5, label='Neutrons')
+    plt.yscale('log')
+    plt.xticks(runs, names, rotation=90, fontsize='small')
+    plt.legend(fontsize='small')
+    plt.subplots_adjust(left=0.05, right=0.97, top=0.9, bottom=0.15,
+                        wspace=0.3, hspace=0.4)
+    return fig
@@ -1,12 +1,12 @@
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-import plotly as py
 import numpy as np
-import plotly.graph_objs as go
-import pandas as pd
-import plotly.io as pio
 import os
-from Plotting.HelperFunctions import filter_coincident_events
+import json
+import html
+import base64
+from Plotting.HelperFunctions import (filter_coincident_events, histogram_2d,
+                                      plot_histogram_2d)
+from Plotting.Cache import get_cached
 
 
 # =============================================================================
@@ -15,14 +15,21 @@ from Plotting.HelperFunctions import filter_coincident_events
 
 
 def Coincidences_2D_plot(window):
+    def compute():
+        # Initial filter, keep only coincident events
+        clusters_20 = filter_coincident_events(window.Clusters_20_layers, window)
+        clusters_16 = filter_coincident_events(window.Clusters_16_layers, window)
+        return {'20': histogram_2d(clusters_20.wCh.values, clusters_20.gCh.values,
+                                   [80, 12], hist_range_20),
+                '16': histogram_2d(clusters_16.wCh.values, clusters_16.gCh.values,
+                                   [64, 12], hist_range_16)}
+
     # Declare parameters (added with condition if empty array)
     data_sets = window.data_sets.splitlines()[0]
-    # Import data
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
-    # Initial filter, keep only coincident events
-    clusters_20 = filter_coincident_events(df_20, window)
-    clusters_16 = filter_coincident_events(df_16, window)
+    hist_range_20 = [[-0.5, 79.5], [-0.5, 11.5]]
+    hist_range_16 = [[-0.5, 63.5], [-0.5, 11.5]]
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'Coincidences_2D', compute)
     # Plot data
     fig = plt.figure()
     fig.set_figheight(4.5)
@@ -31,18 +38,14 @@ def Coincidences_2D_plot(window):
     # for 20 layers
     plt.subplot(1, 2, 1)
     plt.title('20 layers')
-    plt.hist2d(clusters_20.wCh, clusters_20.gCh, bins=[80, 12],
-               range=[[-0.5, 79.5], [-0.5, 11.5]],
-               norm=LogNorm(), cmap='jet')
+    plot_histogram_2d(H['20'], hist_range_20)
     plt.xlabel('Wire [Channel number]')
     plt.ylabel('Grid [Channel number]')
     plt.colorbar()
     # for 16 layers
     plt.subplot(1,2,2)
     plt.title('16 layers')
-    plt.hist2d(clusters_16.wCh, clusters_16.gCh, bins=[64, 12],
-               range=[[-0.5, 63.5], [-0.5, 11.5]],
-               norm=LogNorm(), cmap='jet')
+    plot_histogram_2d(H['16'], hist_range_16)
     plt.xlabel('Wire [Channel number]')
     plt.ylabel('Grid [Channel number]')
     plt.colorbar()
@@ -55,25 +58,46 @@ def Coincidences_2D_plot(window):
 # =============================================================================
 
 def Coincidences_3D_plot(window):
-    # Import data
-    df_20 = window.Clusters_20_layers
-    df_16 = window.Clusters_16_layers
     data_sets = window.data_sets.splitlines()[0]
-    # Perform initial filters
-    clusters_20 = filter_coincident_events(df_20, window)
-    clusters_16 = filter_coincident_events(df_16, window)
+    H_20, H_16 = get_coincidences_3D(window)
+    Coincidences_3D_render(H_20, H_16, data_sets)
+
+
+def get_coincidences_3D(window):
+    """
+    Returns the (wCh, gCh) histograms of the 20 layers (80 x 13) and
+    16 layers (80 x 12) detectors.
+    """
+    def compute():
+        # Perform initial filters
+        clusters_20 = filter_coincident_events(window.Clusters_20_layers, window)
+        clusters_16 = filter_coincident_events(window.Clusters_16_layers, window)
+        # Calculate 3D histogram
+        H_20 = histogram_2d(clusters_20.wCh.values, clusters_20.gCh.values,
+                            [80, 13], [[0, 80], [0, 13]]).astype(float)
+        H_16 = histogram_2d(clusters_16.wCh.values, clusters_16.gCh.values,
+                            [80, 12], [[0, 80], [0, 12]]).astype(float)
+        return {'20': H_20, '16': H_16}
+
+    H = get_cached(window, 'Coincidences_3D', compute)
+    return H['20'], H['16']
+
+
+def Coincidences_3D_render(H_20, H_16, data_sets):
+    """
+    Produces the 3D plot from the (wCh, gCh) histograms of the 20 layers
+    (80 x 13) and 16 layers (80 x 12) detectors.
+    """
+    # plotly takes seconds to import, so only import it when needed
+    import plotly as py
+    import plotly.graph_objs as go
     # Declare max and min count
     min_count = 0
     max_count = np.inf
     # Initiate 'voxel_id -> (x, y, z)'-mapping
     MG24_ch_to_coord_20, MG24_ch_to_coord_16 = get_MG24_to_XYZ_mapping()
-    # Calculate 3D histogram
 
     # 20 layers
-    H_20, edges_20 = np.histogramdd(clusters_20[['wCh', 'gCh']].values,
-                              bins=(80, 13),
-                              range=((0, 80), (0, 13))
-                              )
     # Insert results into an array
     hist_20 = [[], [], [], []]
     loc_20 = 0
@@ -94,10 +118,6 @@ def Coincidences_3D_plot(window):
                                + 'Counts: ' + str(H_20[wCh, gCh])
                                )
     # 16 layers
-    H_16, edges_16 = np.histogramdd(clusters_16[['wCh', 'gCh']].values,
-                                    bins=(80, 12),
-                                    range=((0, 80), (0, 12))
-                                   )
     # Insert results into an array
     hist_16 = [[], [], [], []]
     loc_16 = 0
@@ -176,6 +196,136 @@ def Coincidences_3D_plot(window):
     #pio.write_image(fig, '../Results/HTML_files/Ce3Dhistogram.pdf')
 
 
+# =============================================================================
+# Coincidence Histogram (3D) - Export
+# =============================================================================
+
+
+def Coincidences_3D_export(window, path):
+    """
+    Writes the 3D coincidence histograms of the loaded data to 'path'.npz
+    and a small viewer page 'path'.html, see export_3D_histogram.
+    """
+    data_sets = window.data_sets.splitlines()[0]
+    H_20, H_16 = get_coincidences_3D(window)
+    export_3D_histogram(H_20, H_16, data_sets, path)
+
+
+def export_3D_histogram(H_20, H_16, data_sets, path):
+    """
+    Compact alternative to the plotly HTML of Coincidences_3D_render. Only
+    the histograms are stored, as integer arrays:
+
+        'path'.npz:  H_20, H_16 and data_sets, reloaded by
+                     load_3D_histogram and drawn by Coincidences_3D_render
+        'path'.html: viewer with the same arrays embedded as base64, the
+                     voxel coordinates and labels are produced in the
+                     browser. The viewer uses plotly.min.js from the same
+                     directory (written once) or from the plotly CDN.
+
+    A file is a few kB, compared to several MB for the full plotly HTML.
+    """
+    path = os.path.splitext(path)[0]
+    dtype = get_counts_dtype(H_20, H_16)
+    H_20 = H_20.astype(dtype)
+    H_16 = H_16.astype(dtype)
+    np.savez_compressed(path + '.npz', H_20=H_20, H_16=H_16,
+                        data_sets=np.array(data_sets))
+    viewer = VIEWER_TEMPLATE % {'title': html.escape(data_sets),
+                                'data_sets': json.dumps(data_sets),
+                                'dtype': dtype.__name__,
+                                'H_20': encode_array(H_20),
+                                'H_16': encode_array(H_16)}
+    with open(path + '.html', 'w') as html_file:
+        html_file.write(viewer)
+    write_plotly_js(os.path.dirname(path))
+
+
+def load_3D_histogram(path):
+    """Returns H_20, H_16 and data_sets from an .npz written by export_3D_histogram."""
+    with np.load(os.path.splitext(path)[0] + '.npz') as data:
+        return data['H_20'], data['H_16'], str(data['data_sets'])
+
+
+def get_counts_dtype(*histograms):
+    if max(H.max() for H in histograms) < np.iinfo(np.uint32).max:
+        return np.uint32
+    else:
+        return np.float64
+
+
+def encode_array(H):
+    """Row-major, little-endian base64, as read by the JavaScript typed arrays."""
+    return base64.b64encode(H.astype(H.dtype.newbyteorder('<')).tobytes()).decode('ascii')
+
+
+def write_plotly_js(directory):
+    """Writes plotly.min.js, shared by all viewers in 'directory', once."""
+    path = os.path.join(directory, 'plotly.min.js')
+    if os.path.exists(path):
+        return
+    try:
+        from plotly.offline import get_plotlyjs
+    except ImportError:
+        # The viewer falls back on the CDN
+        return
+    with open(path, 'w') as js_file:
+        js_file.write(get_plotlyjs())
+
+
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Coincidences (3D) %(title)s</title>
+<script src="plotly.min.js"></script>
+<script>
+if (typeof Plotly === 'undefined') {
+    document.write('<script src="https://cdn.plot.ly/plotly-latest.min.js"><\\/script>');
+}
+</script>
+</head>
+<body>
+<div id="plot" style="width:100%%;height:95vh;"></div>
+<script>
+var dataSets = %(data_sets)s;
+function decode(text) {
+    var bytes = Uint8Array.from(atob(text), function (c) { return c.charCodeAt(0); });
+    return '%(dtype)s' === 'uint32' ? new Uint32Array(bytes.buffer) : new Float64Array(bytes.buffer);
+}
+// Same voxel mapping and offsets as Coincidences_3D_render
+function addVoxels(H, grids, wiresPerLayer, xOffset, zOffset, hist) {
+    for (var wCh = 0; wCh < 80; wCh++) {
+        for (var gCh = 0; gCh < grids; gCh++) {
+            var counts = H[wCh * grids + gCh];
+            if (counts > 0) {
+                hist.x.push(Math.floor(wCh / wiresPerLayer) * 23.5 + xOffset);
+                hist.y.push(gCh * 23.5);
+                hist.z.push((wCh %% wiresPerLayer) * 10 + zOffset);
+                hist.color.push(Math.log10(counts));
+                hist.text.push('Wire Channel: ' + wCh + '<br>Grid Channel: ' + gCh
+                               + '<br>Counts: ' + counts);
+            }
+        }
+    }
+}
+var hist = {x: [], y: [], z: [], color: [], text: []};
+addVoxels(decode('%(H_20)s'), 13, 20, 100, 0, hist);
+addVoxels(decode('%(H_16)s'), 12, 16, 0, 40, hist);
+Plotly.newPlot('plot', [{type: 'scatter3d', mode: 'markers', name: 'Multi-Grid',
+                         x: hist.x, y: hist.y, z: hist.z, text: hist.text,
+                         marker: {size: 20, color: hist.color, colorscale: 'Jet',
+                                  opacity: 1, colorbar: {thickness: 20,
+                                                         title: 'log10(counts)'}}}],
+               {title: 'Coincidences (3D) ' + dataSets, showlegend: false,
+                scene: {aspectmode: 'data', xaxis: {title: 'x [mm]'},
+                        yaxis: {title: 'y [mm]'}, zaxis: {title: 'z [mm]'}}});
+</script>
+</body>
+</html>
+"""
+
+
 # =============================================================================
 # Helper Functions
 # =============================================================================
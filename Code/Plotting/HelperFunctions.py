@@ -1,96 +1,66 @@
 import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.colors import LogNorm
+# Re-exported for the plotting modules, the filters and histograms live in
+# filters.py so that clustering and the server do not import matplotlib
+from filters import (filter_events, filter_coincident_events,
+                     describe_filter_state, histogram_1d, histogram_2d,
+                     decimate_min_max)
 
 # =============================================================================
-# Filter
+# Decimated plotting
 # =============================================================================
 
-def filter_events(events, window):
-    # Declare parameters
-    parameters = {'adc': [window.ADC_min.value(),
-                          window.ADC_max.value(),
-                          window.ADC_filter.isChecked()],
-                  'channel': [window.channel_min.value(),
-                              window.channel_max.value(),
-                              window.channel_filter.isChecked()],
-                  'srs_timestamp': [float(window.time_min.text()),
-                                    float(window.time_max.text()),
-                                    window.timestamp_filter.isChecked()],
-                  'chip_id': [window.chip_min.value(),
-                              window.chip_max.value(),
-                              window.chip_filter.isChecked()],
-                  }
-    # Only include the filters that we want to use
-    events_red = events
-    for par, (min_val, max_val, filter_on) in parameters.items():
-        if filter_on:
-            events_red = events_red[(events_red[par] >= min_val)
-                                    & (events_red[par] <= max_val)]
-    # Perform an additional filter on grid and wire channels
-    wCh_filter_on = window.wCh_filter.isChecked()
-    wCh_min = window.wCh_min.value()
-    wCh_max = window.wCh_max.value()
-    gCh_filter_on = window.gCh_filter.isChecked()
-    gCh_min = window.gCh_min.value()
-    gCh_max = window.gCh_max.value()
+def plot_decimated(ax, y, x=None, **kwargs):
+    """
+    Plots a long series as a line decimated to about two points per pixel,
+    keeping the minimum and maximum of every pixel column so that glitches
+    and rollovers stay visible. The visible range is re-decimated when
+    zooming or panning. If 'x' is omitted, the index is used, otherwise 'x'
+    must be sorted.
+    """
+    def redecimate(ax):
+        lo, hi = ax.get_xlim()
+        if x is None:
+            start = max(int(np.floor(lo)), 0)
+            stop = min(int(np.ceil(hi)) + 1, len(y))
+        else:
+            start = max(np.searchsorted(x, lo, side='left') - 1, 0)
+            stop = min(np.searchsorted(x, hi, side='right') + 1, len(y))
+        nbr_buckets = max(int(ax.get_window_extent().width), 100)
+        indices = decimate_min_max(y[start:stop], nbr_buckets) + start
+        line.set_data(indices if x is None else x[indices], y[indices])
+        ax.figure.canvas.draw_idle()
 
-    if wCh_filter_on and gCh_filter_on:
-        events_red = events_red[((events_red['wCh'] >= wCh_min)
-                                 & (events_red['wCh'] <= wCh_max)) |
-                                ((events_red['gCh'] >= gCh_min)
-                                 & (events_red['gCh'] <= gCh_max))]
-    elif wCh_filter_on and (not gCh_filter_on):
-        events_red = events_red[((events_red['wCh'] >= wCh_min)
-                                 & (events_red['wCh'] <= wCh_max)) |
-                                ((events_red['gCh'] >= 0)
-                                 & (events_red['gCh'] <= 12))]
-    elif (not wCh_filter_on) and gCh_filter_on:
-        events_red = events_red[((events_red['wCh'] >= 0)
-                                 & (events_red['wCh'] <= 79)) |
-                                ((events_red['gCh'] >= gCh_min)
-                                 & (events_red['gCh'] <= gCh_max))]
-    print(events_red)
-    return events_red
+    y = np.asarray(y)
+    if x is not None:
+        x = np.asarray(x)
+    nbr_buckets = max(int(ax.get_window_extent().width), 100)
+    indices = decimate_min_max(y, nbr_buckets)
+    line, = ax.plot(indices if x is None else x[indices], y[indices], **kwargs)
+    ax.callbacks.connect('xlim_changed', redecimate)
+    return line
 
 
-def filter_coincident_events(ce, window):
-    # Declare parameters
-    parameters = {'Time': [float(window.time_min.text()),
-                           float(window.time_max.text()),
-                           window.timestamp_filter.isChecked()],
-                  'wADC': [float(window.wADC_min.text()),
-                           float(window.wADC_max.text()),
-                           window.wADC_filter.isChecked()],
-                  'gADC': [float(window.gADC_min.text()),
-                           float(window.gADC_max.text()),
-                           window.gADC_filter.isChecked()],
-                  'wM': [window.wM_min.value(),
-                         window.wM_max.value(),
-                         window.wM_filter.isChecked()],
-                  'gM': [window.gM_min.value(),
-                         window.gM_max.value(),
-                         window.gM_filter.isChecked()]
-                  }
-    # Only include the filters that we want to use
-    ce_red = ce
-    for par, (min_val, max_val, filter_on) in parameters.items():
-        if filter_on:
-            ce_red = ce_red[(ce_red[par] >= min_val)
-                            & (ce_red[par] <= max_val)]
-    # Perform an additional filter on grid and wire channels
-    wCh_filter_on = window.wCh_filter.isChecked()
-    wCh_min = window.wCh_min.value()
-    wCh_max = window.wCh_max.value()
-    gCh_filter_on = window.gCh_filter.isChecked()
-    gCh_min = window.gCh_min.value()
-    gCh_max = window.gCh_max.value()
+# =============================================================================
+# Histograms
+# =============================================================================
+
+def plot_histogram_1d(counts, range, **kwargs):
+    """
+    Displays precomputed counts on the current axes like plt.hist, e.g.
+    with histtype='stepfilled'.
+    """
+    edges = np.linspace(range[0], range[1], len(counts) + 1)
+    return plt.hist(edges[:-1], bins=edges, weights=counts, **kwargs)
+
 
-    if wCh_filter_on and gCh_filter_on:
-        ce_red = ce_red[((ce_red['wCh'] >= wCh_min) & (ce_red['wCh'] <= wCh_max)) |
-                        ((ce_red['gCh'] >= gCh_min) & (ce_red['gCh'] <= gCh_max))]
-    elif wCh_filter_on and (not gCh_filter_on):
-        ce_red = ce_red[((ce_red['wCh'] >= wCh_min) & (ce_red['wCh'] <= wCh_max)) |
-                        ((ce_red['gCh'] >= 0) & (ce_red['gCh'] <= 12))]
-    elif (not wCh_filter_on) and gCh_filter_on:
-        ce_red = ce_red[((ce_red['wCh'] >= 0) & (ce_red['wCh'] <= 79)) |
-                        ((ce_red['gCh'] >= gCh_min) & (ce_red['gCh'] <= gCh_max))]
-    return ce_red
+def plot_histogram_2d(H, range, vmin=None, vmax=None):
+    """
+    Displays a histogram from histogram_2d on the current axes with a
+    logarithmic colour scale, empty bins are left blank.
+    """
+    x_edges = np.linspace(range[0][0], range[0][1], H.shape[0] + 1)
+    y_edges = np.linspace(range[1][0], range[1][1], H.shape[1] + 1)
+    return plt.pcolormesh(x_edges, y_edges, np.ma.masked_equal(H, 0).T,
+                          norm=LogNorm(vmin=vmin, vmax=vmax), cmap='jet')
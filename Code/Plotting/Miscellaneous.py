@@ -1,13 +1,10 @@
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
-import plotly as py
 import numpy as np
-import plotly.graph_objs as go
-import pandas as pd
-import plotly.io as pio
-import os
 
-from Plotting.HelperFunctions import filter_events, filter_coincident_events
+from Plotting.HelperFunctions import (filter_events, filter_coincident_events,
+                                      plot_decimated, histogram_1d,
+                                      histogram_2d, plot_histogram_1d)
+from Plotting.Cache import get_cached
 
 # =============================================================================
 # Timestamp
@@ -27,7 +24,8 @@ def timestamp_plot(window):
     # 20 layers
     plt.subplot(1, 2, 1)
     plt.title('20 layers')
-    plt.plot(df_20.srs_timestamp, color='black', zorder=5)
+    plot_decimated(plt.gca(), df_20.srs_timestamp.values, color='black',
+                   zorder=5)
     plt.xlabel('Event number')
     plt.ylabel('Timestamp [TDC channels]')
     plt.grid(True, which='major', zorder=0)
@@ -35,7 +33,8 @@ def timestamp_plot(window):
     # for 16 layers
     plt.subplot(1, 2, 2)
     plt.title('16 layers')
-    plt.plot(df_16.srs_timestamp, color='black', zorder=5)
+    plot_decimated(plt.gca(), df_16.srs_timestamp.values, color='black',
+                   zorder=5)
     plt.xlabel('Event number')
     plt.ylabel('Timestamp [TDC channels]')
     plt.grid(True, which='major', zorder=0)
@@ -43,6 +42,176 @@ def timestamp_plot(window):
     plt.subplots_adjust(left=0.08, right=0.96, top=0.82, bottom=0.12, wspace=0.32)
     return fig
 
+# =============================================================================
+# Rate history
+# =============================================================================
+
+
+def rate_history_plot(window, bin_width):
+    """
+    Neutron (filtered cluster) rate vs time in bins of 'bin_width' seconds,
+    with Poisson errors, and the total rate of each detector.
+    """
+    data_sets = window.data_sets.splitlines()[0]
+    # Plot
+    fig = plt.figure()
+    fig.set_figheight(4.5)
+    fig.set_figwidth(11)
+    plt.suptitle('Neutron rate vs time (%s s bins)\nData set(s): %s'
+                 % (bin_width, data_sets))
+    for i, (layers, clusters) in enumerate([[20, window.Clusters_20_layers],
+                                            [16, window.Clusters_16_layers]]):
+        ce_red = filter_coincident_events(clusters, window)
+        plt.subplot(1, 2, i+1)
+        plt.xlabel('Time [s]')
+        plt.ylabel('Rate [Hz]')
+        plt.grid(True, which='major', zorder=0)
+        plt.grid(True, which='minor', linestyle='--', zorder=0)
+        history = get_rate_history(ce_red['Time'].values, bin_width)
+        centers, rates, errors, total, total_error = history
+        if centers.shape[0] == 0:
+            plt.title('%d layers -- too few events' % layers)
+            continue
+        print('Total neutron rate (%s layers): %f +/- %f Hz'
+              % (layers, total, total_error))
+        plt.title('%d layers -- total: %.2f $\\pm$ %.2f Hz'
+                  % (layers, total, total_error))
+        plt.errorbar(centers, rates, yerr=errors, fmt='.', color='black',
+                     ecolor='grey', zorder=5)
+    plt.subplots_adjust(left=0.08, right=0.96, top=0.82, bottom=0.12, wspace=0.32)
+    return fig
+
+
+def get_rate_history(times, bin_width):
+    """
+    Returns the bin centers [s from the first event], rates [Hz] and Poisson
+    errors of the events at 'times' [ns], in bins of 'bin_width' seconds,
+    followed by the total rate and its error. One vectorized pass. Without
+    events, or if all events have the same time, there are no bins and the
+    rate is zero.
+    """
+    if times.shape[0] == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0), 0, 0
+    start, end = times.min(), times.max()
+    duration = (end - start) * 1e-9
+    if duration == 0:
+        return np.zeros(0), np.zeros(0), np.zeros(0), 0, 0
+    nbr_bins = max(int(np.ceil(duration / bin_width)), 1)
+    # The last bin only covers the remaining time
+    edges = np.minimum(np.arange(nbr_bins + 1) * bin_width, duration)
+    counts = histogram_1d((times - start) * 1e-9, nbr_bins,
+                          [0, nbr_bins * bin_width])
+    widths = np.diff(edges)
+    widths[widths == 0] = bin_width
+    centers = (edges[:-1] + edges[1:]) / 2
+    total = times.shape[0] / duration
+    total_error = np.sqrt(times.shape[0]) / duration
+    return centers, counts / widths, np.sqrt(counts) / widths, total, total_error
+
+
+# =============================================================================
+# Time window sweep
+# =============================================================================
+
+
+def time_window_sweep_plot(results, data_sets):
+    """
+    Compares the clustering for the time windows of a sweep (see
+    sweep_time_window): number of clusters, coincidence efficiency and the
+    wire and grid multiplicity distributions. The table is printed.
+    """
+    time_windows = results['time_window']
+    print('Time window \t Clusters \t Coincidences \t Efficiency \t Mean wM \t Mean gM')
+    for k, time_window in enumerate(time_windows):
+        multiplicities = np.arange(results['wM'].shape[1])
+        clusters = max(results['clusters'][k], 1)
+        print('%g \t %d \t %d \t %.4f \t %.2f \t %.2f'
+              % (time_window, results['clusters'][k], results['coincidences'][k],
+                 results['efficiency'][k],
+                 (results['wM'][k] * multiplicities).sum() / clusters,
+                 (results['gM'][k] * multiplicities).sum() / clusters))
+    # Plot
+    fig = plt.figure()
+    fig.set_figheight(8)
+    fig.set_figwidth(11)
+    plt.suptitle('Time window sweep\nData set(s): %s' % data_sets.splitlines()[0])
+    plt.subplot(2, 2, 1)
+    plt.title('Clusters')
+    plt.xlabel('Time window [TDC channels]')
+    plt.ylabel('Counts')
+    plt.grid(True, which='major', zorder=0)
+    plt.plot(time_windows, results['clusters'], 'o-', color='black', zorder=5)
+    plt.subplot(2, 2, 2)
+    plt.title('Coincidence efficiency')
+    plt.xlabel('Time window [TDC channels]')
+    plt.ylabel('Coincidences / clusters')
+    plt.grid(True, which='major', zorder=0)
+    plt.plot(time_windows, results['efficiency'], 'o-', color='crimson', zorder=5)
+    for i, (typeM, title) in enumerate([['wM', 'Wire multiplicity'],
+                                        ['gM', 'Grid multiplicity']]):
+        plt.subplot(2, 2, i+3)
+        plt.title(title)
+        plt.xlabel('Multiplicity')
+        plt.ylabel('Counts')
+        plt.yscale('log')
+        plt.grid(True, which='major', zorder=0)
+        multiplicities = np.arange(results[typeM].shape[1])
+        for k, time_window in enumerate(time_windows):
+            plt.step(multiplicities, results[typeM][k], where='mid', zorder=5,
+                     label='%g' % time_window)
+        plt.legend(title='Time window', fontsize='small')
+    plt.subplots_adjust(left=0.08, right=0.96, top=0.88, bottom=0.08,
+                        wspace=0.28, hspace=0.38)
+    return fig
+
+
+# =============================================================================
+# Channel statistics
+# =============================================================================
+
+
+def channel_statistics_plot(window):
+    """
+    Health check of all channels from the statistics accumulated during
+    clustering (see update_channel_stats), without reading the events: ADC
+    mean and standard deviation, and the number of hits, per channel. The
+    summary table is printed.
+    """
+    from cluster import channel_stats_table
+
+    def channel_statistics_plot_bus(table, sub_title, color):
+        plt.title(sub_title)
+        plt.xlabel('Channel')
+        plt.ylabel('ADC')
+        plt.grid(True, which='major', zorder=0)
+        plt.errorbar(table['channel'], table['mean'], table['std'], fmt='o',
+                     color=color, capsize=2, zorder=5, label='Mean ± std')
+        plt.legend(loc='upper left', fontsize='small')
+        plt.twinx()
+        plt.ylabel('Hits')
+        plt.step(table['channel'], table['count'], where='mid', color='grey',
+                 zorder=3)
+        plt.ylim(bottom=0)
+
+    table = channel_stats_table(window.channel_stats)
+    print(table.to_string())
+    grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
+    colors = {'wCh': 'crimson', 'gCh': 'darkorange'}
+    # Plot
+    fig = plt.figure()
+    fig.set_figheight(5)
+    fig.set_figwidth(12)
+    plt.suptitle('Channel statistics\n%s' % window.data_sets.splitlines()[0])
+    for i, typeCh in enumerate(['wCh', 'gCh']):
+        plt.subplot(1, 2, i+1)
+        rows = table['type'] == typeCh
+        channel_statistics_plot_bus(table[rows], grids_or_wires[typeCh],
+                                    colors[typeCh])
+    plt.subplots_adjust(left=0.08, right=0.92, top=0.82, bottom=0.12,
+                        wspace=0.35)
+    return fig
+
+
 # =============================================================================
 # Number of times a channel is used in each VMM chip
 # =============================================================================
@@ -51,7 +220,7 @@ def chip_channels_plot(window):
     """
     Shows events per channel per VMM chip.
     """
-    def chip_ch_plot_bus(events, sub_title):
+    def chip_ch_plot_bus(counts, sub_title):
         # Plot
         plt.title("VMM chip %s %s" %(VMM, sub_title))
         plt.xlabel('chip channel id')
@@ -60,15 +229,17 @@ def chip_channels_plot(window):
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         plt.yscale('log')
         plt.xticks(np.arange(0, 65, 10))
-        plt.hist(events.channel, align="left", bins=65, range=[0, 65],
-                 color='lightgrey', ec='black', zorder=5)
+        plot_histogram_1d(counts, [0, 65], align="left",
+                          color='lightgrey', ec='black', zorder=5)
 
     # Import data before any clustering or mapping
-    clusters_16 = window.data
-    clusters_20 = window.data
+    data = window.data
     # Declare parameters
     VMM_order_16 = [2, 3, 4, 5]
     VMM_order_20 = [2, 3, 4, 5]
+    # Channels of each VMM chip (2-5) in one pass
+    H = histogram_2d(data.chip_id.values, data.channel.values, [4, 65],
+                     [[1.5, 5.5], [0, 65]])
     # Prepare figure
     fig = plt.figure()
     fig.set_figheight(8)
@@ -77,16 +248,14 @@ def chip_channels_plot(window):
     # Plot figure
     # for 20 layers
     for i, VMM in enumerate(VMM_order_20):
-        events_VMM_20 = clusters_20[clusters_20.chip_id == VMM]
         plt.subplot(2, 4, i+1)
         sub_title = "-- 20 layers"
-        chip_ch_plot_bus(events_VMM_20, sub_title)
+        chip_ch_plot_bus(H[VMM - 2], sub_title)
     # for 16 layers
     for i, VMM in enumerate(VMM_order_16):
-        events_VMM_16 = clusters_16[clusters_16.chip_id == VMM]
         plt.subplot(2, 4, i+5)
         sub_title = "-- 16 layers"
-        chip_ch_plot_bus(events_VMM_16, sub_title)
+        chip_ch_plot_bus(H[VMM - 2], sub_title)
     plt.subplots_adjust(left=0.07, right=0.98, top=0.88, bottom=0.09, wspace=0.4, hspace=0.35)
     return fig
 
@@ -95,54 +264,40 @@ def channel_rates(window):
        raw: for all events
        clustered: only neutron (coincidence) events
     """
-    def channel_rates_plot_bus(events, subtitle, typeCh, wires):
+    def channel_rates_plot_bus(counts, sub_title, typeCh):
         plt.xlabel('grid channel')
         plt.ylabel('Rate of total counts')
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         plt.title("Grid rates")
-        #print("Grid channel \t rate")
-        gChs = []
-        g_rates = []
+        rates = counts/((end_time - start_time) * 1e-9)
         if typeCh == 'gCh':
-            for gCh in np.arange(0, 12, 1):
-                counts = len(events[events.gCh == gCh])
-                rate = counts/((end_time - start_time) * 1e-9)
-                gChs.append(gCh)
-                g_rates.append(rate)
-                #print(gCh, "\t", rate, "Hz")
-            plt.scatter(gChs, g_rates, color="darkorange", zorder=2)
-            plt.title(sub_title)
-
-        #print("Wire channel \t rate")
-        wChs = []
-        w_rates = []
-        if typeCh == 'wCh':
-            for wCh in np.arange(0, wires, 1):
-                counts = len(events[events.wCh == wCh])
-                rate = counts/((end_time - start_time) * 1e-9)
-                wChs.append(wCh)
-                w_rates.append(rate)
-                #print(wCh, "\t", rate, "Hz")
-            plt.scatter(wChs, w_rates, color="crimson", zorder=2)
-            plt.title(sub_title)
-
-    if window.raw_rates.isChecked():
-        events_16 = window.Events_16_layers
-        events_16 = filter_events(events_16, window)
-        events_20 = window.Events_20_layers
-        events_20 = filter_events(events_20, window)
-        start_time = events_16.head(1)['srs_timestamp'].values[0]
-        end_time = events_16.tail(1)['srs_timestamp'].values[0]
-        tag = "raw data"
-    else:
-        events_16 = window.Clusters_16_layers
-        events_16 = filter_coincident_events(events_16, window)
-        events_20 = window.Clusters_20_layers
-        events_20 = filter_coincident_events(events_20, window)
-        start_time = events_16.head(1)['Time'].values[0]
-        end_time = events_16.tail(1)['Time'].values[0]
-        tag = "neutrons"
+            plt.scatter(np.arange(0, 12, 1), rates, color="darkorange", zorder=2)
+        else:
+            plt.scatter(np.arange(0, len(counts), 1), rates, color="crimson", zorder=2)
+        plt.title(sub_title)
+
+    def compute():
+        if raw_rates:
+            events_16 = filter_events(window.Events_16_layers, window)
+            events_20 = filter_events(window.Events_20_layers, window)
+            time = 'srs_timestamp'
+        else:
+            events_16 = filter_coincident_events(window.Clusters_16_layers, window)
+            events_20 = filter_coincident_events(window.Clusters_20_layers, window)
+            time = 'Time'
+        # Counts per channel, one pass over the data
+        H = {'times': events_16[time].values[[0, -1]]}
+        for layers, events, wires in [['20', events_20, 80], ['16', events_16, 64]]:
+            H['gCh' + layers] = histogram_1d(events.gCh.values, 12, [-0.5, 11.5])
+            H['wCh' + layers] = histogram_1d(events.wCh.values, wires, [-0.5, wires - 0.5])
+        return H
+
+    raw_rates = window.raw_rates.isChecked()
+    tag = "raw data" if raw_rates else "neutrons"
+    # Compute counts, or reuse them if nothing changed
+    H = get_cached(window, 'channel_rates', compute, raw_rates)
+    start_time, end_time = H['times']
     typeChs = ['gCh', 'wCh']
     grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
     # plot
@@ -153,15 +308,13 @@ def channel_rates(window):
     # for 20 layers
     for i, typeCh in enumerate(typeChs):
         sub_title = "%s -- 20 layers" % grids_or_wires[typeCh]
-        wires = 80
         plt.subplot(2,2,i+1)
-        channel_rates_plot_bus(events_20, sub_title, typeCh, wires)
+        channel_rates_plot_bus(H[typeCh + '20'], sub_title, typeCh)
     # for 16 layers
     for i, typeCh in enumerate(typeChs):
         sub_title = "%s -- 16 layers" % grids_or_wires[typeCh]
         plt.subplot(2,2,i+3)
-        wires = 64
-        channel_rates_plot_bus(events_16, sub_title, typeCh, wires)
+        channel_rates_plot_bus(H[typeCh + '16'], sub_title, typeCh)
 
     plt.subplots_adjust(left=0.1, right=0.98, top=0.86, bottom=0.09, wspace=0.25, hspace=0.45)
     return fig
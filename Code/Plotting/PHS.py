@@ -1,9 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
 import os
-import pandas as pd
-from matplotlib.colors import LogNorm
-from Plotting.HelperFunctions import filter_events, filter_coincident_events
+from Plotting.HelperFunctions import (filter_events, histogram_1d, histogram_2d,
+                                      plot_histogram_1d, plot_histogram_2d)
+from Plotting.Cache import get_cached
 
 # ============================================================================
 # PHS (1D) - VMM
@@ -14,7 +14,7 @@ def PHS_1D_VMM_plot(window):
     """
     VMM mapping. Returns 1D cumulative PHS plots for raw data.
     """
-    def PHS_1D_plot_bus(events, sub_title, number_bins):
+    def PHS_1D_plot_bus(counts, sub_title):
         # Plot
         if VMM == 2:
             sub_title += ' (Grids)'
@@ -26,20 +26,25 @@ def PHS_1D_VMM_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         #plt.yscale('log')
-        plt.hist(events.adc, bins=number_bins,
-                 range=[0, 1050], histtype='stepfilled',
-                 facecolor='lightgrey', ec='black', zorder=5)
+        plot_histogram_1d(counts, [0, 1050], histtype='stepfilled',
+                          facecolor='lightgrey', ec='black', zorder=5)
+
+    def compute():
+        # Initial filter
+        clusters_20 = filter_events(window.Events_20_layers, window)
+        clusters_16 = filter_events(window.Events_16_layers, window)
+        # Histogram of VMM chip (2-5) vs ADC
+        hist_range = [[1.5, 5.5], [0, 1050]]
+        return {'20': histogram_2d(clusters_20.chip_id.values, clusters_20.adc.values,
+                                   [4, number_bins], hist_range),
+                '16': histogram_2d(clusters_16.chip_id.values, clusters_16.adc.values,
+                                   [4, number_bins], hist_range)}
     # Declare parameters
     VMM_order_20 = [2, 3, 4, 5]
     VMM_order_16 = [2, 3, 4, 5]
     number_bins = int(window.phsBins.text())
-    # Import data
-    df_20 = window.Events_20_layers
-    df_16 = window.Events_16_layers
-    #print(df_16)
-    # Initial filter
-    clusters_20 = filter_events(df_20, window)
-    clusters_16 = filter_events(df_16, window)
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_1D_VMM', compute, number_bins)
     # Prepare figure
     fig = plt.figure()
     title = 'PHS (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
@@ -50,17 +55,15 @@ def PHS_1D_VMM_plot(window):
 
     # for 20 layers
     for i, VMM in enumerate(VMM_order_20):
-        events_VMM_20 = clusters_20[clusters_20.chip_id == VMM]
         plt.subplot(2, 4, i+1)
         sub_title = 'VMM: %s' % VMM + " -- 20 layers"
-        PHS_1D_plot_bus(events_VMM_20, sub_title, number_bins)
+        PHS_1D_plot_bus(H['20'][VMM - 2], sub_title)
 
     # for 16 layers
     for i, VMM in enumerate(VMM_order_16):
-        events_VMM_16 = clusters_16[clusters_16.chip_id == VMM]
         plt.subplot(2, 4, i+5)
         sub_title = 'VMM: %s' % VMM + " -- 16 layers"
-        PHS_1D_plot_bus(events_VMM_16, sub_title, number_bins)
+        PHS_1D_plot_bus(H['16'][VMM - 2], sub_title)
     #plt.tight_layout()
     plt.subplots_adjust(left=0.07, right=0.95, top=0.87, bottom=0.08, wspace=0.35, hspace=0.37)
     return fig
@@ -73,7 +76,7 @@ def PHS_1D_MG_plot(window):
     """
     MG mapping. Returns 1D cumulative PHS plot for raw events.
     """
-    def PHS_1D_plot_bus(clusters, typeCh, sub_title, number_bins):
+    def PHS_1D_plot_bus(counts, sub_title):
         # Plot
         plt.title(sub_title)
         plt.xlabel('Collected charge [ADC channels]')
@@ -81,20 +84,25 @@ def PHS_1D_MG_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         #plt.yscale('log')
-        plt.hist(clusters[clusters[typeCh] >= 0].adc, bins=number_bins,
-                 range=[0, 1050], histtype='stepfilled', ec='black',
-                 facecolor='lightgrey', zorder=5)
+        plot_histogram_1d(counts, [0, 1050], histtype='stepfilled', ec='black',
+                          facecolor='lightgrey', zorder=5)
+
+    def compute():
+        # Initial filter
+        clusters_20 = filter_events(window.Events_20_layers, window)
+        clusters_16 = filter_events(window.Events_16_layers, window)
+        H = {}
+        for layers, clusters in [['20', clusters_20], ['16', clusters_16]]:
+            for typeCh in typeChs:
+                H[typeCh + layers] = histogram_1d(clusters.adc.values, number_bins,
+                                                  [0, 1050], clusters[typeCh].values >= 0)
+        return H
     # Declare parameters
     number_bins = int(window.phsBins.text())
     typeChs = ['gCh', 'wCh']
     grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
-
-    # Import data
-    df_20 = window.Events_20_layers
-    df_16 = window.Events_16_layers
-    # Initial filter
-    clusters_20 = filter_events(df_20, window)
-    clusters_16 = filter_events(df_16, window)
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_1D_MG', compute, number_bins)
 
     # Prepare figure
     fig = plt.figure()
@@ -108,13 +116,13 @@ def PHS_1D_MG_plot(window):
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+1)
         sub_title = "%s -- 20 layers" % grids_or_wires[typeCh]
-        PHS_1D_plot_bus(clusters_20, typeCh, sub_title, number_bins)
+        PHS_1D_plot_bus(H[typeCh + '20'], sub_title)
     plt.tight_layout()
     # for 16 layers
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+3)
         sub_title = "%s -- 16 layers" % grids_or_wires[typeCh]
-        PHS_1D_plot_bus(clusters_16, typeCh, sub_title, number_bins)
+        PHS_1D_plot_bus(H[typeCh + '16'], sub_title)
     #plt.tight_layout()
     plt.subplots_adjust(left=0.07, right=0.95, top=0.88, bottom=0.08, wspace=0.25, hspace=0.35)
 
@@ -130,7 +138,7 @@ def PHS_2D_VMM_plot(window):
     """
     VMM mapping. Returns 2D PHS plot.
     """
-    def PHS_2D_plot_bus(events, VMM, limit, bins, sub_title, vmin, vmax):
+    def PHS_2D_plot_bus(H, VMM, limit, sub_title, vmin, vmax):
         if VMM == 2:
             sub_title += ' (Grids)'
         else:
@@ -138,22 +146,25 @@ def PHS_2D_VMM_plot(window):
         plt.xlabel('Channel')
         plt.ylabel('Charge [ADC channels]')
         plt.title(sub_title)
-        plt.hist2d(events.channel, events.adc, bins=[bins, 120],
-                   range=[limit, [0, 1050]], norm=LogNorm(),
-                   vmin=vmin, vmax=vmax, cmap='jet')
+        plot_histogram_2d(H, [limit, [0, 1050]], vmin, vmax)
         plt.colorbar()
 
+    def compute():
+        H = {}
+        for layers, df, VMM_limits, VMM_bins in [['20', window.Events_20_layers, VMM_limits_20, VMM_bins_20],
+                                                 ['16', window.Events_16_layers, VMM_limits_16, VMM_bins_16]]:
+            # Initial filter
+            clusters = filter_events(df, window)
+            H['size_' + layers] = np.array(clusters.shape[0])
+            for VMM, limit, bins in zip(VMM_order, VMM_limits, VMM_bins):
+                H['%s_%d' % (layers, VMM)] = histogram_2d(clusters.channel.values,
+                                                         clusters.adc.values,
+                                                         [bins, 120], [limit, [0, 1050]],
+                                                         mask=clusters.chip_id.values == VMM)
+        return H
 
-    number_bins = int(window.phsBins.text())
-    # Import data
-    df_20 = window.Events_20_layers
-    df_16 = window.Events_16_layers
-    # Initial filter
-    clusters_20 = filter_events(df_20, window)
-    clusters_16 = filter_events(df_16, window)
     # Declare parameters
-    VMM_order_20 = [2, 3, 4, 5]
-    VMM_order_16 = [2, 3, 4, 5]
+    VMM_order = [2, 3, 4, 5]
     VMM_limits_20 = [[15.5, 48.5],
                     [17.5, 46.5],
                     [16.5, 46.5],
@@ -164,29 +175,29 @@ def PHS_2D_VMM_plot(window):
                     [16.5, 46.5]]
     VMM_bins_20 = [33, 29, 30, 30]
     VMM_bins_16 = [33, 29, 30, 30]
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_2D_VMM', compute)
     # Prepare figure
     fig = plt.figure()
     title = 'PHS (2D) - VMM\n(%s, ...)' % window.data_sets.splitlines()[0]
     fig.suptitle(title, x=0.5, y=0.99)
     vmin = 1
-    vmax_20 = clusters_20.shape[0] // 1000 + 100
-    vmax_16 = clusters_16.shape[0] // 1000 + 100
+    vmax_20 = int(H['size_20']) // 1000 + 100
+    vmax_16 = int(H['size_16']) // 1000 + 100
     fig.set_figheight(8)
     fig.set_figwidth(13)
     # Plot figure
     # for 20 layers
-    for i, (VMM, limit, bins) in enumerate(zip(VMM_order_20, VMM_limits_20, VMM_bins_20)):
-        events_VMM_20 = clusters_20[clusters_20.chip_id == VMM]
+    for i, (VMM, limit) in enumerate(zip(VMM_order, VMM_limits_20)):
         plt.subplot(2, 4, i+1)
         sub_title = 'VMM: %s -- 20 layers' % VMM
-        PHS_2D_plot_bus(events_VMM_20, VMM, limit, bins, sub_title, vmin, vmax_20)
+        PHS_2D_plot_bus(H['20_%d' % VMM], VMM, limit, sub_title, vmin, vmax_20)
     plt.tight_layout()
     # for 16 layers
-    for i, (VMM, limit, bins) in enumerate(zip(VMM_order_16, VMM_limits_16, VMM_bins_16)):
-        events_VMM_16 = clusters_16[clusters_16.chip_id == VMM]
+    for i, (VMM, limit) in enumerate(zip(VMM_order, VMM_limits_16)):
         plt.subplot(2, 4, i+5)
         sub_title = 'VMM: %s -- 16 layers' % VMM
-        PHS_2D_plot_bus(events_VMM_16, VMM, limit, bins, sub_title, vmin, vmax_16)
+        PHS_2D_plot_bus(H['16_%d' % VMM], VMM, limit, sub_title, vmin, vmax_16)
     #plt.tight_layout()
     plt.subplots_adjust(left=0.06, right=0.97, top=0.89, bottom=0.08, wspace=0.38, hspace=0.35)
     return fig
@@ -199,45 +210,44 @@ def PHS_2D_MG_plot(window):
     """
     MG mapping. Returns 2D PHS plot.
     """
-    def PHS_2D_plot_bus(events, typeCh, limit, bins, sub_title, vmin, vmax):
+    def PHS_2D_plot_bus(H, limit, sub_title, vmin, vmax):
         plt.xlabel('Channel')
         plt.ylabel('Charge [ADC channels]')
         plt.title(sub_title)
-        plt.hist2d(events[typeCh], events.adc, bins=[bins, 120],
-                   range=[limit, [0, 1050]], norm=LogNorm(),
-                   vmin=vmin, vmax=vmax, cmap='jet')
+        plot_histogram_2d(H, [limit, [0, 1050]], vmin, vmax)
         plt.colorbar()
 
-    def get_wire_events(events, window):
-        events_red = None
+    def get_wire_mask(events, window):
+        wCh = events['wCh'].values
         if window.wCh_filter.isChecked():
-            wCh_min = window.wCh_min.value()
-            wCh_max = window.wCh_max.value()
-            events_red = events[(events['wCh'] >= wCh_min)
-                                & (events['wCh'] <= wCh_max)]
+            return (wCh >= window.wCh_min.value()) & (wCh <= window.wCh_max.value())
         else:
-            events_red = events[(events['wCh'] >= 0)
-                                & (events['wCh'] <= 79)]
+            return (wCh >= 0) & (wCh <= 79)
 
-        return events_red
-
-    def get_grid_events(events, window):
-        events_red = None
+    def get_grid_mask(events, window):
+        gCh = events['gCh'].values
         if window.gCh_filter.isChecked():
-            gCh_min = window.gCh_min.value()
-            gCh_max = window.gCh_max.value()
-            events_red = events[(events['gCh'] >= gCh_min)
-                              & (events['gCh'] <= gCh_max)]
+            return (gCh >= window.gCh_min.value()) & (gCh <= window.gCh_max.value())
         else:
-            events_red = events[(events['gCh'] >= 0)
-                              & (events['gCh'] <= 12)]
-
-        return events_red
-
+            return (gCh >= 0) & (gCh <= 12)
+
+    def compute():
+        H = {}
+        for layers, df, limits, bins_vec in [['20', window.Events_20_layers, limits_20, bins_20],
+                                             ['16', window.Events_16_layers, limits_16, bins_16]]:
+            # Initial filter
+            clusters = filter_events(df, window)
+            for typeCh, limit, bins in zip(typeChs, limits, bins_vec):
+                # Select events based on wires or grids, without copying
+                if typeCh == 'wCh':
+                    mask = get_wire_mask(clusters, window)
+                else:
+                    mask = get_grid_mask(clusters, window)
+                H[typeCh + layers] = histogram_2d(clusters[typeCh].values,
+                                                  clusters.adc.values, [bins, 120],
+                                                  [limit, [0, 1050]], mask=mask)
+        return H
 
-    # Import data
-    df_20 = window.Events_20_layers
-    df_16 = window.Events_16_layers
     # Declare parameters
     typeChs = ['gCh', 'wCh']
     limits_20 = [[-0.5, 11.5], [-0.5, 78.5]]
@@ -245,9 +255,8 @@ def PHS_2D_MG_plot(window):
     limits_16 = [[-0.5, 11.5], [-0.5, 62.5]]
     bins_16 = [12, 63]
     grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
-    # Initial filter
-    clusters_20 = filter_events(df_20, window)
-    clusters_16 = filter_events(df_16, window)
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_2D_MG', compute)
 
     # Prepare figure
     fig = plt.figure()
@@ -260,26 +269,16 @@ def PHS_2D_MG_plot(window):
     fig.set_figwidth(9)
     # Plot figure
     # for 20 layers
-    for i, (typeCh, limit, bins) in enumerate(zip(typeChs, limits_20, bins_20)):
-        # Filter events based on wires or grids
-        if typeCh == 'wCh':
-            events_red_20 = get_wire_events(clusters_20, window)
-        else:
-            events_red_20 = get_grid_events(clusters_20, window)
+    for i, (typeCh, limit) in enumerate(zip(typeChs, limits_20)):
         plt.subplot(2, 2, i+1)
         sub_title = 'PHS: %s -- 20 layers' % grids_or_wires[typeCh]
-        PHS_2D_plot_bus(events_red_20, typeCh, limit, bins, sub_title, vmin, vmax_20)
+        PHS_2D_plot_bus(H[typeCh + '20'], limit, sub_title, vmin, vmax_20)
     plt.tight_layout()
     # for 16 layers
-    for i, (typeCh, limit, bins) in enumerate(zip(typeChs, limits_16, bins_16)):
-        # Filter events based on wires or grids
-        if typeCh == 'wCh':
-            events_red_16 = get_wire_events(clusters_16, window)
-        else:
-            events_red_16 = get_grid_events(clusters_16, window)
+    for i, (typeCh, limit) in enumerate(zip(typeChs, limits_16)):
         plt.subplot(2, 2, i+3)
         sub_title = 'PHS: %s -- 16 layers' % grids_or_wires[typeCh]
-        PHS_2D_plot_bus(events_red_16, typeCh, limit, bins, sub_title, vmin, vmax_16)
+        PHS_2D_plot_bus(H[typeCh + '16'], limit, sub_title, vmin, vmax_16)
     #plt.tight_layout()
     plt.subplots_adjust(left=0.09, right=0.98, top=0.89, bottom=0.1, wspace=0.25, hspace=0.35)
     return fig
@@ -295,6 +294,30 @@ def PHS_Individual_plot(window):
     Can be done for raw events, clustered events, and both overlayed.
     Accepts filters on grid and wire multiplicity.
     """
+    def PHS_Individual_plot_bus(H_raw, H_clusters, channel, w_or_g, output_path):
+        fig = plt.figure()
+        if H_raw is not None and H_clusters is not None:
+            plot_histogram_1d(H_raw[channel], [0, 1050], histtype='stepfilled',
+                              facecolor='lightgrey', ec='black', zorder=5, label='raw')
+            plot_histogram_1d(H_clusters[channel], [0, 1050], histtype='stepfilled',
+                              facecolor='lightblue', ec='black', alpha=0.6, zorder=5,
+                              label='clustered')
+            plt.legend()
+        elif H_raw is not None:
+            plot_histogram_1d(H_raw[channel], [0, 1050], histtype='stepfilled',
+                              facecolor='lightgrey', ec='black', zorder=5)
+        else:
+            plot_histogram_1d(H_clusters[channel], [0, 1050], histtype='stepfilled',
+                              facecolor='lightblue', ec='black', zorder=5)
+        plt.grid(True, which='major', zorder=0)
+        plt.grid(True, which='minor', linestyle='--', zorder=0)
+        plt.xlabel('Collected charge [ADC channels]')
+        plt.ylabel('Counts')
+        plt.title('PHS %s - Channel %d\nData set: %s' % (w_or_g, channel, window.data_sets))
+        # Save
+        fig.savefig(output_path, bbox_inches='tight')
+        plt.close()
+
     # Import data
     df_events_20   = window.Events_20_layers
     df_events_16   = window.Events_16_layers
@@ -308,171 +331,36 @@ def PHS_Individual_plot(window):
     dir_name = os.path.dirname(__file__)
     folder_path = os.path.join(dir_name, '../../Results/PHS')
     number_bins = int(window.phsBins.text())
-
     if window.PHS_raw.isChecked():
-        # Save all PHS
-        for events, detector, layers in zip(events_vec, detectors, layers_vec):
-            # Save wires PHS
-            for wCh in np.arange(0, layers*4, 1):
-                print('%s, Wires: %d/%d' % (detector, wCh, layers*4-1))
-                # Get ADC values
-                adcs = events[events.wCh == wCh]['adc']
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightgrey', ec='black', zorder=5)
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.title('PHS wires - Channel %d\nData set: %s' % (wCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Wires_%s_raw/Channel_%d.pdf' % (folder_path, detector, layers, wCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
-            # Save grids PHS
-            for gCh in np.arange(0, 12, 1):
-                print('%s, Grids: %d/11' % (detector, gCh))
-                # Get ADC values
-                adcs = events[events.gCh == gCh]['adc']
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightgrey', ec='black', zorder=5)
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.title('PHS grids - Channel %d\nData set: %s' % (gCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Grids_%s_raw/Channel_%d.pdf' % (folder_path, detector, layers, gCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
-
+        mode = 'raw'
     elif window.PHS_clustered.isChecked():
-        # Save all PHS
-        for events, detector, layers in zip(events_vec, detectors, layers_vec):
-            # Save wires PHS
-            for wCh in np.arange(0, layers*4, 1):
-                print('%s, Wires: %d/%d' % (detector, wCh, layers*4-1))
-                # Get ADC values
-                if window.wM_filter.isChecked():
-                    adcs = events[(events.wCh == wCh)
-                                & (window.wM_min.value() <= events.wM)
-                                & (events.wM <= window.wM_max.value())
-                                & (events.gM >= window.gM_min.value())
-                                & (events.gM <= window.gM_max.value())
-                                & (events.chip_id != 2)].adc
-                else:
-                    adcs = events[(events.wCh == wCh)
-                                & (events.chip_id != 2)].adc
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightblue', ec='black', zorder=5)
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.title('PHS wires - Channel %d\nData set: %s' % (wCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Wires_%s_clustered/Channel_%d.pdf' % (folder_path, detector, layers, wCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
-            # Save grids PHS
-            for gCh in np.arange(0, 12, 1):
-                print('%s, Grids: %d/11' % (detector, gCh))
-                # Get ADC values
-                if window.gM_filter.isChecked():
-                    adcs = events[(events.gCh == gCh)
-                                & (window.gM_min.value() <= events.gM)
-                                & (events.gM <= window.gM_max.value())
-                                & (events.wM >= window.wM_min.value())
-                                & (events.wM <= window.wM_max.value())
-                                & (events.chip_id == 2)].adc
-                else:
-                    adcs = events[(events.gCh == gCh)
-                                & (events.chip_id == 2)].adc
-
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightblue', ec='black', zorder=5)
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.title('PHS grids - Channel %d\nData set: %s' % (gCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Grids_%s_clustered/Channel_%d.pdf' % (folder_path, detector, layers, gCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
-
+        mode = 'clustered'
     elif window.PHS_overlay.isChecked():
-        # Save all PHS
-        for events, detector, layers in zip(events_vec, detectors, layers_vec):
-            # Save wires PHS
-            for wCh in np.arange(0, layers*4, 1):
-                print('%s, Wires: %d/%d' % (detector, wCh, layers*4-1))
-                # Get ADC values
-                adcs_events = events[events.wCh == wCh]['adc']
-                if window.wM_filter.isChecked():
-                    adcs_clusters = events[(events.wCh == wCh)
-                                         & (window.wM_min.value() <= events.wM)
-                                         & (events.wM <= window.wM_max.value())
-                                         & (events.gM >= window.gM_min.value())
-                                         & (events.gM <= window.gM_max.value())
-                                         & (events.chip_id != 2)].adc
-                else:
-                    adcs_clusters = events[(events.wCh == wCh)
-                                         & (events.chip_id != 2)].adc
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs_events, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightgrey', ec='black', zorder=5, label='raw')
-                plt.hist(adcs_clusters, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightblue', ec='black', alpha=0.6, zorder=5, label='clustered')
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.legend()
-                plt.title('PHS wires - Channel %d\nData set: %s' % (wCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Wires_%s_overlay/Channel_%d.pdf' % (folder_path, detector, layers, wCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
-            # Save grids PHS
-            for gCh in np.arange(0, 12, 1):
-                print('%s, Grids: %d/11' % (detector, gCh))
-                # Get ADC values
-                adcs_events = events[events.gCh == gCh]['adc']
-                if window.gM_filter.isChecked():
-                    adcs_clusters = events[(events.gCh == gCh)
-                                         & (window.gM_min.value() <= events.gM)
-                                         & (events.gM <= window.gM_max.value())
-                                         & (events.wM >= window.wM_min.value())
-                                         & (events.wM <= window.wM_max.value())
-                                         & (events.chip_id == 2)].adc
-                else:
-                    adcs_clusters = events[(events.gCh == gCh)
-                                         & (events.chip_id == 2)].adc
-                # Plot
-                fig = plt.figure()
-                plt.hist(adcs_events, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightgrey', ec='black', zorder=5, label='raw')
-                plt.hist(adcs_clusters, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                         facecolor='lightblue', ec='black', alpha=0.6, zorder=5, label='clustered')
-                plt.grid(True, which='major', zorder=0)
-                plt.grid(True, which='minor', linestyle='--', zorder=0)
-                plt.xlabel('Collected charge [ADC channels]')
-                plt.ylabel('Counts')
-                plt.legend()
-                plt.title('PHS grids - Channel %d\nData set: %s' % (gCh, window.data_sets))
-                # Save
-                output_path = '%s/%s/Grids_%s_overlay/Channel_%d.pdf' % (folder_path, detector, layers, gCh)
-                fig.savefig(output_path, bbox_inches='tight')
-                plt.close()
+        mode = 'overlay'
+    else:
+        return
+
+    # Save all PHS
+    for events, detector, layers in zip(events_vec, detectors, layers_vec):
+        adc = events.adc.values
+        for typeCh, w_or_g, folder, nbr_channels in [['wCh', 'wires', 'Wires', layers*4],
+                                                     ['gCh', 'grids', 'Grids', 12]]:
+            # ADC histograms of all channels in one pass, channel x ADC
+            channels = events[typeCh].values
+            hist_range = [[-0.5, nbr_channels - 0.5], [0, 1050]]
+            H_raw, H_clusters = None, None
+            if mode in ['raw', 'overlay']:
+                H_raw = histogram_2d(channels, adc, [nbr_channels, number_bins],
+                                     hist_range)
+            if mode in ['clustered', 'overlay']:
+                mask = get_clustered_mask(events, typeCh, window)
+                H_clusters = histogram_2d(channels, adc, [nbr_channels, number_bins],
+                                          hist_range, mask)
+            for channel in range(nbr_channels):
+                print('%s, %s: %d/%d' % (detector, folder, channel, nbr_channels-1))
+                output_path = ('%s/%s/%s_%s_%s/Channel_%d.pdf'
+                               % (folder_path, detector, folder, layers, mode, channel))
+                PHS_Individual_plot_bus(H_raw, H_clusters, channel, w_or_g, output_path)
 
 def PHS_Individual_Channel_plot(window, channel):
     """
@@ -482,92 +370,38 @@ def PHS_Individual_Channel_plot(window, channel):
     Accepts filters on grid and wire multiplicity.
     """
     # Import data
-    df_events_20   = window.Events_20_layers
-    df_events_16   = window.Events_16_layers
-    # Intial filter
-    events_20   = filter_events(df_events_20, window)
-    events_16   = filter_events(df_events_16, window)
-
     if window.ind_ch_20.isChecked():
-        events = events_20
+        events = filter_events(window.Events_20_layers, window)
         layers = '20 layers'
     else:
-        events = events_16
+        events = filter_events(window.Events_16_layers, window)
         layers = '16 layers'
 
     number_bins = int(window.phsBins.text())
+    if window.ind_gCh.isChecked():
+        typeCh, w_or_g = 'gCh', 'grid'
+    else:
+        typeCh, w_or_g = 'wCh', 'wire'
+    # Get ADC histograms
+    adc = events.adc.values
+    channel_mask = events[typeCh].values == channel
+    counts_raw = histogram_1d(adc, number_bins, [0, 1050], channel_mask)
+    counts_clusters = histogram_1d(adc, number_bins, [0, 1050],
+                                   channel_mask & get_clustered_mask(events, typeCh, window))
     # Plot
     fig = plt.figure()
-    # Get ADC values
     if window.PHS_raw.isChecked():
-        if window.ind_gCh.isChecked():
-            adcs = events[events.gCh == channel]['adc']
-            w_or_g = 'grid'
-        elif window.ind_wCh.isChecked():
-            adcs = events[events.wCh == channel]['adc']
-            w_or_g = 'wire'
-        plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                facecolor='lightgrey', ec='black', zorder=5)
+        plot_histogram_1d(counts_raw, [0, 1050], histtype='stepfilled',
+                          facecolor='lightgrey', ec='black', zorder=5)
     elif window.PHS_clustered.isChecked():
-        if window.ind_gCh.isChecked():
-            w_or_g = 'grid'
-            if window.gM_filter.isChecked():
-                adcs = events[(events.gCh == channel)
-                            & (window.gM_min.value() <= events.gM)
-                            & (events.gM <= window.gM_max.value())
-                            & (events.wM >= window.wM_min.value())
-                            & (events.wM <= window.wM_max.value())
-                            & (events.chip_id == 2)].adc
-            else:
-                adcs = events[(events.gCh == channel)
-                            & (events.chip_id == 2)].adc
-        elif window.ind_wCh.isChecked():
-            w_or_g = 'wire'
-            if window.wM_filter.isChecked():
-                adcs = events[(events.wCh == channel)
-                            & (window.wM_min.value() <= events.wM)
-                            & (events.wM <= window.wM_max.value())
-                            & (events.gM >= window.gM_min.value())
-                            & (events.gM <= window.gM_max.value())
-                            & (events.chip_id != 2)].adc
-            else:
-                adcs = events[(events.wCh == channel)
-                            & (events.chip_id != 2)].adc
-        plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                facecolor='lightblue', ec='black', zorder=5)
+        plot_histogram_1d(counts_clusters, [0, 1050], histtype='stepfilled',
+                          facecolor='lightblue', ec='black', zorder=5)
     elif window.PHS_overlay.isChecked():
-        if window.ind_gCh.isChecked():
-            w_or_g = 'grid'
-            adcs_events = events[events.gCh == channel]['adc']
-            if window.gM_filter.isChecked():
-                adcs_clusters = events[(events.gCh == channel)
-                                     & (window.gM_min.value() <= events.gM)
-                                     & (events.gM <= window.gM_max.value())
-                                     & (events.wM >= window.wM_min.value())
-                                     & (events.wM <= window.wM_max.value())
-                                     & (events.chip_id == 2)].adc
-            else:
-                adcs_clusters = events[(events.gCh == channel)
-                                     & (events.chip_id == 2)].adc
-
-        elif window.ind_wCh.isChecked():
-            w_or_g = 'wire'
-            adcs_events = events[events.wCh == channel]['adc']
-            if window.wM_filter.isChecked():
-                adcs_clusters = events[(events.wCh == channel)
-                                     & (window.wM_min.value() <= events.wM)
-                                     & (events.wM <= window.wM_max.value())
-                                     & (events.gM >= window.gM_min.value())
-                                     & (events.gM <= window.gM_max.value())
-                                     & (events.chip_id != 2)].adc
-            else:
-                adcs_clusters = events[(events.wCh == channel)
-                                     & (events.chip_id != 2)].adc
-
-        plt.hist(adcs_events, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                 facecolor='lightgrey', ec='black', zorder=5, label='raw')
-        plt.hist(adcs_clusters, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                 facecolor='lightblue', ec='black', alpha=0.6, zorder=5, label='clustered')
+        plot_histogram_1d(counts_raw, [0, 1050], histtype='stepfilled',
+                          facecolor='lightgrey', ec='black', zorder=5, label='raw')
+        plot_histogram_1d(counts_clusters, [0, 1050], histtype='stepfilled',
+                          facecolor='lightblue', ec='black', alpha=0.6, zorder=5,
+                          label='clustered')
         plt.legend()
     plt.grid(True, which='major', zorder=0)
     plt.grid(True, which='minor', linestyle='--', zorder=0)
@@ -581,61 +415,49 @@ def PHS_cluster_plot(window):
     MG mapping, makes 1D PHS plot for clustered (neutron)
     events
     """
-    def PHS_cluster_plot_bus(clusters, typeCh, sub_title, number_bins):
+    def PHS_cluster_plot_bus(counts, sub_title):
         plt.title(sub_title)
         plt.xlabel('Collected charge [ADC channels]')
         plt.ylabel('Counts')
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
-        if typeCh == 'gCh':
-            if window.gM_filter.isChecked():
-                adcs = clusters[(window.gM_min.value() <= clusters.gM)
-                              & (clusters.gM <= window.gM_max.value())
-                              & (clusters.wM >= window.wM_min.value())
-                              & (clusters.wM <= window.wM_max.value())
-                              & (clusters.chip_id == 2)].adc
-            else:
-                adcs = clusters[clusters.chip_id == 2].adc
-
-        elif typeCh == 'wCh':
-            if window.wM_filter.isChecked():
-                adcs = clusters[(window.wM_min.value() <= clusters.wM)
-                              & (clusters.wM <= window.wM_max.value())
-                              & (clusters.gM >= window.gM_min.value())
-                              & (clusters.gM <= window.gM_max.value())
-                              & (clusters.chip_id != 2)].adc
-            else:
-                adcs = clusters[clusters.chip_id != 2].adc
         #plt.yscale('log')
-        plt.hist(adcs, bins=number_bins, range=[0, 1050], histtype='stepfilled',
-                 facecolor='lightblue', ec='black', zorder=5)
+        plot_histogram_1d(counts, [0, 1050], histtype='stepfilled',
+                          facecolor='lightblue', ec='black', zorder=5)
+
+    def compute():
+        H = {}
+        for layers, df in [['20', window.Events_20_layers],
+                           ['16', window.Events_16_layers]]:
+            # Initial filter
+            clusters = filter_events(df, window)
+            for typeCh in typeChs:
+                mask = get_clustered_mask(clusters, typeCh, window)
+                H[typeCh + layers] = histogram_1d(clusters.adc.values, number_bins,
+                                                  [0, 1050], mask)
+        return H
 
-    # Import data
-    df_16 = window.Events_16_layers
-    df_20 = window.Events_20_layers
-    # Initial filter
-    clusters_16 = filter_events(df_16, window)
-    clusters_20 = filter_events(df_20, window)
     number_bins = int(window.phsBins.text())
+    typeChs = ['gCh', 'wCh']
+    grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_cluster', compute, number_bins)
     # Prepare figure
     fig = plt.figure()
     title = 'PHS clustered (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
     fig.suptitle(title, x=0.5, y=0.98)
     fig.set_figheight(6)
     fig.set_figwidth(8)
-
-    typeChs = ['gCh', 'wCh']
-    grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
     # for 20 layers
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+1)
         sub_title = "%s -- 20 layers" % (grids_or_wires[typeCh])
-        PHS_cluster_plot_bus(clusters_20, typeCh, sub_title, number_bins)
+        PHS_cluster_plot_bus(H[typeCh + '20'], sub_title)
     # for 16 layers
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+3)
         sub_title = "%s -- 16 layers" % (grids_or_wires[typeCh])
-        PHS_cluster_plot_bus(clusters_16, typeCh, sub_title, number_bins)
+        PHS_cluster_plot_bus(H[typeCh + '16'], sub_title)
     plt.subplots_adjust(left=0.1, right=0.93, top=0.88, bottom=0.1, wspace=0.35, hspace=0.35)
     return fig
 
@@ -644,7 +466,7 @@ def PHS_1D_overlay_plot(window):
     MG mapping, makes 1D PHS plot overlaying raw events and clustered
     events
     """
-    def PHS_1D_overlay_plot_bus(events, typeCh, sub_title, number_bins):
+    def PHS_1D_overlay_plot_bus(counts_raw, counts_clusters, sub_title):
         # Plot
         plt.title(sub_title)
         plt.xlabel('Collected charge [ADC channels]')
@@ -652,42 +474,32 @@ def PHS_1D_overlay_plot(window):
         plt.grid(True, which='major', zorder=0)
         plt.grid(True, which='minor', linestyle='--', zorder=0)
         #plt.yscale('log')
-        if typeCh == 'gCh':
-            if window.gM_filter.isChecked():
-                adcs_clusters = events[(window.gM_min.value() <= events.gM)
-                                     & (events.gM <= window.gM_max.value())
-                                     & (events.wM >= window.wM_min.value())
-                                     & (events.wM <= window.wM_max.value())
-                                     & (events.chip_id == 2)].adc
-            else:
-                adcs_clusters = events[events.chip_id == 2].adc
-        elif typeCh == 'wCh':
-            if window.wM_filter.isChecked():
-                adcs_clusters = events[(window.wM_min.value() <= events.wM)
-                                     & (events.wM <= window.wM_max.value())
-                                     & (events.gM >= window.gM_min.value())
-                                     & (events.gM <= window.gM_max.value())
-                                     & (events.chip_id != 2)].adc
-            else:
-                adcs_clusters = events[events.chip_id != 2].adc
-        plt.hist(events[events[typeCh] >= 0].adc, bins=number_bins,
-                 range=[0, 1050], histtype='stepfilled', ec='black',
-                 facecolor='lightgrey', zorder=5, label='raw')
-        plt.hist(adcs_clusters, bins=number_bins,
-                 range=[0, 1050], histtype='stepfilled', ec='black',
-                 facecolor='lightblue', alpha=0.6, zorder=5, label='clustered')
+        plot_histogram_1d(counts_raw, [0, 1050], histtype='stepfilled', ec='black',
+                          facecolor='lightgrey', zorder=5, label='raw')
+        plot_histogram_1d(counts_clusters, [0, 1050], histtype='stepfilled', ec='black',
+                          facecolor='lightblue', alpha=0.6, zorder=5, label='clustered')
         plt.legend()
 
-    # Import data
-    raw_20 = window.Events_20_layers
-    raw_16 = window.Events_16_layers
-    # Apply filters
-    events_16 = filter_events(raw_16, window)
-    events_20 = filter_events(raw_20, window)
+    def compute():
+        H = {}
+        for layers, df in [['20', window.Events_20_layers],
+                           ['16', window.Events_16_layers]]:
+            # Apply filters
+            events = filter_events(df, window)
+            adc = events.adc.values
+            for typeCh in typeChs:
+                H['raw_' + typeCh + layers] = histogram_1d(adc, number_bins, [0, 1050],
+                                                           events[typeCh].values >= 0)
+                mask = get_clustered_mask(events, typeCh, window)
+                H['clusters_' + typeCh + layers] = histogram_1d(adc, number_bins,
+                                                                [0, 1050], mask)
+        return H
 
     number_bins = int(window.phsBins.text())
     typeChs = ['gCh', 'wCh']
     grids_or_wires = {'wCh': 'Wires', 'gCh': 'Grids'}
+    # Compute histograms, or reuse them if nothing changed
+    H = get_cached(window, 'PHS_1D_overlay', compute, number_bins)
     # Prepare figure
     fig = plt.figure()
     title = 'PHS overlay (1D)\n(%s, ...)' % window.data_sets.splitlines()[0]
@@ -699,12 +511,39 @@ def PHS_1D_overlay_plot(window):
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+1)
         sub_title = "%s -- 20 layers" % (grids_or_wires[typeCh])
-        PHS_1D_overlay_plot_bus(events_20, typeCh, sub_title, number_bins)
+        PHS_1D_overlay_plot_bus(H['raw_' + typeCh + '20'],
+                                H['clusters_' + typeCh + '20'], sub_title)
     # for 16 layers
     for i, typeCh in enumerate(typeChs):
         plt.subplot(2, 2, i+3)
         sub_title = "%s -- 16 layers" % (grids_or_wires[typeCh])
-        PHS_1D_overlay_plot_bus(events_16, typeCh, sub_title, number_bins)
+        PHS_1D_overlay_plot_bus(H['raw_' + typeCh + '16'],
+                                H['clusters_' + typeCh + '16'], sub_title)
 
     plt.subplots_adjust(left=0.1, right=0.93, top=0.88, bottom=0.12, wspace=0.3, hspace=0.4)
     return fig
+
+
+# =============================================================================
+# Helper Functions
+# =============================================================================
+
+
+def get_clustered_mask(events, typeCh, window):
+    """
+    Returns a mask of the grid ('gCh') or wire ('wCh') events which are part
+    of a cluster within the multiplicity filters.
+    """
+    gM = events['gM'].values
+    wM = events['wM'].values
+    chip_id = events['chip_id'].values
+    if typeCh == 'gCh':
+        mask = chip_id == 2
+        multiplicity_filter_on = window.gM_filter.isChecked()
+    else:
+        mask = chip_id != 2
+        multiplicity_filter_on = window.wM_filter.isChecked()
+    if multiplicity_filter_on:
+        mask &= ((gM >= window.gM_min.value()) & (gM <= window.gM_max.value())
+                 & (wM >= window.wM_min.value()) & (wM <= window.wM_max.value()))
+    return mask
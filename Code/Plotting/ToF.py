@@ -0,0 +1,62 @@
+import matplotlib.pyplot as plt
+from tof import get_tof, get_pulse_period
+from Plotting.HelperFunctions import (filter_coincident_events, histogram_1d,
+                                      histogram_2d, plot_histogram_1d,
+                                      plot_histogram_2d)
+
+# =============================================================================
+# ToF
+# =============================================================================
+
+
+def ToF_plot(window, pulse_times, number_bins=500):
+    """
+    ToF of the filtered clusters with respect to the preceding pulse, for
+    each detector and per wire and grid channel.
+    """
+    def ToF_1D_plot_bus(tof, sub_title):
+        plt.title(sub_title)
+        plt.xlabel('ToF [ms]')
+        plt.ylabel('Counts')
+        plt.grid(True, which='major', zorder=0)
+        plt.grid(True, which='minor', linestyle='--', zorder=0)
+        plot_histogram_1d(histogram_1d(tof, number_bins, tof_range),
+                          tof_range_ms, histtype='stepfilled',
+                          facecolor='lightgrey', ec='black', zorder=5)
+
+    def ToF_2D_plot_bus(tof, channels, nbr_channels, sub_title):
+        plt.title(sub_title)
+        plt.xlabel('ToF [ms]')
+        plt.ylabel('Channel')
+        H = histogram_2d(tof, channels, [number_bins, nbr_channels],
+                         [tof_range, [-0.5, nbr_channels - 0.5]])
+        plot_histogram_2d(H, [tof_range_ms, [-0.5, nbr_channels - 0.5]])
+        plt.colorbar()
+
+    data_sets = window.data_sets.splitlines()[0]
+    # The ToF range is one pulse period
+    period = get_pulse_period(pulse_times)
+    if period is None:
+        period = 1e9 / 14  # ESS, 14 Hz
+    tof_range = [0, period]
+    tof_range_ms = [0, period * 1e-6]
+    # Prepare figure
+    fig = plt.figure()
+    fig.suptitle('ToF\n(%s, ...)' % data_sets, x=0.5, y=0.98)
+    fig.set_figheight(8)
+    fig.set_figwidth(13)
+    for row, (layers, clusters, wires) in enumerate([[20, window.Clusters_20_layers, 80],
+                                                     [16, window.Clusters_16_layers, 64]]):
+        ce_red = filter_coincident_events(clusters, window)
+        tof, valid = get_tof(ce_red['Time'].values, pulse_times)
+        wCh = ce_red['wCh'].values[valid]
+        gCh = ce_red['gCh'].values[valid]
+        tof = tof[valid]
+        plt.subplot(2, 3, 3*row + 1)
+        ToF_1D_plot_bus(tof, 'ToF -- %d layers' % layers)
+        plt.subplot(2, 3, 3*row + 2)
+        ToF_2D_plot_bus(tof, wCh, wires, 'Wires -- %d layers' % layers)
+        plt.subplot(2, 3, 3*row + 3)
+        ToF_2D_plot_bus(tof, gCh, 12, 'Grids -- %d layers' % layers)
+    plt.subplots_adjust(left=0.07, right=0.97, top=0.88, bottom=0.08, wspace=0.35, hspace=0.4)
+    return fig
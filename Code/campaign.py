@@ -0,0 +1,479 @@
+import os
+import numpy as np
+import pandas as pd
+import warnings
+import multiprocessing
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                as_completed)
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+from cluster import (read_hits, get_read_state, read_srs_hits, read_columns,
+                     mask_channels, detect_hot_channels, calibrate_adc,
+                     cluster_data, new_clustering_session,
+                     finish_clustering_session, update_channel_stats,
+                     shift_cluster_index, get_bytes_per_hit)
+import memory
+from memory import get_rss, track_stage, check_memory_budget
+import filters
+from filters import (get_filter_state, get_event_mask, get_cluster_mask,
+                     histogram_1d, histogram_2d, NBR_THREADS)
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Number of hits (or clusters) per chunk, reduced to fit the memory budget
+CHUNK_SIZE = 5000000
+# Smallest chunk, below that the memory budget is exceeded
+MIN_CHUNK_SIZE = 1000
+# Keys of the histograms which hold [first, last] timestamps instead of counts
+TIME_KEYS = ['events_time', 'clusters_time', 'hits_time']
+# Rows kept as a random sample of the events and of the clusters in the
+# histogram-only mode
+RESERVOIR_SIZE = 100000
+# Worker processes for comparing runs, the threads are shared between them
+NBR_PROCESSES = int(os.environ.get('MG_PROCESSES', os.cpu_count() or 1))
+# Widgets and values of the window used by clustering, filters and campaigns,
+# copied by WindowSettings
+SETTINGS_WIDGETS = (['time_window', 'phsBins', 'sample_button',
+                     'time_min', 'time_max', 'timestamp_filter']
+                    + ['%s_%s' % (parameter, suffix)
+                       for parameter in ['ADC', 'channel', 'chip', 'wADC', 'gADC',
+                                         'wM', 'gM', 'wCh', 'gCh']
+                       for suffix in ['min', 'max', 'filter']])
+SETTINGS_VALUES = ['masked_channels', 'hot_channel_factor', 'pulse_channel',
+                   'filter_on_read', 'calibration']
+
+
+# =============================================================================
+# Campaign
+# =============================================================================
+
+
+def run_campaign(file_paths, window, chunk_size=None):
+    """
+    Out-of-core analysis of many files. Raw files are clustered chunk by
+    chunk as one stream, clustered stores (see cluster_to_store) are read
+    chunk by chunk. The current filters are applied to each chunk and the
+    results are accumulated in mergeable histograms, so the memory is bounded
+    by the chunk size and not by the size of the campaign.
+    """
+    histograms = new_histograms(int(window.phsBins.text()))
+    accumulate_histograms(histograms, file_paths, window, chunk_size=chunk_size)
+    return histograms
+
+
+def accumulate_histograms(histograms, file_paths, window, reservoirs=None,
+                          chunk_size=None, state=None):
+    """
+    Adds the files to the histograms (see new_histograms) chunk by chunk,
+    with the filters in 'state' (the current filters if None), and discards
+    the rows. If 'reservoirs' is given, {'events': Reservoir, 'clusters':
+    Reservoir}, a random sample of the rows is kept for spot checks.
+    Returns the per-channel statistics of the files (see
+    update_channel_stats).
+    """
+    if state is None:
+        state = get_filter_state(window)
+    session = new_clustering_session()
+    with track_stage('Campaign'):
+        for events, clusters in iterate_chunks(file_paths, window, chunk_size, session):
+            if events is not None:
+                fill_event_histograms(histograms, events, state)
+                if reservoirs is not None:
+                    reservoirs['events'].add(events)
+            if clusters is not None:
+                fill_cluster_histograms(histograms, clusters, state)
+                if reservoirs is not None:
+                    reservoirs['clusters'].add(clusters)
+    return session['channel_stats']
+
+
+def iterate_chunks(file_paths, window, chunk_size=None, session=None):
+    """
+    Yields (events, clusters) chunks from a list of raw files, clustered in
+    one session, or from clustered stores. One of the two can be None. The
+    per-channel statistics of all events are accumulated in the session.
+    Hot channels are detected in the first chunk with hits and masked in
+    all chunks.
+    """
+    if session is None:
+        session = new_clustering_session()
+    # Hit filters applied while reading raw files (see read_hits)
+    state = get_read_state(window) if window.filter_on_read else None
+    hot_channels = None
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as h5_file:
+            if 'clusters' in h5_file:
+                for table in ['events', 'clusters']:
+                    dataset = h5_file[table]
+                    size = get_chunk_size(dataset, chunk_size)
+                    read = lambda start: pd.DataFrame(
+                        read_columns(dataset, start, start+size), copy=False)
+                    for chunk in prefetch(read, range(0, dataset.shape[0], size)):
+                        if table == 'events':
+                            update_channel_stats(session['channel_stats'], chunk)
+                            yield chunk, None
+                        else:
+                            yield None, chunk
+            else:
+                srs_hits = h5_file['srs_hits']
+                size = get_chunk_size(srs_hits, chunk_size)
+                if state is not None:
+                    read = lambda start: read_hits(srs_hits, state, start, start+size)
+                else:
+                    read = lambda start: read_srs_hits(srs_hits, start, start+size)
+                # The next chunk is read while this one is clustered
+                for data in prefetch(read, range(0, srs_hits.shape[0], size)):
+                    # Hot channels of the first chunk are masked in all
+                    if hot_channels is None:
+                        hot_channels = detect_hot_channels(data, window)
+                    data = calibrate_adc(mask_channels(data, window, hot_channels),
+                                         window)
+                    # The last cluster is closed when the session is finished
+                    clusters, events = cluster_data(data, window, 0, None, session)
+                    yield events, clusters
+    last = finish_clustering_session(session, window)
+    if last is not None:
+        clusters, events = last
+        yield events, clusters
+
+
+def cluster_to_store(file_paths, store_path, window, chunk_size=None):
+    """
+    Clusters raw files chunk by chunk and writes the events and clusters to
+    a clustered store: an HDF5 file with the datasets 'events' and
+    'clusters', which can be analysed with run_campaign without clustering
+    again. The raw files, the time window, the hits per chip and the first
+    and last timestamp are stored in the attributes 'source_files',
+    'time_window', 'chip_hits' and 'time_range', for the catalog.
+    """
+    nbr_clusters, nbr_hits = 0, 0
+    chip_hits = np.zeros(0, dtype=np.int64)
+    time_range = [np.iinfo(np.int64).max, np.iinfo(np.int64).min]
+    with h5py.File(store_path, 'w') as store:
+        store.attrs['source_files'] = [os.path.abspath(file_path)
+                                       for file_path in file_paths]
+        store.attrs['time_window'] = float(window.time_window.text())
+        for events, clusters in iterate_chunks(file_paths, window, chunk_size):
+            # Cluster-to-hit index relative to the whole store
+            shift_cluster_index(clusters, events, nbr_clusters, nbr_hits)
+            nbr_clusters += clusters.shape[0]
+            nbr_hits += events.shape[0]
+            append_to_store(store, 'events', events)
+            append_to_store(store, 'clusters', clusters)
+            if events.shape[0] > 0:
+                counts = np.bincount(events['chip_id'].values.astype(np.int64))
+                chip_hits = np.pad(chip_hits, (0, max(len(counts) - len(chip_hits), 0)))
+                chip_hits[:len(counts)] += counts
+                timestamps = events['srs_timestamp'].values
+                time_range = [min(time_range[0], timestamps.min()),
+                              max(time_range[1], timestamps.max())]
+        store.attrs['chip_hits'] = chip_hits
+        if nbr_hits > 0:
+            store.attrs['time_range'] = time_range
+
+
+# =============================================================================
+# Sampling
+# =============================================================================
+
+
+class Reservoir:
+    """
+    Uniform random sample of at most 'size' rows of a stream of tables with
+    the same columns (reservoir sampling, vectorized per table), in fixed
+    memory. The cluster-to-hit index of sampled clusters does not refer to
+    the sampled events.
+    """
+    def __init__(self, size=RESERVOIR_SIZE, seed=None):
+        self.size = size
+        self.nbr_rows = 0
+        self.columns = None
+        # Position in the stream of the row in each slot, -1 if empty
+        self.positions = np.full(size, -1, dtype=np.int64)
+        self.rng = np.random.default_rng(seed)
+
+    def add(self, table):
+        nbr_rows = table.shape[0]
+        if nbr_rows == 0:
+            return
+        if self.columns is None:
+            self.columns = {column: np.empty(self.size, dtype=table[column].dtype)
+                            for column in table.columns}
+        positions = self.nbr_rows + np.arange(nbr_rows)
+        self.nbr_rows += nbr_rows
+        # Row k of the stream takes a random one of k+1 slots, and is kept if
+        # that slot exists. Of several rows taking the same slot the last one
+        # is kept, as when adding the rows one by one.
+        slots = np.where(positions < self.size, positions,
+                         self.rng.integers(0, positions + 1))
+        rows = np.nonzero(slots < self.size)[0][::-1]
+        slots, first = np.unique(slots[rows], return_index=True)
+        rows = rows[first]
+        for column, values in self.columns.items():
+            values[slots] = table[column].values[rows]
+        self.positions[slots] = positions[rows]
+
+    def table(self):
+        """Returns the sample as a DataFrame, in the order of the stream."""
+        if self.columns is None:
+            return pd.DataFrame()
+        order = np.argsort(self.positions)[-min(self.nbr_rows, self.size):]
+        return pd.DataFrame({column: values[order]
+                             for column, values in self.columns.items()})
+
+
+# =============================================================================
+# Run comparison
+# =============================================================================
+
+
+def compare_runs(runs, window, nbr_processes=None, chunk_size=None):
+    """
+    Analyses several runs, e.g. the settings of an HV scan, as campaigns
+    (see run_campaign) in parallel worker processes. 'runs' maps run names to
+    lists of raw files or clustered stores. Each worker holds one chunk of
+    its run at a time and the memory budget is shared between the workers.
+    Returns the histograms of the runs stacked (see stack_histograms).
+    """
+    if nbr_processes is None:
+        nbr_processes = NBR_PROCESSES
+    nbr_processes = max(min(nbr_processes, len(runs)), 1)
+    settings = WindowSettings(window)
+    memory_budget = (memory.MEMORY_BUDGET / nbr_processes
+                     if memory.MEMORY_BUDGET is not None else None)
+    nbr_threads = max(NBR_THREADS // nbr_processes, 1)
+    results = {}
+    # Spawned workers do not inherit the threads and the GUI of this process
+    context = multiprocessing.get_context('spawn')
+    with track_stage('Run comparison'):
+        with ProcessPoolExecutor(nbr_processes, mp_context=context,
+                                 initializer=init_worker,
+                                 initargs=(memory_budget, nbr_threads)) as executor:
+            futures = {executor.submit(run_campaign, file_paths, settings, chunk_size): name
+                       for name, file_paths in runs.items()}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                print('[runs] %s done (%d/%d)' % (futures[future], len(results), len(runs)))
+    return stack_histograms({name: results[name] for name in runs})
+
+
+def stack_histograms(results):
+    """
+    Stacks the histograms of several runs, run name -> histograms, into
+    arrays with the run as first axis, e.g. 'PHS_1D_MG' of shape
+    (runs, 2, number_bins). The names are in 'runs', and 'events_duration'
+    and 'clusters_duration' hold the time span of each run [s], for rates.
+    """
+    names = list(results)
+    stacked = {'runs': names, 'number_bins': results[names[0]]['number_bins']}
+    for key in results[names[0]]:
+        if key != 'number_bins':
+            stacked[key] = np.stack([np.asarray(results[name][key]) for name in names])
+    for table in ['events', 'clusters']:
+        first, last = stacked[table + '_time'].astype(float).T
+        # Runs without events keep the initial [max, min] time span
+        stacked[table + '_duration'] = np.where(last > first, (last - first) * 1e-9, 0)
+    return stacked
+
+
+def init_worker(memory_budget, nbr_threads):
+    """
+    Shares the memory budget and the threads between the workers. The
+    budget is only read from memory.MEMORY_BUDGET, so all stages of a
+    worker are checked against its share.
+    """
+    import cluster
+    memory.MEMORY_BUDGET = memory_budget
+    cluster.NBR_THREADS = filters.NBR_THREADS = nbr_threads
+
+
+class WindowSettings:
+    """
+    A copy of the settings of the window used by clustering, the filters
+    and campaigns (SETTINGS_WIDGETS and SETTINGS_VALUES). Unlike the window
+    it can be sent to worker processes, and it does not change while they
+    run.
+    """
+    def __init__(self, window):
+        for name in SETTINGS_WIDGETS:
+            setattr(self, name, FrozenWidget(getattr(window, name)))
+        for name in SETTINGS_VALUES:
+            setattr(self, name, getattr(window, name))
+
+
+class FrozenWidget:
+    """The value, text and check state of a widget when it was copied."""
+    def __init__(self, widget):
+        self._value = widget.value() if hasattr(widget, 'value') else None
+        self._text = widget.text() if hasattr(widget, 'text') else None
+        self._checked = widget.isChecked() if hasattr(widget, 'isChecked') else None
+
+    def value(self):
+        return self._value
+
+    def text(self):
+        return self._text
+
+    def isChecked(self):
+        return self._checked
+
+
+# =============================================================================
+# Histograms
+# =============================================================================
+
+
+def new_histograms(number_bins):
+    """
+    Returns empty histograms for the campaign plots. All counts are over the
+    filtered events and clusters:
+
+        PHS_1D_VMM:      ADC per VMM chip (2-5)                 4 x number_bins
+        PHS_1D_MG:       ADC of grid and wire events            2 x number_bins
+        PHS_2D_MG_grids: ADC vs grid channel                   12 x 120
+        PHS_2D_MG_wires: ADC vs wire channel                   80 x 120
+        Coincidences:    wire channel vs grid channel          80 x 13
+        events_gCh/wCh, clusters_gCh/wCh: counts per channel for rates
+        events_time, clusters_time: [first, last] timestamp
+        hits_time: [first, last] timestamp of all events, unfiltered, for
+                   the measurement time
+    """
+    return {'number_bins': number_bins,
+            'PHS_1D_VMM': np.zeros((4, number_bins), dtype=np.int64),
+            'PHS_1D_MG': np.zeros((2, number_bins), dtype=np.int64),
+            'PHS_2D_MG_grids': np.zeros((12, 120), dtype=np.int64),
+            'PHS_2D_MG_wires': np.zeros((80, 120), dtype=np.int64),
+            'Coincidences': np.zeros((80, 13), dtype=np.int64),
+            'events_gCh': np.zeros(12, dtype=np.int64),
+            'events_wCh': np.zeros(80, dtype=np.int64),
+            'clusters_gCh': np.zeros(12, dtype=np.int64),
+            'clusters_wCh': np.zeros(80, dtype=np.int64),
+            'events_time': np.array([np.iinfo(np.int64).max, np.iinfo(np.int64).min]),
+            'clusters_time': np.array([np.iinfo(np.int64).max, np.iinfo(np.int64).min]),
+            'hits_time': np.array([np.iinfo(np.int64).max, np.iinfo(np.int64).min])
+            }
+
+
+def merge_histograms(histograms, other):
+    """Adds the histograms in 'other' to 'histograms', in place."""
+    for key, values in other.items():
+        if key == 'number_bins':
+            continue
+        elif key in TIME_KEYS:
+            histograms[key][0] = min(histograms[key][0], values[0])
+            histograms[key][1] = max(histograms[key][1], values[1])
+        else:
+            histograms[key] += values
+    return histograms
+
+
+def fill_event_histograms(histograms, events, state):
+    if events.shape[0] > 0:
+        timestamps = events['srs_timestamp'].values
+        merge_histograms(histograms, {'hits_time': [timestamps.min(), timestamps.max()]})
+    mask = get_event_mask(events, state)
+    if not mask.any():
+        return
+    number_bins = histograms['number_bins']
+    adc = events['adc'].values
+    chip_id = events['chip_id'].values
+    gCh = events['gCh'].values
+    wCh = events['wCh'].values
+    # PHS (1D)
+    histograms['PHS_1D_VMM'] += histogram_2d(chip_id, adc, [4, number_bins],
+                                             [[1.5, 5.5], [0, 1050]], mask)
+    histograms['PHS_1D_MG'][0] += histogram_1d(adc, number_bins, [0, 1050],
+                                               mask & (gCh >= 0))
+    histograms['PHS_1D_MG'][1] += histogram_1d(adc, number_bins, [0, 1050],
+                                               mask & (wCh >= 0))
+    # PHS (2D), with the same channel selection as PHS_2D_MG_plot
+    gCh_min, gCh_max, gCh_filter_on = state['gCh']
+    wCh_min, wCh_max, wCh_filter_on = state['wCh']
+    if not gCh_filter_on:
+        gCh_min, gCh_max = 0, 12
+    if not wCh_filter_on:
+        wCh_min, wCh_max = 0, 79
+    histograms['PHS_2D_MG_grids'] += histogram_2d(gCh, adc, [12, 120],
+                                                  [[-0.5, 11.5], [0, 1050]],
+                                                  mask & (gCh >= gCh_min) & (gCh <= gCh_max))
+    histograms['PHS_2D_MG_wires'] += histogram_2d(wCh, adc, [80, 120],
+                                                  [[-0.5, 79.5], [0, 1050]],
+                                                  mask & (wCh >= wCh_min) & (wCh <= wCh_max))
+    # Rates
+    histograms['events_gCh'] += histogram_1d(gCh, 12, [-0.5, 11.5], mask)
+    histograms['events_wCh'] += histogram_1d(wCh, 80, [-0.5, 79.5], mask)
+    # The hits are not in time order, so the span does not depend on chunks
+    timestamps = events['srs_timestamp'].values[mask]
+    merge_histograms(histograms, {'events_time': [timestamps.min(), timestamps.max()]})
+
+
+def fill_cluster_histograms(histograms, clusters, state):
+    mask = get_cluster_mask(clusters, state)
+    if not mask.any():
+        return
+    gCh = clusters['gCh'].values
+    wCh = clusters['wCh'].values
+    # Coincidences, as the 3D histogram (unit bins from 0)
+    histograms['Coincidences'] += histogram_2d(wCh, gCh, [80, 13],
+                                               [[-0.5, 79.5], [-0.5, 12.5]], mask)
+    # Rates
+    histograms['clusters_gCh'] += histogram_1d(gCh, 12, [-0.5, 11.5], mask)
+    histograms['clusters_wCh'] += histogram_1d(wCh, 80, [-0.5, 79.5], mask)
+    times = clusters['Time'].values[mask]
+    merge_histograms(histograms, {'clusters_time': [times.min(), times.max()]})
+
+
+# =============================================================================
+# Helper Functions
+# =============================================================================
+
+
+def get_chunk_size(dataset, chunk_size=None):
+    """
+    Returns the number of rows per chunk, reduced such that clustering a
+    chunk, and reading the next one, fits in the memory budget.
+    """
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+        if memory.MEMORY_BUDGET is not None:
+            free = memory.MEMORY_BUDGET - get_rss()
+            bytes_per_hit = get_bytes_per_hit(dataset.dtype) + dataset.dtype.itemsize
+            chunk_size = min(chunk_size, int(free / bytes_per_hit))
+            if chunk_size < MIN_CHUNK_SIZE:
+                # Not even the smallest chunk fits, refuse with a report
+                check_memory_budget('Campaign chunk', MIN_CHUNK_SIZE * bytes_per_hit)
+    return max(chunk_size, MIN_CHUNK_SIZE)
+
+
+def prefetch(function, arguments):
+    """
+    Yields 'function(argument)' for each argument in order, computing the
+    next result on a background thread while the current one is used.
+    """
+    with ThreadPoolExecutor(1) as executor:
+        future = None
+        for argument in arguments:
+            next_future = executor.submit(function, argument)
+            if future is not None:
+                yield future.result()
+            future = next_future
+        if future is not None:
+            yield future.result()
+
+
+def append_to_store(store, name, table):
+    if table.shape[0] == 0:
+        return
+    records = table.to_records(index=False)
+    if name not in store:
+        store.create_dataset(name, data=records, maxshape=(None,),
+                             chunks=True, compression='gzip')
+    else:
+        dataset = store[name]
+        size = dataset.shape[0]
+        dataset.resize((size + records.shape[0],))
+        dataset[size:] = records
@@ -0,0 +1,305 @@
+import os
+import re
+import glob
+import sqlite3
+import numpy as np
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# File name of the catalog in the scanned directory
+CATALOG_NAME = 'catalog.sqlite'
+# Version of the schema, older catalogs are rebuilt on opening
+CATALOG_VERSION = 2
+# The hits per chip of raw files are estimated from this many blocks of rows
+# spread over the file, smaller files are counted exactly
+SCAN_SAMPLES = 16
+SCAN_SAMPLE_SIZE = 100000
+# Conditions select_files accepts, column -> SQL with the comparison
+# operator as '%s' and the value as parameter. 'chip_id' selects the files
+# with hits on a chip, 'clustered' counts the stores a file was clustered into.
+SELECT_COLUMNS = dict({column: column + ' %s ?' for column in
+                       ['name', 'kind', 'size', 'hits', 'clusters', 'time_min',
+                        'time_max', 'duration', 'rate', 'time_window']},
+                      chip_id='path IN (SELECT path FROM chips '
+                              'WHERE hits > 0 AND chip_id %s ?)',
+                      clustered='(SELECT COUNT(*) FROM clustered '
+                                'WHERE source = path) %s ?')
+SELECT_OPERATORS = ['=', '!=', '<', '<=', '>', '>=', 'LIKE']
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,   -- absolute path
+    name TEXT,               -- file name
+    size INTEGER,            -- file size [bytes]
+    mtime REAL,              -- modification time, files are scanned again when changed
+    kind TEXT,               -- 'raw' (srs_hits) or 'store' (clustered store)
+    hits INTEGER,
+    clusters INTEGER,        -- NULL for raw files
+    time_min INTEGER,        -- first and last srs_timestamp
+    time_max INTEGER,
+    duration REAL,           -- [s]
+    rate REAL,               -- hits per second
+    time_window REAL         -- clustering time window of a store, NULL if unknown
+);
+CREATE TABLE IF NOT EXISTS chips (
+    path TEXT REFERENCES files(path) ON DELETE CASCADE,
+    chip_id INTEGER,
+    hits INTEGER,            -- estimated from samples for large raw files
+    PRIMARY KEY (path, chip_id)
+);
+CREATE TABLE IF NOT EXISTS clustered (
+    source TEXT,             -- raw file clustered into the store
+    store TEXT REFERENCES files(path) ON DELETE CASCADE,
+    time_window REAL,
+    PRIMARY KEY (source, store)
+);
+CREATE INDEX IF NOT EXISTS files_time ON files(time_min, time_max);
+"""
+
+
+# =============================================================================
+# Catalog
+# =============================================================================
+
+
+def open_catalog(path):
+    """
+    Opens (or creates) a catalog, an SQLite database of data files. A
+    catalog with an older schema is emptied, all files are scanned again.
+    """
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA foreign_keys = ON')
+    version, = connection.execute('PRAGMA user_version').fetchone()
+    if version != CATALOG_VERSION:
+        connection.executescript('DROP TABLE IF EXISTS clustered; '
+                                 'DROP TABLE IF EXISTS chips; '
+                                 'DROP TABLE IF EXISTS files;')
+        connection.execute('PRAGMA user_version = %d' % CATALOG_VERSION)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_catalog_path(directory):
+    """
+    Returns the default catalog of a data directory: in the directory if it
+    is writable, else in the home directory of the user, e.g. for read-only
+    DAQ storage.
+    """
+    directory = os.path.abspath(directory)
+    if os.access(directory, os.W_OK):
+        return os.path.join(directory, CATALOG_NAME)
+    return os.path.join(os.path.expanduser('~'), '%s_%s'
+                        % (os.path.basename(directory), CATALOG_NAME))
+
+
+def update_catalog(connection, directory):
+    """
+    Adds the HDF5 files below 'directory' to the catalog. Only new and
+    changed files are scanned, files which no longer exist are removed.
+    Returns the number of scanned files.
+    """
+    file_paths = sorted(os.path.abspath(path) for path in
+                        glob.glob(os.path.join(directory, '**', '*.h5'), recursive=True))
+    known = {path: (size, mtime) for path, size, mtime in
+             connection.execute('SELECT path, size, mtime FROM files')}
+    nbr_scanned = 0
+    for file_path in file_paths:
+        stat = os.stat(file_path)
+        if known.get(file_path) == (stat.st_size, stat.st_mtime):
+            continue
+        try:
+            add_file(connection, file_path)
+            nbr_scanned += 1
+        except (OSError, KeyError) as error:
+            # Not a data file
+            print('[catalog] Skipped %s: %s' % (file_path, error))
+    directory = os.path.join(os.path.abspath(directory), '')
+    for file_path in set(known) - set(file_paths):
+        if file_path.startswith(directory):
+            connection.execute('DELETE FROM files WHERE path = ?', (file_path,))
+    connection.commit()
+    return nbr_scanned
+
+
+def add_file(connection, file_path):
+    """Scans a file and adds it to the catalog, replacing older entries."""
+    info, chip_counts, sources = scan_file(file_path)
+    connection.execute('DELETE FROM files WHERE path = ?', (info['path'],))
+    connection.execute('INSERT INTO files (%s) VALUES (%s)'
+                       % (', '.join(info), ', '.join('?' * len(info))),
+                       list(info.values()))
+    connection.executemany('INSERT INTO chips VALUES (?, ?, ?)',
+                           [(info['path'], chip_id, hits)
+                            for chip_id, hits in chip_counts.items()])
+    connection.executemany('INSERT OR REPLACE INTO clustered VALUES (?, ?, ?)',
+                           [(source, info['path'], info['time_window'])
+                            for source in sources])
+
+
+def scan_file(file_path):
+    """
+    Returns the catalog entry of a raw file or clustered store, its number
+    of hits per chip and, for stores, the raw files clustered into it (see
+    campaign.cluster_to_store). Stores record their hits per chip and time
+    range in attributes, for raw files the first and last timestamps and
+    samples of the chip column are read (see sample_chip_counts). The file
+    is not clustered.
+    """
+    stat = os.stat(file_path)
+    with h5py.File(file_path, 'r') as h5_file:
+        if 'clusters' in h5_file:
+            kind, hits, clusters = 'store', h5_file['events'], h5_file['clusters'].shape[0]
+        else:
+            kind, hits, clusters = 'raw', h5_file['srs_hits'], None
+        # Clustering state, recorded in stores
+        time_window = h5_file.attrs.get('time_window')
+        time_window = float(time_window) if time_window is not None else None
+        sources = [str(source) for source in h5_file.attrs.get('source_files', [])]
+        nbr_hits = hits.shape[0]
+        if 'chip_hits' in h5_file.attrs:
+            chip_counts = np.asarray(h5_file.attrs['chip_hits'])
+        else:
+            chip_counts = sample_chip_counts(hits)
+        if nbr_hits == 0:
+            time_min, time_max = None, None
+        elif 'time_range' in h5_file.attrs:
+            time_min, time_max = [int(time) for time in h5_file.attrs['time_range']]
+        else:
+            # The hits are in time order
+            time_min = int(hits[0, 'srs_timestamp'])
+            time_max = int(hits[-1, 'srs_timestamp'])
+    duration = (time_max - time_min) * 1e-9 if nbr_hits > 0 else 0
+    info = {'path': os.path.abspath(file_path),
+            'name': os.path.basename(file_path),
+            'size': stat.st_size, 'mtime': stat.st_mtime, 'kind': kind,
+            'hits': nbr_hits, 'clusters': clusters,
+            'time_min': time_min, 'time_max': time_max, 'duration': duration,
+            'rate': nbr_hits / duration if duration > 0 else None,
+            'time_window': time_window}
+    return info, {int(chip_id): int(hits) for chip_id, hits
+                  in enumerate(chip_counts) if hits > 0}, sources
+
+
+def sample_chip_counts(hits):
+    """
+    Returns the number of hits per chip of a dataset, estimated from
+    SCAN_SAMPLES blocks of SCAN_SAMPLE_SIZE rows spread over the dataset
+    and scaled to all rows. Chips seen in the samples get at least one hit.
+    """
+    nbr_hits = hits.shape[0]
+    if nbr_hits <= SCAN_SAMPLES * SCAN_SAMPLE_SIZE:
+        starts = range(0, nbr_hits, SCAN_SAMPLE_SIZE)
+    else:
+        starts = np.linspace(0, nbr_hits - SCAN_SAMPLE_SIZE, SCAN_SAMPLES).astype(np.int64)
+    chip_counts = np.zeros(0, dtype=np.int64)
+    nbr_sampled = 0
+    for start in starts:
+        chip_ids = hits[int(start):int(start)+SCAN_SAMPLE_SIZE, 'chip_id'].astype(np.int64)
+        counts = np.bincount(chip_ids)
+        chip_counts = np.pad(chip_counts, (0, max(len(counts) - len(chip_counts), 0)))
+        chip_counts[:len(counts)] += counts
+        nbr_sampled += len(chip_ids)
+    if nbr_sampled == nbr_hits:
+        return chip_counts
+    return np.ceil(chip_counts * (nbr_hits / nbr_sampled)).astype(np.int64)
+
+
+# =============================================================================
+# Queries
+# =============================================================================
+
+
+def select_files(connection, conditions=()):
+    """
+    Returns the paths of the files matching all conditions, in time order.
+    A condition is (column, operator, value) with a column of SELECT_COLUMNS
+    and an operator of SELECT_OPERATORS, the values are passed as query
+    parameters, e.g.
+
+        select_files(connection, [('kind', '=', 'raw'), ('duration', '>', 600)])
+        select_files(connection, [('time_min', '>=', t0), ('time_max', '<=', t1)])
+        select_files(connection, [('chip_id', '=', 5)])
+        select_files(connection, [('kind', '=', 'raw'), ('clustered', '=', 0)])
+
+    Raises ValueError for other columns or operators.
+    """
+    clauses, parameters = ['1'], []
+    for column, operator, value in conditions:
+        if column not in SELECT_COLUMNS:
+            raise ValueError('Unknown column "%s", use one of %s'
+                             % (column, ', '.join(SELECT_COLUMNS)))
+        if operator.upper() not in SELECT_OPERATORS:
+            raise ValueError('Unknown operator "%s", use one of %s'
+                             % (operator, ' '.join(SELECT_OPERATORS)))
+        clauses.append(SELECT_COLUMNS[column] % operator.upper())
+        parameters.append(value)
+    query = ('SELECT path FROM files WHERE %s ORDER BY time_min, path'
+             % ' AND '.join(clauses))
+    return [path for path, in connection.execute(query, parameters)]
+
+
+def parse_conditions(text):
+    """
+    Returns the conditions of select_files from text such as
+    "kind = raw AND duration > 600". Quotes around values are optional,
+    numbers are converted. Raises ValueError for malformed conditions.
+    """
+    conditions = []
+    for condition in re.split(r'\s+AND\s+', text.strip(), flags=re.IGNORECASE):
+        match = re.fullmatch(r'\s*(\w+)\s*(<=|>=|!=|=|<|>|LIKE\b)\s*(.+?)\s*',
+                             condition, flags=re.IGNORECASE)
+        if match is None:
+            raise ValueError('Malformed condition "%s", use column operator '
+                             'value' % condition)
+        column, operator, value = match.groups()
+        value = value.strip('\'"')
+        for convert in [int, float]:
+            try:
+                value = convert(value)
+                break
+            except ValueError:
+                pass
+        conditions.append((column, operator, value))
+    return conditions
+
+
+def order_files(connection, file_paths):
+    """
+    Returns the files in time order, for appending. Files which are not in
+    the catalog are scanned and added first.
+    """
+    paths = [os.path.abspath(file_path) for file_path in file_paths]
+    for file_path in paths:
+        if get_file_info(connection, file_path) is None:
+            add_file(connection, file_path)
+    connection.commit()
+    time_min = {path: get_file_info(connection, path)['time_min'] for path in paths}
+    order = sorted(range(len(paths)), key=lambda i: (time_min[paths[i]] is None,
+                                                     time_min[paths[i]] or 0,
+                                                     paths[i]))
+    return [file_paths[i] for i in order]
+
+
+def get_file_info(connection, file_path):
+    """
+    Returns the catalog entry of a file as a dictionary, or None. 'chips'
+    holds the hits per chip, 'clustered' the stores the file was clustered
+    into, with their time windows.
+    """
+    cursor = connection.execute('SELECT * FROM files WHERE path = ?',
+                                (os.path.abspath(file_path),))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    info = dict(zip([column[0] for column in cursor.description], row))
+    info['chips'] = dict(connection.execute('SELECT chip_id, hits FROM chips '
+                                            'WHERE path = ?', (info['path'],)))
+    info['clustered'] = dict(connection.execute('SELECT store, time_window FROM '
+                                                'clustered WHERE source = ?',
+                                                (info['path'],)))
+    return info
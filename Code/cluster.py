@@ -1,16 +1,48 @@
 import os
+import zlib
+import functools
 import pandas as pd
-import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
 import numpy as np
-import struct
-import re
-import zipfile
-import shutil
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 with warnings.catch_warnings():
     warnings.filterwarnings("ignore", category=FutureWarning)
     import h5py
+try:
+    import numba
+except ImportError:
+    numba = None
+
+from memory import check_memory_budget
+from filters import get_filter_state, NBR_THREADS
+
+# Use the Numba-compiled clustering kernel when Numba is installed. Can be
+# switched off at runtime to use the pure Python loop.
+USE_JIT = numba is not None
+# Last mapping and its integer array (see get_channel_map), replaced as a
+# whole so threads never see a mapping with the array of another
+channel_map_cache = [(None, None)]
+# Largest multiplicity in the distributions of the time window sweep
+MAX_MULTIPLICITY = 32
+# Number of MG wire and grid channels, for the per-channel statistics
+NBR_WIRES = 80
+NBR_GRIDS = 12
+# Default factor over the median hit count above which a channel is hot
+HOT_CHANNEL_FACTOR = 10
+# Fields of 'srs_hits' used by clustering and the plots, and the hit
+# filters which can be applied while reading (see read_hits)
+HIT_FIELDS = ['srs_timestamp', 'chiptime', 'chip_id', 'channel', 'adc']
+READ_PARAMETERS = ['chip_id', 'channel', 'adc', 'srs_timestamp']
+# Rows of 'srs_hits' read at a time when filtering while reading, and hits
+# calibrated at a time
+READ_BLOCK_SIZE = 1000000
+# Gain calibration: smallest table shape (chip_id x VMM channel, as the
+# channel mapping), and the PHS peak search of fit_gains: ADC below which
+# the peak is not searched, ADC bin width and the hits needed per channel
+CALIBRATION_SHAPE = (6, 80)
+PEAK_ADC_MIN = 100
+PEAK_BIN_WIDTH = 8
+PEAK_MIN_COUNTS = 100
 
 
 # =============================================================================
@@ -20,22 +52,339 @@ with warnings.catch_warnings():
 
 def import_data(file_path, window):
     h5_file = h5py.File(file_path, 'r')
+    check_memory_budget('Clustering of %s' % os.path.basename(file_path),
+                        get_clustering_size(h5_file['srs_hits'], window))
     if window.sample_button.isChecked():
         data = pd.DataFrame(h5_file['srs_hits'].value[0:20])
+    elif window.filter_on_read:
+        data = read_hits(h5_file['srs_hits'], get_read_state(window))
     else:
-        data = pd.DataFrame(h5_file['srs_hits'].value)
+        data = read_srs_hits(h5_file['srs_hits'])
     return data
 
+
+def read_srs_hits(srs_hits, start=0, stop=None, nbr_threads=None):
+    """Reads the rows 'start' to 'stop' of 'srs_hits' (see read_columns)."""
+    return pd.DataFrame(read_columns(srs_hits, start, stop, nbr_threads=nbr_threads),
+                        copy=False)
+
+
+def read_columns(srs_hits, start=0, stop=None, fields=None, nbr_threads=None):
+    """
+    Reads the rows 'start' to 'stop' of 'srs_hits' into a dictionary of
+    column arrays. For chunked datasets with gzip (and shuffle) compression,
+    the raw chunks are fetched through h5py, which serializes all calls, and
+    decompressed on 'nbr_threads' threads (zlib releases the GIL), directly
+    into the preallocated columns. Other layouts are read by h5py.
+    """
+    stop = srs_hits.shape[0] if stop is None else min(stop, srs_hits.shape[0])
+    start = min(start, stop)
+    dtype = srs_hits.dtype
+    fields = dtype.names if fields is None else fields
+    filters = get_chunk_filters(srs_hits)
+    if filters is None:
+        records = srs_hits[start:stop]
+        return {field: records[field] for field in fields}
+    columns = {field: np.empty(stop - start, dtype=dtype[field]) for field in fields}
+    chunk_rows = srs_hits.chunks[0]
+
+    def read_chunk(chunk_start):
+        lo, hi = max(start, chunk_start), min(stop, chunk_start + chunk_rows)
+        filter_mask, data = srs_hits.id.read_direct_chunk((chunk_start,))
+        # Filters are undone in reverse order, skipped ones are flagged
+        for i in reversed(range(len(filters))):
+            if filter_mask & (1 << i):
+                continue
+            if filters[i] == h5py.h5z.FILTER_DEFLATE:
+                data = zlib.decompress(data)
+            else:
+                data = np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1).T.tobytes()
+        records = np.frombuffer(data, dtype=dtype)
+        for field in fields:
+            columns[field][lo-start:hi-start] = records[field][lo-chunk_start:hi-chunk_start]
+
+    first_chunk = start // chunk_rows * chunk_rows
+    with ThreadPoolExecutor(nbr_threads or NBR_THREADS) as executor:
+        list(executor.map(read_chunk, range(first_chunk, stop, chunk_rows)))
+    return columns
+
+
+def get_chunk_filters(dataset):
+    """
+    Returns the filter pipeline of a 1D chunked dataset if its chunks can be
+    decoded by read_columns, i.e. it only uses gzip and shuffle and all
+    chunks are written, else None.
+    """
+    if dataset.chunks is None or len(dataset.chunks) != 1:
+        return None
+    plist = dataset.id.get_create_plist()
+    filters = [plist.get_filter(i)[0] for i in range(plist.get_nfilters())]
+    supported = {h5py.h5z.FILTER_DEFLATE, h5py.h5z.FILTER_SHUFFLE}
+    nbr_chunks = -(-dataset.shape[0] // dataset.chunks[0])
+    if (not set(filters) <= supported
+            or dataset.id.get_type().get_size() != dataset.dtype.itemsize
+            or dataset.id.get_num_chunks() != nbr_chunks):
+        return None
+    return filters
+
+
+def get_read_state(window):
+    """
+    Returns the filter state applied by read_hits. The ADC filter is meant
+    for calibrated ADC (see calibrate_adc), so it is left to filter_events
+    when a gain calibration is set.
+    """
+    state = get_filter_state(window)
+    if window.calibration is not None:
+        state['adc'] = state['adc'][:2] + [False]
+    return state
+
+
+def read_hits(srs_hits, state, start=0, stop=None):
+    """
+    Reads the rows 'start' to 'stop' of 'srs_hits' block by block, keeping
+    only the fields in HIT_FIELDS and the hits passing the chip, channel, ADC
+    and time filters in 'state' (see get_filter_state), before the DataFrame
+    is built. Prints the fraction of hits kept.
+    """
+    stop = srs_hits.shape[0] if stop is None else min(stop, srs_hits.shape[0])
+    fields = [field for field in srs_hits.dtype.names if field in HIT_FIELDS]
+    blocks = {field: [] for field in fields}
+    for block_start in range(start, stop, READ_BLOCK_SIZE):
+        block_stop = min(block_start + READ_BLOCK_SIZE, stop)
+        hits = read_columns(srs_hits, block_start, block_stop, fields)
+        mask = np.ones(block_stop - block_start, dtype=bool)
+        for par in READ_PARAMETERS:
+            min_val, max_val, filter_on = state[par]
+            if filter_on:
+                mask &= (hits[par] >= min_val) & (hits[par] <= max_val)
+        for field in fields:
+            blocks[field].append(hits[field] if mask.all() else hits[field][mask])
+    hits = {field: (np.concatenate(blocks[field]) if blocks[field]
+                    else np.zeros(0, dtype=srs_hits.dtype[field]))
+            for field in fields}
+    nbr_kept = len(hits[fields[0]])
+    print('[read] kept %d of %d hits (%.1f %%)'
+          % (nbr_kept, stop - start, 100 * nbr_kept / max(stop - start, 1)))
+    return pd.DataFrame(hits, copy=False)
+
+# =============================================================================
+# CHANNEL MASK
+# =============================================================================
+
+
+def mask_channels(data, window, hot_channels=None):
+    """
+    Drops the hits of masked channels before clustering: the channels in
+    'window.masked_channels', as (chip_id, channel), the pulse channel
+    'window.pulse_channel' (see tof.read_pulse_times) and, if
+    'window.hot_channel_factor' is set, all channels with more hits than
+    that factor times the median of the channels with hits. Hot channels
+    found before (see detect_hot_channels) can be given in 'hot_channels',
+    so all chunks of a run drop the same channels. Prints the number of
+    hits removed per channel.
+    """
+    if data.shape[0] == 0:
+        return data
+    counts, flat_index = get_channel_counts(data)
+    shape = counts.shape
+    masked = np.zeros(shape, dtype=bool)
+    masked_channels = list(window.masked_channels)
+    if window.pulse_channel is not None:
+        masked_channels.append(window.pulse_channel)
+    for chip_id, channel in masked_channels:
+        if chip_id < shape[0] and channel < shape[1]:
+            masked[chip_id, channel] = True
+    if hot_channels is not None:
+        rows, columns = (min(shape[0], hot_channels.shape[0]),
+                         min(shape[1], hot_channels.shape[1]))
+        masked[:rows, :columns] |= hot_channels[:rows, :columns]
+    elif window.hot_channel_factor is not None:
+        masked |= find_hot_channels(counts, window.hot_channel_factor)
+    if not (masked & (counts > 0)).any():
+        return data
+    for chip_id, channel in zip(*np.nonzero(masked & (counts > 0))):
+        print('[mask] chip %d, channel %d: removed %d hits (%.1f %%)'
+              % (chip_id, channel, counts[chip_id, channel],
+                 100 * counts[chip_id, channel] / data.shape[0]))
+    keep = ~masked.ravel()[flat_index]
+    print('[mask] removed %d of %d hits' % (data.shape[0] - keep.sum(), data.shape[0]))
+    return data[keep].reset_index(drop=True)
+
+
+def detect_hot_channels(data, window):
+    """
+    Returns the mask of hot channels in 'data', e.g. the first chunk of a
+    run, to be reused by mask_channels for the rest of the run. None if
+    hot channels are not masked or there are no hits.
+    """
+    if window.hot_channel_factor is None or data.shape[0] == 0:
+        return None
+    return find_hot_channels(get_channel_counts(data)[0], window.hot_channel_factor)
+
+
+def get_channel_counts(data):
+    """
+    Returns the hits per (chip_id, channel), one bincount, and the flat
+    index of the channel of each hit.
+    """
+    chip_ids = data['chip_id'].values.astype(np.int64)
+    channels = data['channel'].values.astype(np.int64)
+    shape = (int(chip_ids.max()) + 1, int(channels.max()) + 1)
+    flat_index = chip_ids * shape[1] + channels
+    counts = np.bincount(flat_index, minlength=shape[0]*shape[1]).reshape(shape)
+    return counts, flat_index
+
+
+def find_hot_channels(counts, factor):
+    """
+    Returns a mask of the channels with more than 'factor' times the median
+    number of hits of the channels with hits.
+    """
+    active = counts > 0
+    if not active.any():
+        return np.zeros(counts.shape, dtype=bool)
+    return counts > factor * np.median(counts[active])
+
+
+# =============================================================================
+# CALIBRATION
+# =============================================================================
+
+
+def load_calibration(path):
+    """
+    Reads a gain calibration table with the columns chip_id, channel, gain
+    and offset (CSV, or Excel as the mapping tables), as written by
+    fit_gains, and compiles it into 'gain' and 'offset' arrays indexed by
+    [chip_id, channel]. Channels not in the table get gain 1 and offset 0.
+    """
+    if path.endswith('.xlsx'):
+        table = pd.read_excel(path)
+    else:
+        table = pd.read_csv(path)
+    chip_ids = table['chip_id'].values.astype(np.int64)
+    channels = table['channel'].values.astype(np.int64)
+    shape = (max(int(chip_ids.max()) + 1, CALIBRATION_SHAPE[0]),
+             max(int(channels.max()) + 1, CALIBRATION_SHAPE[1]))
+    calibration = {'gain': np.ones(shape), 'offset': np.zeros(shape)}
+    calibration['gain'][chip_ids, channels] = table['gain'].values
+    calibration['offset'][chip_ids, channels] = table['offset'].values
+    return calibration
+
+
+def calibrate_adc(data, window):
+    """
+    Applies the gain calibration in 'window.calibration' (see
+    load_calibration, None is off) to the 'adc' column of the hits before
+    clustering, block by block,
+
+        adc = gain[chip_id, channel] * adc + offset[chip_id, channel]
+
+    rounded and kept in the type of the column. The column is replaced in
+    place.
+    """
+    if window.calibration is None or data.shape[0] == 0:
+        return data
+    chip_ids = data['chip_id'].values
+    channels = data['channel'].values
+    adc = data['adc'].values
+    # Hits outside of the table are not calibrated
+    shape = (max(int(chip_ids.max()) + 1, window.calibration['gain'].shape[0]),
+             max(int(channels.max()) + 1, window.calibration['gain'].shape[1]))
+    gain = np.ones(shape)
+    offset = np.zeros(shape)
+    table_shape = window.calibration['gain'].shape
+    gain[:table_shape[0], :table_shape[1]] = window.calibration['gain']
+    offset[:table_shape[0], :table_shape[1]] = window.calibration['offset']
+    gain, offset = gain.ravel(), offset.ravel()
+    adc_max = np.iinfo(adc.dtype).max
+    calibrated = np.empty_like(adc)
+    for start in range(0, adc.shape[0], READ_BLOCK_SIZE):
+        block = slice(start, start + READ_BLOCK_SIZE)
+        index = get_int64(chip_ids[block]) * shape[1] + get_int64(channels[block])
+        values = gain[index] * adc[block] + offset[index]
+        calibrated[block] = np.clip(np.rint(values, out=values), 0, adc_max, out=values)
+    data['adc'] = calibrated
+    return data
+
+
+def fit_gains(hits, adc_min=PEAK_ADC_MIN, bin_width=PEAK_BIN_WIDTH,
+              min_counts=PEAK_MIN_COUNTS):
+    """
+    Derives a gain calibration from uncalibrated hits: the PHS of every
+    (chip_id, channel) is histogrammed in one pass, its peak above 'adc_min'
+    (below the saturated last bin) is located to a fraction of a bin by a
+    parabola through the highest bin and its neighbours, and the gain
+    scales the peak to the median peak of all channels. Channels with fewer than 'min_counts' hits get gain 1.
+    Returns a table with the columns chip_id, channel, gain, offset, peak
+    and counts, which load_calibration reads (e.g. after 'to_csv').
+    """
+    from filters import histogram_2d
+    chip_ids = get_int64(hits['chip_id'].values)
+    channels = get_int64(hits['channel'].values)
+    adc = hits['adc'].values
+    nbr_channels = int(channels.max()) + 1
+    nbr_flat = (int(chip_ids.max()) + 1) * nbr_channels
+    nbr_bins = int(adc.max()) // bin_width + 1
+    H = histogram_2d(chip_ids * nbr_channels + channels, adc, [nbr_flat, nbr_bins],
+                     [[-0.5, nbr_flat - 0.5], [0, nbr_bins * bin_width]])
+    counts = H.sum(axis=1)
+    # Highest bin above adc_min, refined with its neighbours. The last bin
+    # holds the saturated hits and is not searched.
+    last_bin = max(nbr_bins - 1, 1)
+    first_bin = min(adc_min // bin_width, last_bin - 1)
+    peak_bin = np.argmax(H[:, first_bin:last_bin], axis=1) + first_bin
+    rows = np.arange(nbr_flat)
+    left = H[rows, np.maximum(peak_bin - 1, 0)].astype(float)
+    center = H[rows, peak_bin].astype(float)
+    right = H[rows, np.minimum(peak_bin + 1, nbr_bins - 1)].astype(float)
+    curvature = left - 2 * center + right
+    shift = np.divide(left - right, 2 * curvature, out=np.zeros(nbr_flat),
+                      where=curvature < 0)
+    peak = (peak_bin + 0.5 + np.clip(shift, -0.5, 0.5)) * bin_width
+    fitted = (counts >= min_counts) & (center > 0)
+    reference = np.median(peak[fitted]) if fitted.any() else 1
+    gain = np.where(fitted, reference / peak, 1.0)
+    table = pd.DataFrame({'chip_id': rows // nbr_channels,
+                          'channel': rows % nbr_channels,
+                          'gain': gain, 'offset': 0.0,
+                          'peak': np.where(fitted, peak, np.nan),
+                          'counts': counts})
+    return table[counts > 0].reset_index(drop=True)
+
+
 # =============================================================================
 # CLUSTER DATA
 # =============================================================================
 
 
-def cluster_data(df_raw, window, file_nbr, file_nbrs):
+def cluster_data(df_raw, window, file_nbr, file_nbrs, session=None):
+    """
+    Clusters the hits of one file. Without a session, the unfinished last
+    cluster of the file is dropped. With a session (see
+    new_clustering_session), the hits of the unfinished cluster are carried
+    over to the next file, and the last cluster is closed when
+    file_nbr == file_nbrs.
+    """
     # Inititate parameters
     time_window = float(window.time_window.text())  # [TDC Channels]
+    close_last = session is not None and file_nbr == file_nbrs
+    # Continue the open cluster from the previous file
+    if session is not None and session['open_hits'] is not None:
+        df_raw = pd.concat([session['open_hits'], df_raw], ignore_index=True)
+        session['open_hits'] = None
     # Initate data vectors
     size = df_raw.shape[0]
+    if size == 0:
+        # No hits, e.g. all removed by the read filters or the channel mask
+        empty = np.zeros([0], dtype=int)
+        df_clustered = pd.DataFrame({key: empty for key in
+                                     ['wCh', 'gCh', 'wM', 'gM', 'wADC', 'gADC',
+                                      'Time', 'HitStart', 'HitStop']})
+        df_raw = df_raw.assign(**{key: empty for key in
+                                  ['wCh', 'gCh', 'gM', 'wM', 'ClusterID']})
+        return df_clustered, df_raw
     wMraw = np.zeros([size], dtype=int)
     gMraw = np.zeros([size], dtype=int)
     data_dict = {'wCh': np.zeros([size], dtype=int),
@@ -44,12 +393,74 @@ def cluster_data(df_raw, window, file_nbr, file_nbrs):
                  'gM': np.zeros([size], dtype=int),
                  'wADC': np.zeros([size], dtype=int),
                  'gADC': np.zeros([size], dtype=int),
-                 'Time': np.zeros([size], dtype=int)
+                 'Time': np.zeros([size], dtype=int),
+                 'HitStart': np.zeros([size], dtype=int)
                  }
     MG_channels = {'wCh': np.zeros([size], dtype=int),
                    'gCh': np.zeros([size], dtype=int)}
     # Get mappings
     VMM_ch_to_MG24_ch = get_VMM_to_MG24_mapping()
+    # Cluster, with the compiled kernel if Numba is available
+    if USE_JIT:
+        Chs = get_int64(df_raw['channel'].values)
+        chip_ids = get_int64(df_raw['chip_id'].values)
+        channel_map = get_channel_map(VMM_ch_to_MG24_ch)
+        check_hits(chip_ids, Chs, channel_map)
+        index, clusterStartIndex = cluster_kernel(
+            Chs, get_int64(df_raw['adc'].values), chip_ids,
+            get_times(df_raw), channel_map, time_window,
+            data_dict['wCh'], data_dict['gCh'], data_dict['wM'],
+            data_dict['gM'], data_dict['wADC'], data_dict['gADC'],
+            data_dict['Time'], data_dict['HitStart'],
+            MG_channels['wCh'], MG_channels['gCh'], gMraw, wMraw)
+    else:
+        index, clusterStartIndex = cluster_loop(df_raw, time_window,
+                                                VMM_ch_to_MG24_ch, data_dict,
+                                                MG_channels, gMraw, wMraw)
+
+    if close_last:
+        # End of the run, keep the last cluster
+        gMraw[clusterStartIndex:] = data_dict['gM'][index]
+        wMraw[clusterStartIndex:] = data_dict['wM'][index]
+        index += 1
+        clusterStartIndex = size
+    elif session is not None:
+        # Carry the hits of the open cluster over to the next file
+        session['open_hits'] = df_raw.iloc[clusterStartIndex:].reset_index(drop=True)
+
+    # Cluster-to-hit index (CSR): the hits of cluster k are the rows
+    # HitStart[k] to HitStop[k], the hits of the unfinished last cluster
+    # get ClusterID -1
+    hit_start = data_dict['HitStart'][0:index]
+    hit_stop = np.append(hit_start[1:], clusterStartIndex)[0:index]
+    data_dict['HitStop'] = hit_stop
+    cluster_ids = np.full([size], -1, dtype=int)
+    cluster_ids[:clusterStartIndex] = np.repeat(np.arange(index),
+                                                hit_stop - hit_start)
+    #Remove empty elements and save in DataFrame for easier analysis
+    for key in data_dict.keys():
+        data_dict[key] = data_dict[key][0:index]
+    df_clustered = pd.DataFrame(data_dict)
+    # Events: the raw columns and the MG channels, multiplicities and
+    # cluster IDs, assembled once without copying the columns
+    columns = {column: df_raw[column].values for column in df_raw.columns}
+    columns.update({'wCh': MG_channels['wCh'], 'gCh': MG_channels['gCh'],
+                    'gM': gMraw, 'wM': wMraw, 'ClusterID': cluster_ids})
+    df_raw = pd.DataFrame(columns, index=df_raw.index, copy=False)
+    if session is not None:
+        # The carried hits are returned with the next file instead
+        df_raw = df_raw.iloc[:clusterStartIndex]
+        update_channel_stats(session['channel_stats'], df_raw)
+    return df_clustered, df_raw
+
+
+def cluster_loop(df_raw, time_window, VMM_ch_to_MG24_ch, data_dict,
+                 MG_channels, gMraw, wMraw):
+    """
+    Clustering loop in pure Python, used when Numba is not available. Fills
+    the vectors in place and returns the index of the open cluster and the
+    index of its first hit.
+    """
     chip_id_to_wire_or_grid = {2: ['gCh', 'gM', 'gADC', 'gMAX'],
                                3: ['wCh', 'wM', 'wADC', 'wMAX'],
                                4: ['wCh', 'wM', 'wADC', 'wMAX'],
@@ -71,19 +482,21 @@ def cluster_data(df_raw, window, file_nbr, file_nbrs):
     data_dict['Time'][index] = start_time
     # Modify first cluster
     mgCh = VMM_ch_to_MG24_ch[chip_id][Ch]
+    if mgCh is None:
+        mgCh = -10
     xCh, xM, xADC, xMAX = chip_id_to_wire_or_grid[chip_id]
     data_dict[xADC][index] += ADC
     data_dict[xM][index] += 1
     if ADC > gw_ADC_max[xMAX]:
         gw_ADC_max[xMAX] = ADC
         data_dict[xCh][index] = mgCh
+    MG_channels['wCh'][0], MG_channels['gCh'][0] = -1, -1
     MG_channels[xCh][0] = mgCh
     # Get numpy arrays from data frame
-    Chs = df_raw['channel'].values[1:].astype(np.int64)
-    ADCs = df_raw['adc'].values[1:].astype(np.int64)
-    chip_ids = df_raw['chip_id'].values[1:].astype(np.int64)
-    Times = (df_raw['srs_timestamp'].values[1:].astype(np.int64)
-             + df_raw['chiptime'].values[1:].astype(np.int64))
+    Chs = get_int64(df_raw['channel'].values)[1:]
+    ADCs = get_int64(df_raw['adc'].values)[1:]
+    chip_ids = get_int64(df_raw['chip_id'].values)[1:]
+    Times = get_times(df_raw)[1:]
     #Times = (df_raw['srs_timestamp'].values[1:].astype(np.int64))
     clusterStartIndex = 0
     # Iterate through data
@@ -106,6 +519,7 @@ def cluster_data(df_raw, window, file_nbr, file_nbrs):
             # Increase cluster index and reset temporary variables
             index += 1
             clusterStartIndex = i+1
+            data_dict['HitStart'][index] = clusterStartIndex
             start_time = Time
             # Start new cluster
             gw_ADC_max['wMAX'], gw_ADC_max['gMAX'] = 0, 0
@@ -120,16 +534,317 @@ def cluster_data(df_raw, window, file_nbr, file_nbrs):
                 data_dict[xCh][index] = mgCh
         # Add MG channel to the raw events
         MG_channels[xCh][i+1] = mgCh
+    return index, clusterStartIndex
 
-    #Remove empty elements and save in DataFrame for easier analysis
-    for key in data_dict.keys():
-        data_dict[key] = data_dict[key][0:index]
-    df_clustered = pd.DataFrame(data_dict)
-    # Append vector to raw dataframe with MG channels
-    df_raw = df_raw.join(pd.DataFrame(MG_channels))
-    df_raw = df_raw.join(pd.DataFrame({'gM': gMraw}))
-    df_raw = df_raw.join(pd.DataFrame({'wM': wMraw}))
-    return df_clustered, df_raw
+
+def cluster_kernel(Chs, ADCs, chip_ids, Times, channel_map, time_window,
+                   wCh, gCh, wM, gM, wADC, gADC, Time, HitStart,
+                   hit_wCh, hit_gCh, gMraw, wMraw):
+    """
+    Same clustering as cluster_loop on plain integer arrays, compiled with
+    Numba. A cluster starts at the first hit outside of the time window of
+    the previous cluster's first hit, and keeps the channel with the
+    largest ADC for wires and grids separately.
+    """
+    index = 0
+    clusterStartIndex = 0
+    start_time = Times[0]
+    wMAX, gMAX = 0, 0
+    wCh[0], gCh[0] = -1, -1
+    Time[0] = start_time
+    for i in range(len(Times)):
+        if i > 0 and (Times[i] - start_time) >= time_window:
+            gMraw[clusterStartIndex:i] = gM[index]
+            wMraw[clusterStartIndex:i] = wM[index]
+            # Start new cluster
+            index += 1
+            clusterStartIndex = i
+            HitStart[index] = i
+            start_time = Times[i]
+            wMAX, gMAX = 0, 0
+            wCh[index], gCh[index] = -1, -1
+            Time[index] = start_time
+        # Modify cluster
+        mgCh = channel_map[chip_ids[i], Chs[i]]
+        ADC = ADCs[i]
+        hit_wCh[i], hit_gCh[i] = -1, -1
+        if chip_ids[i] == 2:
+            gADC[index] += ADC
+            gM[index] += 1
+            if ADC > gMAX:
+                gMAX = ADC
+                gCh[index] = mgCh
+            hit_gCh[i] = mgCh
+        else:
+            wADC[index] += ADC
+            wM[index] += 1
+            if ADC > wMAX:
+                wMAX = ADC
+                wCh[index] = mgCh
+            hit_wCh[i] = mgCh
+    return index, clusterStartIndex
+
+
+if numba is not None:
+    # Without the GIL, so the next chunk can be read while clustering
+    cluster_kernel = numba.njit(cache=True, nogil=True)(cluster_kernel)
+
+
+def check_hits(chip_ids, Chs, channel_map):
+    """
+    The compiled kernel does not check its input, so the first hit it can
+    not cluster raises the error of cluster_loop here instead: IndexError
+    for chips or channels outside the mapping, KeyError for any other chip
+    ID than 2-5.
+    """
+    unknown = ((chip_ids < 2) | (chip_ids > 5)
+               | (Chs < 0) | (Chs >= channel_map.shape[1]))
+    if unknown.any():
+        i = np.argmax(unknown)
+        if chip_ids[i] >= channel_map.shape[0] or not 0 <= Chs[i] < channel_map.shape[1]:
+            raise IndexError('chip %d, channel %d is outside the VMM to MG '
+                             'mapping' % (chip_ids[i], Chs[i]))
+        raise KeyError(int(chip_ids[i]))
+
+
+def new_clustering_session():
+    """
+    Returns a session for clustering the consecutive files of a run as one
+    stream, carrying the hits of the open cluster from one file to the next.
+    """
+    return {'open_hits': None, 'channel_stats': new_channel_stats()}
+
+
+def finish_clustering_session(session, window):
+    """
+    Closes the open cluster of a session when the number of files was not
+    known in advance, e.g. in a pipeline. Returns its clusters and events,
+    or None if there is no open cluster.
+    """
+    if session['open_hits'] is None or session['open_hits'].shape[0] == 0:
+        session['open_hits'] = None
+        return None
+    open_hits = session['open_hits']
+    session['open_hits'] = None
+    return cluster_data(open_hits, window, 1, 1,
+                        {'open_hits': None,
+                         'channel_stats': session['channel_stats']})
+
+# =============================================================================
+# CHANNEL STATISTICS
+# =============================================================================
+
+
+def new_channel_stats():
+    """
+    Returns empty per-channel accumulators for the wires and grids: number
+    of hits, mean and sum of squared deviations (M2) of the ADC, ADC min and
+    max, and the distribution of the multiplicity of the clusters of the
+    hits. Accumulators of different files or chunks can be merged with
+    merge_channel_stats.
+    """
+    stats = {}
+    for typeCh, nbr_channels in [['wCh', NBR_WIRES], ['gCh', NBR_GRIDS]]:
+        stats[typeCh] = {'count': np.zeros(nbr_channels, dtype=np.int64),
+                         'mean': np.zeros(nbr_channels),
+                         'M2': np.zeros(nbr_channels),
+                         'min': np.full(nbr_channels, np.iinfo(np.int64).max),
+                         'max': np.full(nbr_channels, np.iinfo(np.int64).min),
+                         'multiplicity': np.zeros((nbr_channels, MAX_MULTIPLICITY + 1),
+                                                  dtype=np.int64)}
+    return stats
+
+
+def update_channel_stats(stats, events):
+    """
+    Adds the hits of an events table to the accumulators, in place. The
+    statistics of the table are computed per channel in one pass of
+    bincounts and merged as in Welford's algorithm (see merge_channel_stats).
+    """
+    adc = get_int64(events['adc'].values)
+    clustered = events['ClusterID'].values >= 0
+    for typeCh, typeM in [['wCh', 'wM'], ['gCh', 'gM']]:
+        nbr_channels = stats[typeCh]['count'].shape[0]
+        channels = get_int64(events[typeCh].values)
+        mask = (channels >= 0) & (channels < nbr_channels)
+        channels, values = channels[mask], adc[mask]
+        count = np.bincount(channels, minlength=nbr_channels)
+        mean = np.bincount(channels, values, minlength=nbr_channels) / np.maximum(count, 1)
+        M2 = np.bincount(channels, (values - mean[channels]) ** 2, minlength=nbr_channels)
+        minimum = np.full(nbr_channels, np.iinfo(np.int64).max)
+        maximum = np.full(nbr_channels, np.iinfo(np.int64).min)
+        np.minimum.at(minimum, channels, values)
+        np.maximum.at(maximum, channels, values)
+        # Hits of the unfinished last cluster have no multiplicity yet
+        in_cluster = clustered[mask]
+        multiplicities = np.minimum(get_int64(events[typeM].values)[mask][in_cluster],
+                                    MAX_MULTIPLICITY)
+        multiplicity = np.bincount(channels[in_cluster] * (MAX_MULTIPLICITY + 1)
+                                   + multiplicities,
+                                   minlength=nbr_channels * (MAX_MULTIPLICITY + 1))
+        merge_channel_stats(stats, {typeCh: {
+            'count': count, 'mean': mean, 'M2': M2, 'min': minimum, 'max': maximum,
+            'multiplicity': multiplicity.reshape(nbr_channels, MAX_MULTIPLICITY + 1)}})
+    return stats
+
+
+def merge_channel_stats(stats, other):
+    """
+    Adds the accumulators in 'other' to 'stats', in place. Means and M2 are
+    combined with the parallel form of Welford's algorithm (Chan et al.).
+    """
+    for typeCh, values in other.items():
+        acc = stats[typeCh]
+        count = acc['count'] + values['count']
+        delta = values['mean'] - acc['mean']
+        weight = values['count'] / np.maximum(count, 1)
+        acc['M2'] += values['M2'] + delta ** 2 * acc['count'] * weight
+        acc['mean'] += delta * weight
+        acc['count'] = count
+        acc['min'] = np.minimum(acc['min'], values['min'])
+        acc['max'] = np.maximum(acc['max'], values['max'])
+        acc['multiplicity'] += values['multiplicity']
+    return stats
+
+
+def channel_stats_table(stats):
+    """
+    Returns the accumulators as a summary table, one row per wire and grid
+    channel: hits, ADC mean, standard deviation, min and max, and the mean
+    multiplicity of the clusters of the hits. The events are the same for
+    both detectors, so they share the accumulators.
+    """
+    rows = []
+    for typeCh in ['wCh', 'gCh']:
+        acc = stats[typeCh]
+        count = acc['count']
+        multiplicity = acc['multiplicity']
+        rows.append(pd.DataFrame({
+            'type': typeCh,
+            'channel': np.arange(count.shape[0]),
+            'count': count,
+            'mean': np.where(count > 0, acc['mean'], np.nan),
+            'std': np.where(count > 1, np.sqrt(acc['M2'] / np.maximum(count - 1, 1)),
+                            np.nan),
+            'min': np.where(count > 0, acc['min'], np.nan),
+            'max': np.where(count > 0, acc['max'], np.nan),
+            'mean_multiplicity': ((multiplicity * np.arange(MAX_MULTIPLICITY + 1)).sum(axis=1)
+                                  / np.maximum(multiplicity.sum(axis=1), 1))}))
+    return pd.concat(rows, ignore_index=True)
+
+# =============================================================================
+# Time window sweep
+# =============================================================================
+
+
+def sweep_time_window(times, chip_ids, time_windows, max_multiplicity=MAX_MULTIPLICITY):
+    """
+    Clusters the time-ordered hits with every time window in one pass, as
+    cluster_data would with each window separately (the last cluster is
+    closed). 'times' is srs_timestamp + chiptime. Returns a dictionary
+    with, for each window,
+
+        clusters:     number of clusters
+        coincidences: clusters with both wire and grid hits
+        efficiency:   coincidences / clusters
+        wM, gM:       multiplicity distributions, 0 to 'max_multiplicity'
+                      (the last bin holds all larger multiplicities)
+    """
+    time_windows = np.asarray(time_windows, dtype=np.float64)
+    nbr_windows = len(time_windows)
+    wM_counts = np.zeros((nbr_windows, max_multiplicity + 1), dtype=np.int64)
+    gM_counts = np.zeros((nbr_windows, max_multiplicity + 1), dtype=np.int64)
+    coincidences = np.zeros(nbr_windows, dtype=np.int64)
+    if len(times) > 0:
+        sweep_kernel(np.asarray(times, dtype=np.int64),
+                     np.asarray(chip_ids) == 2, time_windows,
+                     wM_counts, gM_counts, coincidences)
+    clusters = wM_counts.sum(axis=1)
+    return {'time_window': time_windows,
+            'clusters': clusters,
+            'coincidences': coincidences,
+            'efficiency': coincidences / np.maximum(clusters, 1),
+            'wM': wM_counts,
+            'gM': gM_counts}
+
+
+def sweep_kernel(Times, is_grid, time_windows, wM_counts, gM_counts,
+                 coincidences):
+    """
+    Single pass over the hits, keeping the open cluster of every time
+    window: its start time and wire and grid multiplicities. Compiled with
+    Numba when available.
+    """
+    nbr_windows = len(time_windows)
+    max_multiplicity = wM_counts.shape[1] - 1
+    start_time = np.full(nbr_windows, Times[0])
+    wM = np.zeros(nbr_windows, dtype=np.int64)
+    gM = np.zeros(nbr_windows, dtype=np.int64)
+    for i in range(len(Times)):
+        for k in range(nbr_windows):
+            if i > 0 and (Times[i] - start_time[k]) >= time_windows[k]:
+                # Close cluster and start a new one
+                wM_counts[k, min(wM[k], max_multiplicity)] += 1
+                gM_counts[k, min(gM[k], max_multiplicity)] += 1
+                if wM[k] > 0 and gM[k] > 0:
+                    coincidences[k] += 1
+                start_time[k] = Times[i]
+                wM[k], gM[k] = 0, 0
+            if is_grid[i]:
+                gM[k] += 1
+            else:
+                wM[k] += 1
+    # Close the last clusters
+    for k in range(nbr_windows):
+        wM_counts[k, min(wM[k], max_multiplicity)] += 1
+        gM_counts[k, min(gM[k], max_multiplicity)] += 1
+        if wM[k] > 0 and gM[k] > 0:
+            coincidences[k] += 1
+
+
+if numba is not None:
+    sweep_kernel = numba.njit(cache=True)(sweep_kernel)
+
+# =============================================================================
+# Cluster-to-hit index
+# =============================================================================
+
+
+def get_cluster_hits(events, clusters, cluster_id):
+    """Returns the hits of a cluster."""
+    start, stop = clusters[['HitStart', 'HitStop']].values[cluster_id]
+    return events.iloc[start:stop]
+
+
+def get_hit_values(events, clusters, column):
+    """
+    Returns a cluster column propagated to the hits, e.g. the wire
+    multiplicity of the cluster of each hit. Hits outside of any cluster
+    get -1.
+    """
+    cluster_ids = events['ClusterID'].values
+    values = np.append(clusters[column].values, -1)
+    return values[cluster_ids]
+
+
+def get_hit_mask(events, cluster_mask):
+    """
+    Propagates a boolean mask on the clusters (e.g. clusters.wM == 2) to a
+    boolean mask on the hits.
+    """
+    cluster_ids = events['ClusterID'].values
+    return np.append(np.asarray(cluster_mask), False)[cluster_ids]
+
+
+def shift_cluster_index(clusters, events, nbr_clusters, nbr_hits):
+    """
+    Shifts the cluster-to-hit index of a file, to be appended after
+    'nbr_clusters' clusters and 'nbr_hits' hits.
+    """
+    clusters['HitStart'] += nbr_hits
+    clusters['HitStop'] += nbr_hits
+    cluster_ids = events['ClusterID'].values
+    events['ClusterID'] = np.where(cluster_ids >= 0, cluster_ids + nbr_clusters, -1)
 
 # =============================================================================
 # Helper Functions
@@ -150,7 +865,75 @@ def mkdir_p(mypath):
             raise
 
 
+def get_clustering_size(srs_hits, window):
+    """
+    Estimates the peak memory in bytes for importing and clustering the
+    'srs_hits' dataset, without reading it.
+    """
+    nbr_hits = 20 if window.sample_button.isChecked() else srs_hits.shape[0]
+    return nbr_hits * get_bytes_per_hit(srs_hits.dtype)
+
+
+def get_tables_size(file_paths, window):
+    """
+    Estimates the peak memory in bytes for clustering raw files into the
+    tables of the GUI, without reading them: the largest clustering peak,
+    and the events of all files, stored for both detectors.
+    """
+    peak, tables = 0, 0
+    for file_path in file_paths:
+        with h5py.File(file_path, 'r') as h5_file:
+            srs_hits = h5_file['srs_hits']
+            peak = max(peak, get_clustering_size(srs_hits, window))
+            nbr_hits = 20 if window.sample_button.isChecked() else srs_hits.shape[0]
+            # The raw columns, and the MG channels, multiplicities and
+            # cluster IDs as int64
+            tables += 2 * nbr_hits * (srs_hits.dtype.itemsize + 5 * 8)
+    return peak + tables
+
+
+def get_bytes_per_hit(dtype):
+    """Estimates the peak memory per hit in bytes during clustering."""
+    # The raw records are held by h5py and the DataFrame, the events table
+    # shares its columns. On top of that comes 17 int64 columns: cluster
+    # vectors, MG channels, multiplicities, cluster IDs, the times and the
+    # int64 copies of the input (none if the input already is int64).
+    return 2 * dtype.itemsize + 17 * 8
+
+
+def get_int64(values):
+    """Returns the values as int64, without a copy if they already are."""
+    return np.asarray(values, dtype=np.int64)
+
+
+def get_times(df_raw):
+    """Returns srs_timestamp + chiptime as int64, in one allocation."""
+    return np.add(df_raw['srs_timestamp'].values, df_raw['chiptime'].values,
+                  dtype=np.int64, casting='unsafe')
+
+
+def get_channel_map(VMM_ch_to_MG24_ch):
+    """
+    Returns the VMM to MG channel mapping as an integer array, unmapped
+    channels get -10. The array of the last mapping is kept, as clustering
+    calls this once per chunk with the same mapping.
+    """
+    mapping, channel_map = channel_map_cache[0]
+    if mapping is not VMM_ch_to_MG24_ch:
+        channel_map = np.full(VMM_ch_to_MG24_ch.shape, -10, dtype=np.int64)
+        mapped = VMM_ch_to_MG24_ch != None
+        channel_map[mapped] = VMM_ch_to_MG24_ch[mapped].astype(np.int64)
+        channel_map_cache[0] = (VMM_ch_to_MG24_ch, channel_map)
+    return channel_map
+
+
+@functools.lru_cache(maxsize=None)
 def get_VMM_to_MG24_mapping():
+    """
+    Returns the VMM to MG channel mapping, (chip_id, channel) -> MG channel
+    or None. The Excel file is read once per process, the mapping is shared
+    and must not be modified.
+    """
     # Import mapping
     dir_name = os.path.dirname(__file__)
     #path_mapping = os.path.join(dir_name, '../Tables/Latest_Isabelle_MG_to_VMM_Mapping.xlsx')
@@ -0,0 +1,221 @@
+import os
+import shutil
+import urllib.parse
+import numpy as np
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = None
+
+from cluster import new_channel_stats, update_channel_stats
+from filters import EVENT_PARAMETERS, CLUSTER_PARAMETERS, get_filter_state
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Length of a time slice partition in the units of 'Time' and 'srs_timestamp'
+TIME_SLICE = 3600e9
+# Rows per Parquet row group. Each row group stores min/max statistics per
+# column, which are used to skip row groups on reload.
+ROW_GROUP_SIZE = 100000
+# Column holding the time of each table, used for the time slice partitions
+TIME_COLUMNS = {'events': 'srs_timestamp', 'clusters': 'Time'}
+# Row number within the run, written on export to restore the row order on
+# reload. Time does not give the order, e.g. in stores of several files
+# the timestamps restart at each file.
+ROW_COLUMN = 'row'
+PARAMETERS = {'events': EVENT_PARAMETERS, 'clusters': CLUSTER_PARAMETERS}
+
+
+# =============================================================================
+# Export
+# =============================================================================
+
+
+def export_to_parquet(events, clusters, directory, run, time_slice=TIME_SLICE):
+    """
+    Writes the events and clusters tables to a partitioned Parquet dataset,
+
+        'directory'/events/run='run'/time_slice=0/part-0.parquet
+        'directory'/clusters/run='run'/time_slice=0/part-0.parquet
+        ...
+
+    where 'time_slice' is the time divided by 'time_slice'. Exporting a run
+    again replaces its partitions, other runs are kept. The cluster-to-hit
+    index (HitStart, HitStop and ClusterID) is relative to the run, the
+    row number in the run is stored in the column 'row'.
+    """
+    check_pyarrow()
+    for name, table in [['events', events], ['clusters', clusters]]:
+        # Remove all partitions of an earlier export of the run, not only
+        # the time slices written again
+        for run_directory in get_run_directories(os.path.join(directory, name), run):
+            shutil.rmtree(run_directory)
+        if table.shape[0] == 0:
+            continue
+        table = pa.Table.from_pandas(table, preserve_index=False)
+        time = table[TIME_COLUMNS[name]].to_numpy()
+        slices = (time // time_slice).astype(np.int64)
+        table = table.append_column(ROW_COLUMN, pa.array(np.arange(len(time))))
+        table = table.append_column('run', pa.array(np.full(len(time), run)))
+        table = table.append_column('time_slice', pa.array(slices))
+        # The length of the time slices is needed to prune them on reload
+        metadata = table.schema.metadata or {}
+        metadata[b'time_slice'] = repr(float(time_slice)).encode()
+        table = table.replace_schema_metadata(metadata)
+        ds.write_dataset(table, os.path.join(directory, name), format='parquet',
+                         partitioning=get_partitioning(),
+                         max_rows_per_group=ROW_GROUP_SIZE,
+                         min_rows_per_group=ROW_GROUP_SIZE,
+                         existing_data_behavior='delete_matching')
+
+
+# =============================================================================
+# Reload
+# =============================================================================
+
+
+def load_from_parquet(directory, name, state=None, runs=None, columns=None):
+    """
+    Reads the 'events' or 'clusters' of a dataset written by
+    export_to_parquet. The filters in 'state' (see get_filter_state) are
+    pushed down to the reader, only the time slices and row groups which can
+    contain matching rows are read. The result equals filter_events or
+    filter_coincident_events applied to the full table. 'runs' selects runs
+    by name, the run is returned in the column 'run'.
+    """
+    check_pyarrow()
+    dataset = ds.dataset(os.path.join(directory, name), format='parquet',
+                         partitioning=get_partitioning())
+    expression = pc.scalar(True)
+    if state is not None:
+        expression = get_filter_expression(dataset.schema, state, PARAMETERS[name])
+        time_min, time_max, time_filter_on = state[TIME_COLUMNS[name]]
+        if time_filter_on:
+            time_slice = float(dataset.schema.metadata[b'time_slice'])
+            expression &= ((pc.field('time_slice') >= int(np.ceil(time_min) // time_slice))
+                           & (pc.field('time_slice') <= int(np.floor(time_max) // time_slice)))
+    if runs is not None:
+        expression &= pc.field('run').isin(runs)
+    has_rows = ROW_COLUMN in dataset.schema.names
+    if columns is not None and has_rows:
+        columns = list(columns) + [column for column in ['run', ROW_COLUMN]
+                                   if column not in columns]
+    table = dataset.to_table(columns=columns, filter=expression)
+    df = table.to_pandas()
+    if 'run' in df:
+        df['run'] = df['run'].astype(str)
+    # Rows of a run in the order of the exported table. Exports without
+    # row numbers are put in time slice order.
+    sort_by = [column for column in ['run', ROW_COLUMN if has_rows else 'time_slice']
+               if column in df]
+    if sort_by:
+        df.sort_values(sort_by, kind='stable', inplace=True)
+        df.reset_index(drop=True, inplace=True)
+    if has_rows:
+        df.drop(columns=[ROW_COLUMN], inplace=True)
+    return df
+
+
+def load_window_from_parquet(directory, window, runs=None):
+    """
+    Reloads events and clusters with the current filters into the window,
+    replacing the loaded data. Without filters the cluster-to-hit index is
+    shifted to the loaded tables. With filters the rows it points at may
+    not be loaded, so HitStart, HitStop and ClusterID are dropped.
+    """
+    state = get_filter_state(window)
+    tables = {name: load_from_parquet(directory, name, state, runs)
+              for name in ['events', 'clusters']}
+    channel_stats = update_channel_stats(new_channel_stats(), tables['events'])
+    if any(filter_on for min_val, max_val, filter_on in state.values()):
+        tables['events'].drop(columns=['ClusterID'], inplace=True)
+        tables['clusters'].drop(columns=['HitStart', 'HitStop'], inplace=True)
+    else:
+        shift_run_index(tables['clusters'], tables['events'])
+    for name in ['events', 'clusters']:
+        tables[name] = tables[name].drop(columns=['run', 'time_slice'])
+    window.Events_20_layers = tables['events']
+    window.Events_16_layers = tables['events']
+    window.Clusters_20_layers = tables['clusters']
+    window.Clusters_16_layers = tables['clusters']
+    window.channel_stats = channel_stats
+    window.data_version += 1
+
+
+# =============================================================================
+# Helper Functions
+# =============================================================================
+
+
+def check_pyarrow():
+    if pa is None:
+        raise ImportError('Parquet export requires pyarrow, '
+                          'install it with "pip install pyarrow"')
+
+
+def get_partitioning():
+    return ds.partitioning(pa.schema([('run', pa.string()),
+                                      ('time_slice', pa.int64())]),
+                           flavor='hive')
+
+
+def get_run_directories(directory, run):
+    """Returns the partition directories of a run, 'directory'/run='run'."""
+    if not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, entry) for entry in os.listdir(directory)
+            if entry.startswith('run=')
+            and urllib.parse.unquote(entry[len('run='):]) == str(run)]
+
+
+def shift_run_index(clusters, events):
+    """
+    Shifts the cluster-to-hit index, relative to each run, to the tables of
+    all loaded runs, in place. The rows of each run are contiguous.
+    """
+    event_runs = events['run'].values
+    cluster_runs = clusters['run'].values
+    nbr_hits, nbr_clusters = 0, 0
+    for run in np.unique(np.concatenate([event_runs, cluster_runs])):
+        run_events = event_runs == run
+        run_clusters = cluster_runs == run
+        clusters.loc[run_clusters, 'HitStart'] += nbr_hits
+        clusters.loc[run_clusters, 'HitStop'] += nbr_hits
+        cluster_ids = events['ClusterID'].values
+        events['ClusterID'] = np.where(run_events & (cluster_ids >= 0),
+                                       cluster_ids + nbr_clusters, cluster_ids)
+        nbr_hits += np.count_nonzero(run_events)
+        nbr_clusters += np.count_nonzero(run_clusters)
+
+
+def get_filter_expression(schema, state, parameters):
+    """
+    Returns the dataset expression equal to get_parameter_mask and
+    get_channel_mask. The limits are converted to the type of the column,
+    as the row group statistics are only used when the types match.
+    """
+    expression = pc.scalar(True)
+    for par in parameters:
+        min_val, max_val, filter_on = state[par]
+        if filter_on:
+            expression &= get_range_expression(schema, par, min_val, max_val)
+    wCh_min, wCh_max, wCh_filter_on = state['wCh']
+    gCh_min, gCh_max, gCh_filter_on = state['gCh']
+    if wCh_filter_on or gCh_filter_on:
+        if not wCh_filter_on:
+            wCh_min, wCh_max = 0, 79
+        if not gCh_filter_on:
+            gCh_min, gCh_max = 0, 12
+        expression &= (get_range_expression(schema, 'wCh', wCh_min, wCh_max)
+                       | get_range_expression(schema, 'gCh', gCh_min, gCh_max))
+    return expression
+
+
+def get_range_expression(schema, column, min_val, max_val):
+    if pa.types.is_integer(schema.field(column).type):
+        min_val, max_val = int(np.ceil(min_val)), int(np.floor(max_val))
+    return (pc.field(column) >= min_val) & (pc.field(column) <= max_val)
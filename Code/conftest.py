@@ -0,0 +1,89 @@
+import numpy as np
+import pandas as pd
+import pytest
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+import cluster
+
+# Filter widgets of the GUI, as (name, minimum, maximum)
+FILTERS = [('ADC', 0, 1024), ('channel', 0, 79), ('chip', 2, 5), ('time', 0, 1e18),
+           ('wADC', 0, 1e5), ('gADC', 0, 1e5), ('wM', 0, 80), ('gM', 0, 12),
+           ('wCh', 0, 79), ('gCh', 0, 11)]
+
+
+class Widget:
+    """A spin box, line edit or check box of the GUI holding 'value'."""
+    def __init__(self, value):
+        self._value = value
+
+    def value(self):
+        return self._value
+
+    def text(self):
+        return str(self._value)
+
+    def isChecked(self):
+        return bool(self._value)
+
+
+class Window:
+    """
+    The clustering settings and filters, in place of the widgets of the
+    GUI. Filters given as name=(min, max), e.g. ADC=(100, 900), are on.
+    """
+    def __init__(self, time_window=4e3, **filters):
+        self.time_window = Widget(time_window)
+        self.phsBins = Widget(50)
+        self.sample_button = Widget(False)
+        self.masked_channels = []
+        self.hot_channel_factor = None
+        self.pulse_channel = None
+        self.filter_on_read = False
+        self.calibration = None
+        for name, min_val, max_val in FILTERS:
+            min_val, max_val = filters.get(name, (min_val, max_val))
+            setattr(self, name + '_min', Widget(min_val))
+            setattr(self, name + '_max', Widget(max_val))
+            check_box = 'timestamp_filter' if name == 'time' else name + '_filter'
+            setattr(self, check_box, Widget(name in filters))
+
+
+def get_mapping():
+    """Stub VMM to MG mapping: grids on chip 2, wires on chips 3-5."""
+    mapping = np.empty((6, 80), dtype='object')
+    for chip_id in range(2, 6):
+        for channel in range(10, 70):
+            if chip_id == 2:
+                mapping[chip_id][channel] = (channel - 10) % 12
+            else:
+                mapping[chip_id][channel] = (channel - 10) % 20 + 20 * (chip_id - 3)
+    return mapping
+
+
+def get_hits(size, seed=0):
+    """Random hits in time order, as in the 'srs_hits' of a raw file."""
+    random = np.random.default_rng(seed)
+    return pd.DataFrame({'srs_timestamp': np.sort(random.integers(0, size * 2000, size)),
+                         'chiptime': random.integers(0, 50, size),
+                         'chip_id': random.integers(2, 6, size),
+                         'channel': random.integers(0, 80, size),
+                         'adc': random.integers(0, 1024, size)})
+
+
+def write_raw_file(path, hits, **options):
+    """Writes hits as a raw file, 'options' are passed to create_dataset."""
+    options = dict({'chunks': (1000,), 'compression': 'gzip', 'shuffle': True},
+                   **options)
+    with h5py.File(path, 'w') as h5_file:
+        h5_file.create_dataset('srs_hits', data=hits.to_records(index=False),
+                               **options)
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def stub_mapping(monkeypatch):
+    monkeypatch.setattr(cluster, 'get_VMM_to_MG24_mapping', get_mapping)
+    monkeypatch.setattr(cluster, 'USE_JIT', cluster.USE_JIT)
@@ -0,0 +1,283 @@
+import os
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from memory import track_stage, check_memory_budget, table_nbytes
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Worker threads for the filters and histograms, set with MG_THREADS
+NBR_THREADS = int(os.environ.get('MG_THREADS', os.cpu_count() or 1))
+# Rows per chunk, smaller tables are processed in the calling thread
+CHUNK_SIZE = 1000000
+
+
+# =============================================================================
+# Filter
+# =============================================================================
+
+# Filters on the events (hits) and on the clusters
+EVENT_PARAMETERS = ['adc', 'channel', 'srs_timestamp', 'chip_id']
+CLUSTER_PARAMETERS = ['Time', 'wADC', 'gADC', 'wM', 'gM']
+
+
+def filter_events(events, window):
+    state = get_filter_state(window)
+    check_memory_budget('Event filter', table_nbytes(events))
+    with track_stage('Event filter') as report:
+        mask = get_chunked_mask(get_event_mask, events, state,
+                                EVENT_PARAMETERS + ['wCh', 'gCh'])
+        events_red = events if mask.all() else take_rows(events, mask)
+        report['tables'] = [events_red]
+    print(events_red)
+    return events_red
+
+
+def filter_coincident_events(ce, window):
+    state = get_filter_state(window)
+    check_memory_budget('Cluster filter', table_nbytes(ce))
+    with track_stage('Cluster filter') as report:
+        mask = get_chunked_mask(get_cluster_mask, ce, state,
+                                CLUSTER_PARAMETERS + ['wCh', 'gCh'])
+        ce_red = ce if mask.all() else take_rows(ce, mask)
+        report['tables'] = [ce_red]
+    return ce_red
+
+
+def get_filter_state(window):
+    """
+    Returns a snapshot of all filter widgets as a plain dictionary,
+    parameter -> [min, max, filter_on], which does not depend on the window.
+    """
+    return {'adc': [window.ADC_min.value(),
+                    window.ADC_max.value(),
+                    window.ADC_filter.isChecked()],
+            'channel': [window.channel_min.value(),
+                        window.channel_max.value(),
+                        window.channel_filter.isChecked()],
+            'srs_timestamp': [float(window.time_min.text()),
+                              float(window.time_max.text()),
+                              window.timestamp_filter.isChecked()],
+            'chip_id': [window.chip_min.value(),
+                        window.chip_max.value(),
+                        window.chip_filter.isChecked()],
+            'Time': [float(window.time_min.text()),
+                     float(window.time_max.text()),
+                     window.timestamp_filter.isChecked()],
+            'wADC': [float(window.wADC_min.text()),
+                     float(window.wADC_max.text()),
+                     window.wADC_filter.isChecked()],
+            'gADC': [float(window.gADC_min.text()),
+                     float(window.gADC_max.text()),
+                     window.gADC_filter.isChecked()],
+            'wM': [window.wM_min.value(),
+                   window.wM_max.value(),
+                   window.wM_filter.isChecked()],
+            'gM': [window.gM_min.value(),
+                   window.gM_max.value(),
+                   window.gM_filter.isChecked()],
+            'wCh': [window.wCh_min.value(),
+                    window.wCh_max.value(),
+                    window.wCh_filter.isChecked()],
+            'gCh': [window.gCh_min.value(),
+                    window.gCh_max.value(),
+                    window.gCh_filter.isChecked()]
+            }
+
+
+def describe_filter_state(state):
+    """Returns the active filters of a filter state as text, for titles."""
+    # 'Time' is set by the same widgets as 'srs_timestamp'
+    filters = ['%s: %g-%g' % (par, min_val, max_val)
+               for par, (min_val, max_val, filter_on) in state.items()
+               if filter_on and par != 'Time']
+    return ', '.join(filters) if filters else 'none'
+
+
+def get_event_mask(events, state):
+    """
+    Returns the boolean mask of the events passing the filters in 'state'.
+    'events' can be a DataFrame or a dictionary of column arrays.
+    """
+    return get_parameter_mask(events, state, EVENT_PARAMETERS) & get_channel_mask(events, state)
+
+
+def get_cluster_mask(ce, state):
+    """
+    Returns the boolean mask of the clusters passing the filters in 'state'.
+    'ce' can be a DataFrame or a dictionary of column arrays.
+    """
+    return get_parameter_mask(ce, state, CLUSTER_PARAMETERS) & get_channel_mask(ce, state)
+
+
+def get_parameter_mask(table, state, parameters):
+    # Only include the filters that we want to use
+    mask = np.ones(len(table['wCh']), dtype=bool)
+    for par in parameters:
+        min_val, max_val, filter_on = state[par]
+        if filter_on:
+            values = np.asarray(table[par])
+            mask &= (values >= min_val) & (values <= max_val)
+    return mask
+
+
+def get_channel_mask(table, state):
+    # Perform an additional filter on grid and wire channels
+    wCh_min, wCh_max, wCh_filter_on = state['wCh']
+    gCh_min, gCh_max, gCh_filter_on = state['gCh']
+    if not (wCh_filter_on or gCh_filter_on):
+        return np.ones(len(table['wCh']), dtype=bool)
+    if not wCh_filter_on:
+        wCh_min, wCh_max = 0, 79
+    if not gCh_filter_on:
+        gCh_min, gCh_max = 0, 12
+    wCh = np.asarray(table['wCh'])
+    gCh = np.asarray(table['gCh'])
+    return (((wCh >= wCh_min) & (wCh <= wCh_max))
+            | ((gCh >= gCh_min) & (gCh <= gCh_max)))
+
+
+# =============================================================================
+# Parallel reductions
+# =============================================================================
+
+
+def map_chunks(function, size, nbr_threads=None):
+    """
+    Calls 'function(start, stop)' on contiguous chunks of the rows 0 to
+    'size' and returns the results in order. The chunks are processed on
+    a thread pool, numpy releases the GIL for masking, take and bincount.
+    """
+    if nbr_threads is None:
+        nbr_threads = NBR_THREADS
+    nbr_chunks = min(nbr_threads, size // CHUNK_SIZE)
+    if nbr_chunks <= 1:
+        return [function(0, size)]
+    edges = np.linspace(0, size, nbr_chunks + 1).astype(np.int64)
+    with ThreadPoolExecutor(nbr_chunks) as executor:
+        return list(executor.map(function, edges[:-1], edges[1:]))
+
+
+def get_chunked_mask(mask_function, table, state, columns):
+    """
+    Evaluates a mask function, e.g. get_event_mask, chunk by chunk on the
+    'columns' of 'table'.
+    """
+    def mask_chunk(start, stop):
+        return mask_function({column: values[start:stop]
+                              for column, values in arrays.items()}, state)
+
+    arrays = {column: np.asarray(table[column]) for column in columns}
+    return np.concatenate(map_chunks(mask_chunk, len(table)))
+
+
+def take_rows(table, mask, nbr_threads=None):
+    """
+    Returns the rows of a DataFrame where 'mask' is True, like table[mask],
+    copying the columns in parallel.
+    """
+    if nbr_threads is None:
+        nbr_threads = NBR_THREADS
+    if nbr_threads <= 1 or len(table) < CHUNK_SIZE:
+        return table[mask]
+    index = np.flatnonzero(mask)
+    with ThreadPoolExecutor(min(nbr_threads, table.shape[1])) as executor:
+        columns = list(executor.map(lambda column: table[column].values.take(index),
+                                    table.columns))
+    return pd.DataFrame(dict(zip(table.columns, columns)),
+                        index=table.index[index], copy=False)
+
+
+# =============================================================================
+# Histograms
+# =============================================================================
+
+def histogram_1d(values, bins, range, mask=None, nbr_threads=None):
+    """
+    Returns the histogram of 'values' with the same binning as np.histogram,
+    calculated with np.bincount. Only entries where 'mask' is True are
+    counted. Large inputs are histogrammed in chunks on 'nbr_threads'
+    threads and summed.
+    """
+    def histogram_chunk(start, stop):
+        index = get_bin_index(values[start:stop], bins, range)
+        valid = (index >= 0) & (index < bins)
+        if mask is not None:
+            valid &= mask[start:stop]
+        return np.bincount(index[valid], minlength=bins)
+
+    values = np.asarray(values)
+    if mask is not None:
+        mask = np.asarray(mask)
+    return sum(map_chunks(histogram_chunk, len(values), nbr_threads))
+
+
+def histogram_2d(x, y, bins, range, mask=None, nbr_threads=None):
+    """
+    Returns the 2D histogram of 'x' and 'y' with the same binning as
+    np.histogram2d, but calculated with np.bincount on a flattened integer
+    bin index. Only entries where 'mask' is True are counted. Large inputs
+    are histogrammed in chunks on 'nbr_threads' threads and summed.
+    """
+    def histogram_chunk(start, stop):
+        ix = get_bin_index(x[start:stop], bins[0], range[0])
+        iy = get_bin_index(y[start:stop], bins[1], range[1])
+        valid = (ix >= 0) & (ix < bins[0]) & (iy >= 0) & (iy < bins[1])
+        if mask is not None:
+            valid &= mask[start:stop]
+        return np.bincount(ix[valid] * bins[1] + iy[valid],
+                           minlength=bins[0] * bins[1])
+
+    x, y = np.asarray(x), np.asarray(y)
+    if mask is not None:
+        mask = np.asarray(mask)
+    counts = sum(map_chunks(histogram_chunk, len(x), nbr_threads))
+    return counts.reshape(bins[0], bins[1])
+
+
+def get_bin_index(values, bins, limits):
+    """
+    Returns the integer bin index of each value. Values outside of 'limits'
+    get an index outside of [0, bins), the upper limit is included in the
+    last bin, as in np.histogram.
+    """
+    lo, hi = limits
+    width = (hi - lo) / bins
+    if width == 1 and np.issubdtype(values.dtype, np.integer):
+        # Channel axes: unit bins on integer data is a subtraction
+        index = values.astype(np.int64) - int(np.ceil(lo))
+        if hi == int(hi):
+            index[values == hi] = bins - 1
+        return index
+    index = np.floor((values - lo) / width).astype(np.int64)
+    index[values == hi] = bins - 1
+    return index
+
+
+# =============================================================================
+# Decimation
+# =============================================================================
+
+def decimate_min_max(y, nbr_buckets):
+    """
+    Returns the sorted indices of the minimum and maximum of 'y' in each of
+    'nbr_buckets' equally sized buckets, plus the first and last index.
+    """
+    size = len(y)
+    if size <= 2 * nbr_buckets:
+        return np.arange(size)
+    bucket_size = size // nbr_buckets
+    nbr_full = size // bucket_size
+    # Reshape the full buckets (a view, no copy) and treat the rest separately
+    buckets = y[:nbr_full * bucket_size].reshape(nbr_full, bucket_size)
+    offsets = np.arange(nbr_full) * bucket_size
+    indices = [offsets + buckets.argmin(axis=1),
+               offsets + buckets.argmax(axis=1)]
+    if nbr_full * bucket_size < size:
+        tail = y[nbr_full * bucket_size:]
+        indices.append(nbr_full * bucket_size + np.array([tail.argmin(),
+                                                          tail.argmax()]))
+    indices.append(np.array([0, size - 1]))
+    return np.unique(np.concatenate(indices))
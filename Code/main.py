@@ -1,22 +1,17 @@
+import time
+t_start = time.time()
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 from PyQt5 import uic
 import sys
 import os
-import pandas as pd
-import numpy as np
-import time
+import importlib.util
 
-from cluster import import_data, cluster_data
-from Plotting.PHS import (PHS_1D_VMM_plot, PHS_1D_MG_plot, PHS_2D_VMM_plot,
-                          PHS_2D_MG_plot, PHS_Individual_plot,
-                          PHS_Individual_Channel_plot, PHS_cluster_plot,
-                          PHS_1D_overlay_plot)
-from Plotting.Coincidences import Coincidences_2D_plot, Coincidences_3D_plot
-from Plotting.Miscellaneous import timestamp_plot, chip_channels_plot, channel_rates
-from Plotting.HelperFunctions import filter_coincident_events
-from Plotting.HelpMessage import gethelp
+# Heavy modules (pandas, h5py, matplotlib, plotly, Numba) are only imported on
+# first use of the corresponding button, to keep the start-up fast
+from memory import (track_stage, check_memory_budget, fits_memory_budget,
+                    table_nbytes, MemoryBudgetError)
 
 # =============================================================================
 # Windows
@@ -26,16 +21,46 @@ from Plotting.HelpMessage import gethelp
 class MainWindow(QMainWindow):
     def __init__(self, app, parent=None):
         super(MainWindow, self).__init__(parent)
-        dir_name = os.path.dirname(__file__)
-        title_screen_path = os.path.join(dir_name, '../Windows/mainwindow.ui')
-        self.ui = uic.loadUi(title_screen_path, self)
+        self.ui = self.load_ui()
         self.app = app
         self.measurement_time = 0
         self.data_sets = ''
-        #self.Clusters_20_layers = pd.DataFrame()
-        self.Clusters_16_layers = pd.DataFrame()
-        #self.Events_20_layers = pd.DataFrame()
-        self.Events_16_layers = pd.DataFrame()
+        self.rate_bin_width = 60  # [s]
+        # Channels dropped before clustering, as (chip_id, channel), and the
+        # factor over the median above which channels are hot (None is off)
+        self.masked_channels = []
+        self.hot_channel_factor = None
+        # VMM chip and channel of the pulse (chopper) signal, as (chip_id,
+        # channel), and its times. The channel is read from the raw files and
+        # not clustered (None is off).
+        self.pulse_channel = None
+        self.pulse_times = None
+        # Apply the chip, channel, ADC and time filters while reading raw files
+        self.filter_on_read = False
+        # Gain calibration applied to the ADC before clustering (None is off)
+        self.calibration = None
+        # Histogram-only mode: clustered files only fill the campaign
+        # histograms and random samples of the rows (see campaign.py)
+        self.histogram_only = False
+        self.histograms = None
+        self.reservoirs = None
+        # Filters the histograms are filled with, fixed when they are started
+        self.histogram_state = None
+        # Raw hits of the last clustered file, for the channels per chip
+        # (None after histogram-only clustering or loading from Parquet)
+        self.data = None
+        # Tables are created on the first clustering
+        self.Clusters_20_layers = None
+        self.Clusters_16_layers = None
+        self.Events_20_layers = None
+        self.Events_16_layers = None
+        # Catalog of data files (see catalog.py), opened from the menu
+        self.catalog = None
+        # Per-channel statistics, accumulated during clustering
+        self.channel_stats = None
+        # Incremented whenever the tables change, cached plot data of older
+        # versions is never used again (see Plotting/Cache.py)
+        self.data_version = 0
         self.VMM.setEnabled
         self.show()
         self.refresh_window()
@@ -45,26 +70,74 @@ class MainWindow(QMainWindow):
     # =========================================================================
 
     def cluster_action(self):
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open file', '../data')[0]
+        self.cluster_files(file_paths)
+
+    def cluster_files(self, file_paths):
+        import pandas as pd
+        from cluster import (import_data, mask_channels, detect_hot_channels,
+                             calibrate_adc,
+                             cluster_data, shift_cluster_index,
+                             new_clustering_session, new_channel_stats,
+                             merge_channel_stats, get_tables_size)
         t0 = time.time()
+        if self.catalog is not None and len(file_paths) > 1:
+            # Append the files in time order
+            from catalog import order_files
+            file_paths = order_files(self.catalog, file_paths)
+        if self.histogram_only and len(file_paths) > 0:
+            self.cluster_to_histograms(file_paths)
+            return
+        if len(file_paths) > 0 and not fits_memory_budget(get_tables_size(file_paths, self)):
+            # Too large for the tables, cluster chunk by chunk instead
+            QMessageBox.information(self, 'Memory budget',
+                                    'The selected files do not fit in the '
+                                    'memory budget. They are clustered chunk '
+                                    'by chunk in histogram-only mode.')
+            self.cluster_to_histograms(file_paths)
+            return
         # Import data
-        file_paths = QFileDialog.getOpenFileNames(self, 'Open file', '../data')[0]
         size = len(file_paths)
         if size > 0:
-            # Check if we want to append or write
-            if self.write_button.isChecked():
+            # Check if we want to append or write. After the histogram-only
+            # mode the tables only hold samples, which can not be appended to
+            if (self.write_button.isChecked() or self.Clusters_16_layers is None
+                    or self.reservoirs is not None):
                 self.measurement_time = 0
                 self.Clusters_20_layers = pd.DataFrame()
                 self.Clusters_16_layers = pd.DataFrame()
                 self.Events_20_layers   = pd.DataFrame()
                 self.Events_16_layers   = pd.DataFrame()
+                self.channel_stats = new_channel_stats()
+                self.histograms = None
+                self.reservoirs = None
+                self.pulse_times = None
                 self.data_sets = ''
+                self.data_version += 1
             else:
                 self.data_sets += '\n'
-            # Iterate through selected files
+            # Iterate through selected files, clustering them as one stream
+            session = new_clustering_session()
+            hot_channels = None
             for i, file_path in enumerate(file_paths):
-                data = import_data(file_path, self)
+                with track_stage('Import') as report:
+                    data = import_data(file_path, self)
+                    report['tables'] = [data]
+                with track_stage('Channel mask') as report:
+                    # Hot channels of the first file are masked in all
+                    if hot_channels is None:
+                        hot_channels = detect_hot_channels(data, self)
+                    data = mask_channels(data, self, hot_channels)
+                    report['tables'] = [data]
+                with track_stage('Calibration') as report:
+                    data = calibrate_adc(data, self)
+                    report['tables'] = [data]
                 self.data = data
-                clusters, events = cluster_data(data, self, i+1, size)
+                with track_stage('Clustering') as report:
+                    clusters, events = cluster_data(data, self, i+1, size,
+                                                    session)
+                    report['tables'] = [clusters, events]
+                    report['hits'] = data.shape[0]
                 print("EVENTS")
                 print(events)
                 print("length", len(events))
@@ -72,11 +145,28 @@ class MainWindow(QMainWindow):
                 print(clusters)
                 print("length", len(clusters))
                 self.measurement_time += self.get_duration(events)
-                self.Clusters_20_layers = self.Clusters_20_layers.append(clusters)
-                self.Clusters_16_layers = self.Clusters_16_layers.append(clusters)
-                self.Events_20_layers = self.Events_20_layers.append(events)
-                self.Events_16_layers = self.Events_16_layers.append(events)
+                shift_cluster_index(clusters, events,
+                                    self.Clusters_16_layers.shape[0],
+                                    self.Events_16_layers.shape[0])
+                # Each append copies the old table, and everything is stored
+                # for both detectors
+                check_memory_budget('Accumulation',
+                                    table_nbytes(self.Clusters_16_layers,
+                                                 self.Events_16_layers)
+                                    + 2 * table_nbytes(clusters, events))
+                with track_stage('Accumulation') as report:
+                    self.Clusters_20_layers = self.Clusters_20_layers.append(clusters)
+                    self.Clusters_16_layers = self.Clusters_16_layers.append(clusters)
+                    self.Events_20_layers = self.Events_20_layers.append(events)
+                    self.Events_16_layers = self.Events_16_layers.append(events)
+                    report['tables'] = [self.Clusters_20_layers,
+                                        self.Clusters_16_layers,
+                                        self.Events_20_layers,
+                                        self.Events_16_layers]
+                self.data_version += 1
                 self.refresh_window()
+            merge_channel_stats(self.channel_stats, session['channel_stats'])
+            self.update_pulse_times(file_paths)
             self.Clusters_20_layers.reset_index(drop=True, inplace=True)
             self.Clusters_16_layers.reset_index(drop=True, inplace=True)
             self.Events_20_layers.reset_index(drop=True, inplace=True)
@@ -90,6 +180,292 @@ class MainWindow(QMainWindow):
             self.data_sets = file_names
             self.refresh_window()
 
+    def cluster_to_histograms(self, file_paths):
+        """
+        Clusters the files into the campaign histograms, keeping only a
+        random sample of the events and clusters, so memory stays constant
+        however long the run is. The samples replace the tables, so the
+        usual plots can be used for spot checks. The rows are discarded, so
+        the histograms keep the filters they were started with, also when
+        appending.
+        """
+        from cluster import new_channel_stats, merge_channel_stats
+        from campaign import (new_histograms, merge_histograms,
+                              accumulate_histograms, Reservoir)
+        from filters import get_filter_state
+        # Check if we want to append or write
+        if (self.write_button.isChecked() or self.histograms is None
+                or self.Clusters_16_layers is None):
+            self.measurement_time = 0
+            self.histograms = new_histograms(int(self.phsBins.text()))
+            self.reservoirs = {'events': Reservoir(), 'clusters': Reservoir()}
+            self.histogram_state = get_filter_state(self)
+            self.channel_stats = new_channel_stats()
+            self.pulse_times = None
+            self.data_sets = ''
+        else:
+            self.data_sets += '\n'
+        histograms = new_histograms(self.histograms['number_bins'])
+        channel_stats = accumulate_histograms(histograms, file_paths, self,
+                                              self.reservoirs,
+                                              state=self.histogram_state)
+        # From all events, as get_duration, not only the filtered ones
+        start_time, end_time = histograms['hits_time']
+        if start_time <= end_time:
+            self.measurement_time += end_time - start_time
+        merge_histograms(self.histograms, histograms)
+        merge_channel_stats(self.channel_stats, channel_stats)
+        self.update_pulse_times(file_paths)
+        events = self.reservoirs['events'].table()
+        clusters = self.reservoirs['clusters'].table()
+        self.Clusters_20_layers = clusters
+        self.Clusters_16_layers = clusters
+        self.Events_20_layers = events
+        self.Events_16_layers = events
+        # The raw hits are not kept
+        self.data = None
+        self.data_version += 1
+        self.data_sets += self.get_file_names(file_paths)
+        self.data_sets_browser.setText(self.data_sets)
+        self.refresh_window()
+
+    def update_pulse_times(self, file_paths):
+        """
+        Appends the pulse times of the files, read from the pulse channel of
+        the raw hits (see tof.read_pulse_times).
+        """
+        if self.pulse_channel is None:
+            self.pulse_times = None
+            return
+        import numpy as np
+        from tof import read_pulse_times
+        pulse_times = [read_pulse_times(file_path, *self.pulse_channel)
+                       for file_path in file_paths]
+        if self.pulse_times is not None:
+            pulse_times.append(self.pulse_times)
+        self.pulse_times = np.sort(np.concatenate(pulse_times))
+
+    def histograms_action(self):
+        if self.histograms is not None:
+            from filters import get_filter_state
+            from Plotting.Campaign import Campaign_plot, Campaign_3D_plot
+            if get_filter_state(self) != self.histogram_state:
+                QMessageBox.information(self, 'Histogram-only mode',
+                                        'The filters have changed since the '
+                                        'histograms were started. They keep '
+                                        'the filters shown in the title, '
+                                        'cluster again to apply new ones.')
+            fig = Campaign_plot(self.histograms, self.data_sets,
+                                self.histogram_state)
+            fig.show()
+            Campaign_3D_plot(self.histograms, self.data_sets)
+
+    def catalog_build_action(self):
+        from catalog import get_catalog_path, open_catalog, update_catalog
+        directory = QFileDialog.getExistingDirectory(self, 'Data directory', '../data')
+        if directory == '':
+            return
+        # The data directory may be read-only, the catalog can be elsewhere
+        path = QFileDialog.getSaveFileName(self, 'Catalog', get_catalog_path(directory),
+                                           '*.sqlite', options=QFileDialog.DontConfirmOverwrite)[0]
+        if path != '':
+            self.catalog = open_catalog(path)
+            with track_stage('Catalog'):
+                nbr_scanned = update_catalog(self.catalog, directory)
+            nbr_files = self.catalog.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+            print('[catalog] %d files, %d scanned' % (nbr_files, nbr_scanned))
+
+    def catalog_select_action(self):
+        if self.catalog is not None:
+            import sqlite3
+            from catalog import select_files, parse_conditions
+            condition, ok = QInputDialog.getText(self, 'Select from catalog',
+                                                 'Conditions on the files '
+                                                 '(column operator value AND ...):',
+                                                 text='kind = raw AND hits > 0')
+            if ok and condition != '':
+                try:
+                    file_paths = select_files(self.catalog,
+                                              parse_conditions(condition))
+                except (sqlite3.Error, ValueError) as error:
+                    QMessageBox.warning(self, 'Catalog', str(error))
+                    return
+                print('[catalog] %d files selected' % len(file_paths))
+                self.cluster_files(file_paths)
+
+    def campaign_action(self):
+        from campaign import run_campaign
+        from Plotting.Campaign import Campaign_plot, Campaign_3D_plot
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open campaign files',
+                                                  '../data')[0]
+        if len(file_paths) > 0:
+            histograms = run_campaign(file_paths, self)
+            data_sets = self.get_file_names(file_paths)
+            fig = Campaign_plot(histograms, data_sets)
+            fig.show()
+            Campaign_3D_plot(histograms, data_sets)
+
+    def compare_runs_action(self):
+        from campaign import compare_runs
+        from Plotting.Campaign import Runs_comparison_plot
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open runs (one file per run)',
+                                                  '../data')[0]
+        if len(file_paths) > 0:
+            mode, ok = QInputDialog.getItem(self, 'Run comparison', 'Plot:',
+                                            ['overlay', 'ratio', 'difference'],
+                                            0, False)
+            if ok:
+                if self.catalog is not None:
+                    from catalog import order_files
+                    file_paths = order_files(self.catalog, file_paths)
+                runs = {os.path.splitext(os.path.basename(file_path))[0]: [file_path]
+                        for file_path in file_paths}
+                stacked = compare_runs(runs, self)
+                fig = Runs_comparison_plot(stacked, mode)
+                fig.show()
+
+    def cluster_to_store_action(self):
+        from campaign import cluster_to_store
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open file', '../data')[0]
+        if len(file_paths) > 0:
+            store_path = QFileDialog.getSaveFileName(self, 'Save clustered store',
+                                                     '../Clusters', '*.h5')[0]
+            if store_path != '':
+                cluster_to_store(file_paths, store_path, self)
+
+    def time_window_sweep_action(self):
+        import numpy as np
+        from cluster import (import_data, mask_channels, detect_hot_channels,
+                             sweep_time_window)
+        from Plotting.Miscellaneous import time_window_sweep_plot
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open file', '../data')[0]
+        if len(file_paths) > 0:
+            time_window = float(self.time_window.text())
+            default = ', '.join('%g' % (time_window * factor)
+                                for factor in [0.25, 0.5, 1, 2, 4])
+            text, ok = QInputDialog.getText(self, 'Time window sweep',
+                                            'Time windows [TDC channels]:',
+                                            text=default)
+            if ok and text != '':
+                time_windows = [float(value) for value in text.split(',')]
+                # Only the times and chips are needed, the files are one stream
+                times, chip_ids = [], []
+                hot_channels = None
+                for file_path in file_paths:
+                    data = import_data(file_path, self)
+                    if hot_channels is None:
+                        hot_channels = detect_hot_channels(data, self)
+                    data = mask_channels(data, self, hot_channels)
+                    times.append(data['srs_timestamp'].values.astype(np.int64)
+                                 + data['chiptime'].values.astype(np.int64))
+                    chip_ids.append(data['chip_id'].values)
+                    del data
+                with track_stage('Time window sweep'):
+                    results = sweep_time_window(np.concatenate(times),
+                                                np.concatenate(chip_ids),
+                                                time_windows)
+                fig = time_window_sweep_plot(results,
+                                             self.get_file_names(file_paths))
+                fig.show()
+
+    def parquet_export_action(self):
+        if self.data_sets != '':
+            from columnar import export_to_parquet
+            directory = QFileDialog.getExistingDirectory(self, 'Export to Parquet',
+                                                         '../Clusters')
+            if directory != '':
+                default_run = os.path.splitext(self.data_sets.splitlines()[0])[0]
+                run, ok = QInputDialog.getText(self, 'Export to Parquet',
+                                               'Run name:', text=default_run)
+                if ok and run != '':
+                    export_to_parquet(self.Events_16_layers,
+                                      self.Clusters_16_layers, directory, run)
+
+    def parquet_load_action(self):
+        from columnar import load_window_from_parquet
+        directory = QFileDialog.getExistingDirectory(self, 'Load from Parquet',
+                                                     '../Clusters')
+        if directory != '':
+            load_window_from_parquet(directory, self)
+            # The loaded tables replace any histogram-only samples, the raw
+            # hits and pulses of earlier files
+            self.histograms = None
+            self.reservoirs = None
+            self.data = None
+            self.pulse_times = None
+            self.data_sets = os.path.basename(directory)
+            self.data_sets_browser.setText(self.data_sets)
+            self.measurement_time = self.get_duration(self.Events_16_layers)
+            self.refresh_window()
+
+    def server_action(self):
+        from urllib.error import URLError
+        from server import ServerError
+        try:
+            self.query_server()
+        except ServerError as error:
+            QMessageBox.warning(self, 'Histogram server', str(error))
+        except URLError as error:
+            QMessageBox.warning(self, 'Histogram server',
+                                'No histogram server is running (%s). Start '
+                                'it with python server.py.' % error.reason)
+
+    def query_server(self):
+        from server import request_server
+        from filters import get_filter_state
+        from Plotting.Campaign import Campaign_plot, Campaign_3D_plot
+        runs = [run['name'] for run in request_server('/runs')]
+        run, ok = QInputDialog.getItem(self, 'Histogram server', 'Run:',
+                                       runs + ['New run...'], 0, True)
+        if not ok or run == '':
+            return
+        if run not in runs:
+            file_paths = QFileDialog.getOpenFileNames(self, 'Open file',
+                                                      '../data')[0]
+            if len(file_paths) == 0:
+                return
+            if run == 'New run...':
+                run = self.get_file_names(file_paths).splitlines()[0]
+            request_server('/load', {'run': run, 'files': file_paths,
+                                     'time_window': float(self.time_window.text())})
+        histograms = request_server('/histograms',
+                                    {'run': run, 'state': get_filter_state(self),
+                                     'number_bins': int(self.phsBins.text())})
+        fig = Campaign_plot(histograms, run)
+        fig.show()
+        Campaign_3D_plot(histograms, run)
+
+    def ToF_file_action(self):
+        if self.data_sets != '':
+            from tof import load_pulse_times
+            file_path = QFileDialog.getOpenFileName(self, 'Open pulse times',
+                                                    '../data')[0]
+            if file_path != '':
+                self.show_ToF(load_pulse_times(file_path))
+
+    def ToF_channel_action(self):
+        default = '%d, %d' % self.pulse_channel if self.pulse_channel else ''
+        text, ok = QInputDialog.getText(self, 'ToF',
+                                        'Pulse signal (chip, channel, empty '
+                                        'is off):', text=default)
+        if not ok:
+            return
+        pulse_channel = (tuple(int(value) for value in text.split(','))
+                         if text.strip() else None)
+        if pulse_channel is None:
+            self.pulse_channel = None
+            self.pulse_times = None
+        elif pulse_channel != self.pulse_channel or self.pulse_times is None:
+            # The pulses are read from the raw hits at the next clustering
+            self.pulse_channel = pulse_channel
+            self.pulse_times = None
+            QMessageBox.information(self, 'ToF',
+                                    'The pulse channel is read from the raw '
+                                    'files and not clustered. Cluster the '
+                                    'files again to show the ToF.')
+        else:
+            self.show_ToF(self.pulse_times)
+
     def save_action(self):
         save_path = QFileDialog.getSaveFileName()[0]
         if save_path != '':
@@ -102,6 +478,8 @@ class MainWindow(QMainWindow):
 
     def PHS_1D_action(self):
         if self.data_sets != '':
+            from Plotting.PHS import (PHS_1D_VMM_plot, PHS_1D_MG_plot,
+                                      PHS_cluster_plot, PHS_1D_overlay_plot)
             if self.PHS_raw.isChecked():
                 if self.VMM.isChecked():
                     fig = PHS_1D_VMM_plot(self)
@@ -121,6 +499,7 @@ class MainWindow(QMainWindow):
 
     def PHS_2D_action(self):
         if self.data_sets != '':
+            from Plotting.PHS import PHS_2D_VMM_plot, PHS_2D_MG_plot
             if self.VMM.isChecked():
                 fig = PHS_2D_VMM_plot(self)
             else:
@@ -129,6 +508,8 @@ class MainWindow(QMainWindow):
 
     def PHS_Individual_action(self):
         if self.data_sets != '':
+            from Plotting.PHS import (PHS_Individual_plot,
+                                      PHS_Individual_Channel_plot)
             if self.ind_gCh.isChecked() or self.ind_wCh.isChecked():
                 channel = self.ind_channel.value()
                 fig = PHS_Individual_Channel_plot(self, channel)
@@ -138,42 +519,131 @@ class MainWindow(QMainWindow):
 
     def Coincidences_2D_action(self):
         if self.data_sets != '':
+            from Plotting.Coincidences import Coincidences_2D_plot
             fig = Coincidences_2D_plot(self)
             fig.show()
 
     def Coincidences_3D_action(self):
         if self.data_sets != '':
+            from Plotting.Coincidences import Coincidences_3D_plot
             Coincidences_3D_plot(self)
 
+    def Coincidences_3D_export_action(self):
+        if self.data_sets != '':
+            from Plotting.Coincidences import Coincidences_3D_export
+            path = QFileDialog.getSaveFileName(self, 'Export Coincidences (3D)',
+                                               '../Results/Coincidences_3D',
+                                               '*.npz')[0]
+            if path != '':
+                Coincidences_3D_export(self, path)
+
+    def Coincidences_3D_load_action(self):
+        from Plotting.Coincidences import (load_3D_histogram,
+                                           Coincidences_3D_render)
+        path = QFileDialog.getOpenFileName(self, 'Open Coincidences (3D) export',
+                                           '../Results/Coincidences_3D',
+                                           '*.npz')[0]
+        if path != '':
+            H_20, H_16, data_sets = load_3D_histogram(path)
+            Coincidences_3D_render(H_20, H_16, data_sets)
+
     def timestamp_action(self):
         if self.data_sets != '':
+            from Plotting.Miscellaneous import timestamp_plot
             fig = timestamp_plot(self)
             fig.show()
 
     def rate_action(self):
         if self.data_sets != '':
-            ce_16 = self.Clusters_16_layers
-            ce_20 = self.Clusters_20_layers
-            layers_vec = [16, 20]
-            events_vec = [ce_16, ce_20]
-            for layer, events in zip(layers_vec, events_vec):
-                ce_red = filter_coincident_events(events, self)
-                start_time = ce_red.head(1)['Time'].values[0]
-                end_time = ce_red.tail(1)['Time'].values[0]
-                rate = ce_red.shape[0]/((end_time - start_time) * 1e-9)
-                print('Total neutron rate (%s layers): %f Hz' % (layer, rate))
+            from Plotting.Miscellaneous import rate_history_plot
+            fig = rate_history_plot(self, self.rate_bin_width)
+            fig.show()
+
+    def rate_bin_width_action(self):
+        bin_width, ok = QInputDialog.getDouble(self, 'Rate history',
+                                               'Bin width [s]:',
+                                               self.rate_bin_width, 0.001, 1e6, 3)
+        if ok:
+            self.rate_bin_width = bin_width
+
+    def calibration_load_action(self):
+        from cluster import load_calibration
+        path = QFileDialog.getOpenFileName(self, 'Load gain calibration',
+                                           '../Tables', '*.csv *.xlsx')[0]
+        if path != '':
+            self.calibration = load_calibration(path)
+
+    def calibration_fit_action(self):
+        import pandas as pd
+        from cluster import (import_data, mask_channels, detect_hot_channels,
+                             fit_gains, load_calibration)
+        file_paths = QFileDialog.getOpenFileNames(self, 'Open file', '../data')[0]
+        if len(file_paths) > 0:
+            path = QFileDialog.getSaveFileName(self, 'Save gain calibration',
+                                               '../Tables', '*.csv')[0]
+            if path != '':
+                # The hits are read without calibration
+                hits, hot_channels = [], None
+                for file_path in file_paths:
+                    data = import_data(file_path, self)
+                    if hot_channels is None:
+                        hot_channels = detect_hot_channels(data, self)
+                    hits.append(mask_channels(data, self, hot_channels))
+                hits = pd.concat(hits, ignore_index=True)
+                with track_stage('Gain fit'):
+                    table = fit_gains(hits)
+                del hits
+                print(table.to_string())
+                table.to_csv(path, index=False)
+                self.calibration = load_calibration(path)
+
+    def calibration_off_action(self):
+        self.calibration = None
+
+    def channel_statistics_action(self):
+        if self.channel_stats is not None:
+            from Plotting.Miscellaneous import channel_statistics_plot
+            fig = channel_statistics_plot(self)
+            fig.show()
+
+    def channel_mask_action(self):
+        from cluster import HOT_CHANNEL_FACTOR
+        default = ', '.join('%d:%d' % channel for channel in self.masked_channels)
+        text, ok = QInputDialog.getText(self, 'Channel mask',
+                                        'Masked channels (chip:channel, ...):',
+                                        text=default)
+        if not ok:
+            return
+        factor, ok = QInputDialog.getDouble(self, 'Channel mask',
+                                            'Mask channels with more than this '
+                                            'factor times the median hits\n'
+                                            '(e.g. %g, 0 is off):' % HOT_CHANNEL_FACTOR,
+                                            self.hot_channel_factor or 0,
+                                            0, 1e6, 1)
+        if ok:
+            self.masked_channels = [tuple(int(value) for value in channel.split(':'))
+                                    for channel in text.split(',') if channel.strip()]
+            self.hot_channel_factor = factor if factor > 0 else None
 
     def channel_rate_action(self):
         if self.data_sets != '':
+            from Plotting.Miscellaneous import channel_rates
             fig = channel_rates(self)
             fig.show()
 
     def help_action(self):
+        from Plotting.HelpMessage import gethelp
         print("HELP!!!!")
         gethelp()
 
     def chip_channels_action(self):
-        if self.data_sets != '':
+        if self.data_sets != '' and self.data is None:
+            QMessageBox.information(self, 'Channels per chip',
+                                    'No raw hits are loaded: the channels per '
+                                    'chip need files clustered without '
+                                    'histogram-only mode.')
+        elif self.data_sets != '':
+            from Plotting.Miscellaneous import chip_channels_plot
             fig = chip_channels_plot(self)
             fig.show()
 
@@ -200,6 +670,39 @@ class MainWindow(QMainWindow):
         self.toogle_VMM_MG()
         # Help
         self.helpbutton.clicked.connect(self.help_action)
+        # Menus
+        analysis_menu = self.menuBar.addMenu('Analysis')
+        analysis_menu.addAction('Build run catalog...', self.catalog_build_action)
+        analysis_menu.addAction('Cluster from catalog...', self.catalog_select_action)
+        analysis_menu.addAction('Cluster to store...', self.cluster_to_store_action)
+        analysis_menu.addAction('Campaign (out-of-core)...', self.campaign_action)
+        analysis_menu.addAction('Compare runs...', self.compare_runs_action)
+        analysis_menu.addAction('Rate history bin width...', self.rate_bin_width_action)
+        analysis_menu.addAction('Time window sweep...', self.time_window_sweep_action)
+        analysis_menu.addAction('Channel mask...', self.channel_mask_action)
+        analysis_menu.addAction('Channel statistics', self.channel_statistics_action)
+        analysis_menu.addAction('Load gain calibration...', self.calibration_load_action)
+        analysis_menu.addAction('Fit gain calibration...', self.calibration_fit_action)
+        analysis_menu.addAction('Gain calibration off', self.calibration_off_action)
+        filter_on_read = analysis_menu.addAction('Filter hits while reading')
+        filter_on_read.setCheckable(True)
+        filter_on_read.toggled.connect(
+            lambda checked: setattr(self, 'filter_on_read', checked))
+        histogram_only = analysis_menu.addAction('Histogram-only mode')
+        histogram_only.setCheckable(True)
+        histogram_only.toggled.connect(
+            lambda checked: setattr(self, 'histogram_only', checked))
+        analysis_menu.addAction('Histogram-only plots', self.histograms_action)
+        analysis_menu.addAction('Histogram server...', self.server_action)
+        analysis_menu.addAction('Export to Parquet...', self.parquet_export_action)
+        analysis_menu.addAction('Load from Parquet (filtered)...',
+                                self.parquet_load_action)
+        analysis_menu.addAction('ToF (pulse file)...', self.ToF_file_action)
+        analysis_menu.addAction('ToF (pulse channel)...', self.ToF_channel_action)
+        analysis_menu.addAction('Export Coincidences (3D)...',
+                                self.Coincidences_3D_export_action)
+        analysis_menu.addAction('Coincidences (3D) from export...',
+                                self.Coincidences_3D_load_action)
         # Individual channels
         self.toggle_ind_channels()
         self.toggle_PHS_choice()
@@ -228,6 +731,41 @@ class MainWindow(QMainWindow):
         self.raw_rates.setStyleSheet("background-color:hsv(290,10,220)")
         self.clustered_rates.setStyleSheet("background-color:hsv(290,10,220)")
 
+    def show_ToF(self, pulse_times):
+        from Plotting.ToF import ToF_plot
+        if len(pulse_times) == 0:
+            QMessageBox.warning(self, 'ToF', 'No pulses found.')
+        else:
+            fig = ToF_plot(self, pulse_times)
+            fig.show()
+
+    def load_ui(self):
+        """
+        Sets up the window from the .ui file. The file is compiled to Python
+        once and the compiled module is reused until the .ui file changes,
+        which is much faster than parsing it at every start.
+        """
+        dir_name = os.path.dirname(__file__)
+        ui_path = os.path.join(dir_name, '../Windows/mainwindow.ui')
+        compiled_path = os.path.join(dir_name, '../Windows/__pycache__/mainwindow_ui.py')
+        try:
+            if (not os.path.exists(compiled_path)
+                    or os.path.getmtime(compiled_path) < os.path.getmtime(ui_path)):
+                os.makedirs(os.path.dirname(compiled_path), exist_ok=True)
+                with open(compiled_path, 'w') as compiled_file:
+                    uic.compileUi(ui_path, compiled_file)
+            spec = importlib.util.spec_from_file_location('mainwindow_ui', compiled_path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        except OSError:
+            # No write access, parse the .ui file instead
+            return uic.loadUi(ui_path, self)
+        ui = module.Ui_MainWindow()
+        ui.setupUi(self)
+        # Make the widgets attributes of the window, as with uic.loadUi
+        self.__dict__.update(vars(ui))
+        return self
+
     def refresh_window(self):
         self.update()
         self.app.processEvents()
@@ -247,6 +785,8 @@ class MainWindow(QMainWindow):
         return file_names
 
     def get_duration(self, events):
+        if events.shape[0] == 0:
+            return 0
         start_time = events.head(1)['srs_timestamp'].values[0]
         end_time = events.tail(1)['srs_timestamp'].values[0]
         return end_time - start_time
@@ -288,8 +828,22 @@ class MainWindow(QMainWindow):
 # Start GUI
 # =============================================================================
 
-app = QApplication(sys.argv)
-main_window = MainWindow(app)
-main_window.setAttribute(Qt.WA_DeleteOnClose, True)
-main_window.setup_buttons()
-sys.exit(app.exec_())
+def excepthook(exc_type, exc_value, exc_traceback):
+    # Refuse stages that would exceed the memory budget with a report,
+    # instead of letting the machine swap
+    if issubclass(exc_type, MemoryBudgetError):
+        QMessageBox.warning(None, 'Memory budget exceeded', str(exc_value))
+    else:
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+
+# Worker processes (see campaign.compare_runs) import this module without
+# starting the GUI
+if __name__ == '__main__':
+    sys.excepthook = excepthook
+    app = QApplication(sys.argv)
+    main_window = MainWindow(app)
+    main_window.setAttribute(Qt.WA_DeleteOnClose, True)
+    main_window.setup_buttons()
+    print('[startup] Window ready after %.2f s' % (time.time() - t_start))
+    sys.exit(app.exec_())
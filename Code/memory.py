@@ -0,0 +1,153 @@
+import os
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# Memory budget in GB, 'None' means unlimited. Can be set through the
+# environment variable MG_MEMORY_BUDGET, e.g. 'MG_MEMORY_BUDGET=12'.
+MEMORY_BUDGET = (float(os.environ['MG_MEMORY_BUDGET']) * 1e9
+                 if os.environ.get('MG_MEMORY_BUDGET') else None)
+# Python allocation tracing (tracemalloc) slows down the clustering loop, so
+# it is only switched on when MG_TRACE_MEMORY=1
+TRACE_ALLOCATIONS = os.environ.get('MG_TRACE_MEMORY', '0') == '1'
+# All stage reports of the current session
+stage_reports = []
+
+
+class MemoryBudgetError(MemoryError):
+    """
+    Raised when a stage would exceed the memory budget. The message contains
+    the report which is shown to the user.
+    """
+
+
+# =============================================================================
+# Memory accounting
+# =============================================================================
+
+
+@contextmanager
+def track_stage(stage):
+    """
+    Records RSS, peak traced allocations and the size of the tables produced
+    during a stage. Tables are registered by the caller through
+    'report['tables']', e.g.
+
+        with track_stage('Import') as report:
+            data = import_data(file_path, window)
+            report['tables'] = [data]
+
+    If the caller sets 'report['hits']', the memory per hit is reported too.
+    """
+    if TRACE_ALLOCATIONS:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    report = {'stage': stage, 'tables': [], 'hits': None,
+              'rss_before': get_rss()}
+    t0 = time.time()
+    try:
+        yield report
+    finally:
+        report['duration'] = time.time() - t0
+        report['rss_after'] = get_rss()
+        report['nbytes'] = table_nbytes(*report.pop('tables'))
+        report['peak_traced'] = (tracemalloc.get_traced_memory()[1]
+                                 if tracemalloc.is_tracing() else None)
+        stage_reports.append(report)
+        print(format_report(report))
+
+
+def get_rss():
+    """Returns the resident set size of the process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        # No procfs (Windows/macOS), fall back on the peak RSS
+        try:
+            import resource
+        except ImportError:
+            return 0
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+        return max_rss if max_rss > 1 << 32 else max_rss * 1024
+
+
+def table_nbytes(*tables):
+    """Returns the summed size in bytes of DataFrames and numpy arrays."""
+    nbytes = 0
+    for table in tables:
+        if hasattr(table, 'memory_usage'):
+            nbytes += int(table.memory_usage(index=True).sum())
+        elif hasattr(table, 'nbytes'):
+            nbytes += table.nbytes
+    return nbytes
+
+
+# =============================================================================
+# Memory budget
+# =============================================================================
+
+
+def check_memory_budget(stage, required_bytes):
+    """
+    Raises MemoryBudgetError if allocating 'required_bytes' on top of the
+    current RSS would exceed the memory budget.
+    """
+    if fits_memory_budget(required_bytes):
+        return
+    rss = get_rss()
+    if rss + required_bytes > MEMORY_BUDGET:
+        message = ('%s needs about %s, but %s of the %s memory budget is '
+                   'already in use.\n\nMemory usage per stage:\n%s'
+                   % (stage, format_bytes(required_bytes), format_bytes(rss),
+                      format_bytes(MEMORY_BUDGET), memory_report()))
+        raise MemoryBudgetError(message)
+
+
+def fits_memory_budget(required_bytes):
+    """
+    Returns False if allocating 'required_bytes' on top of the current RSS
+    would exceed the memory budget, e.g. to process the data in chunks
+    instead.
+    """
+    return MEMORY_BUDGET is None or get_rss() + required_bytes <= MEMORY_BUDGET
+
+
+# =============================================================================
+# Helper Functions
+# =============================================================================
+
+
+def format_bytes(nbytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nbytes) < 1000:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1000
+    return '%.1f TB' % nbytes
+
+
+def format_report(report):
+    line = ('[memory] %-20s RSS: %s -> %s, tables: %s, time: %.2f s'
+            % (report['stage'], format_bytes(report['rss_before']),
+               format_bytes(report['rss_after']), format_bytes(report['nbytes']),
+               report['duration']))
+    if report['peak_traced'] is not None:
+        line += ', peak traced: %s' % format_bytes(report['peak_traced'])
+    if report['hits']:
+        # Peak allocations per hit when traced, else the size of the tables
+        nbytes = (report['peak_traced'] if report['peak_traced'] is not None
+                  else report['nbytes'])
+        line += ', per hit: %.0f B' % (nbytes / report['hits'])
+    return line
+
+
+def memory_report():
+    """Returns the reports of all stages of the session as text."""
+    return '\n'.join(format_report(report) for report in stage_reports)
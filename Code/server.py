@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import numpy as np
+import pandas as pd
+
+# =============================================================================
+# Settings
+# =============================================================================
+
+# The server only listens on the local machine
+HOST = '127.0.0.1'
+PORT = int(os.environ.get('MG_SERVER_PORT', 8765))
+
+
+# =============================================================================
+# Server
+# =============================================================================
+
+
+class Run:
+    """
+    Events and clusters of a run, clustered (or read from clustered stores)
+    once and shared by all requests. Stored once, not per detector. For
+    clustered stores the cluster-to-hit index stays relative to each store.
+    """
+    def __init__(self, name, file_paths, time_window):
+        from campaign import iterate_chunks
+        from cluster import shift_cluster_index
+        self.name = name
+        self.file_paths = list(file_paths)
+        self.time_window = time_window
+        events, clusters = [], []
+        nbr_clusters, nbr_hits = 0, 0
+        window = ServerWindow(time_window)
+        for events_chunk, clusters_chunk in iterate_chunks(file_paths, window):
+            if events_chunk is not None and clusters_chunk is not None:
+                shift_cluster_index(clusters_chunk, events_chunk, nbr_clusters, nbr_hits)
+            if events_chunk is not None:
+                nbr_hits += events_chunk.shape[0]
+                events.append(events_chunk)
+            if clusters_chunk is not None:
+                nbr_clusters += clusters_chunk.shape[0]
+                clusters.append(clusters_chunk)
+        self.events = pd.concat(events, ignore_index=True)
+        self.clusters = pd.concat(clusters, ignore_index=True)
+
+    def describe(self):
+        return {'name': self.name, 'files': self.file_paths,
+                'time_window': self.time_window,
+                'events': int(self.events.shape[0]),
+                'clusters': int(self.clusters.shape[0])}
+
+
+class RunConflictError(ValueError):
+    """Raised when a run is loaded again with other files or time window."""
+
+
+class ServerError(RuntimeError):
+    """Raised by request_server when the server answers with an error."""
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+class ServerWindow:
+    """The clustering settings, in place of the widgets of the GUI."""
+    def __init__(self, time_window):
+        self.time_window = Text(str(time_window))
+        self.masked_channels = []
+        self.hot_channel_factor = None
+        self.pulse_channel = None
+        self.filter_on_read = False
+        self.calibration = None
+
+
+class Text:
+    def __init__(self, text):
+        self._text = text
+
+    def text(self):
+        return self._text
+
+
+class HistogramServer(ThreadingHTTPServer):
+    """
+    Answers histogram queries on loaded runs over HTTP (JSON). Requests are
+    handled in threads. The runs and the results (see Plotting/Cache.py) are
+    shared, so any number of clients cost one copy of each run in memory.
+    """
+    daemon_threads = True
+
+    def __init__(self, address=(HOST, PORT)):
+        super().__init__(address, RequestHandler)
+        self.runs = {}
+        self.runs_lock = threading.Lock()
+        self.load_locks = {}
+
+    def load_run(self, name, file_paths, time_window):
+        """
+        Loads a run once, clients asking for a run being loaded wait. Raises
+        RunConflictError if the run is loaded with other files or time window.
+        """
+        with self.runs_lock:
+            load_lock = self.load_locks.setdefault(name, threading.Lock())
+        with load_lock:
+            if name not in self.runs:
+                self.runs[name] = Run(name, file_paths, time_window)
+        run = self.runs[name]
+        if run.file_paths != list(file_paths) or run.time_window != time_window:
+            raise RunConflictError('Run "%s" is already loaded with files %s '
+                                   'and time window %s'
+                                   % (name, run.file_paths, run.time_window))
+        return run
+
+    def get_run(self, name):
+        if name not in self.runs:
+            raise KeyError('Run "%s" is not loaded' % name)
+        return self.runs[name]
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /runs                                      loaded runs
+    POST /load        {run, files, time_window}     load or cluster a run, 409 if
+                                                    loaded with other parameters
+    POST /histograms  {run, state, number_bins}     PHS, coincidences, rates
+    POST /rate_history {run, state, bin_width}      neutron rate vs time
+    POST /timestamps  {run, nbr_points}             decimated timestamps
+
+    'state' is a filter state as returned by get_filter_state.
+    """
+    def do_GET(self):
+        if self.path == '/runs':
+            self.send_json([run.describe() for run in self.server.runs.values()])
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        queries = {'/load': query_load,
+                   '/histograms': query_histograms,
+                   '/rate_history': query_rate_history,
+                   '/timestamps': query_timestamps}
+        if self.path not in queries:
+            self.send_error(404)
+            return
+        length = int(self.headers.get('Content-Length', 0))
+        try:
+            request = json.loads(self.rfile.read(length))
+            answer = queries[self.path](self.server, request)
+        except RunConflictError as error:
+            self.send_json({'error': str(error)}, 409)
+        except (KeyError, ValueError, TypeError, OSError) as error:
+            # Malformed request, unknown run or missing file
+            self.send_json({'error': '%s: %s' % (type(error).__name__, error)}, 400)
+        except Exception as error:
+            # E.g. MemoryBudgetError, the client still gets an answer
+            self.send_json({'error': '%s: %s' % (type(error).__name__, error)}, 500)
+        else:
+            self.send_json(answer)
+
+    def send_json(self, values, status=200):
+        body = json.dumps(values, default=to_json).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        print('[server] %s' % (format % args))
+
+
+# =============================================================================
+# Queries
+# =============================================================================
+
+
+def query_load(server, request):
+    run = server.load_run(request['run'], request['files'],
+                          float(request['time_window']))
+    return run.describe()
+
+
+def query_histograms(server, request):
+    """The histograms of a campaign (see campaign.new_histograms)."""
+    from campaign import (new_histograms, fill_event_histograms,
+                          fill_cluster_histograms)
+    from Plotting.Cache import get_cached_key, get_state_key
+
+    def compute():
+        histograms = new_histograms(number_bins)
+        fill_event_histograms(histograms, run.events, state)
+        fill_cluster_histograms(histograms, run.clusters, state)
+        histograms['number_bins'] = np.array(number_bins)
+        return histograms
+
+    run = server.get_run(request['run'])
+    state = request['state']
+    number_bins = int(request['number_bins'])
+    key = ('histograms', run.name, get_state_key(state), number_bins)
+    return get_cached_key(key, compute)
+
+
+def query_rate_history(server, request):
+    from filters import get_cluster_mask
+    from Plotting.Miscellaneous import get_rate_history
+    from Plotting.Cache import get_cached_key, get_state_key
+
+    def compute():
+        mask = get_cluster_mask(run.clusters, state)
+        times = run.clusters['Time'].values[mask]
+        if times.shape[0] < 2:
+            return {}
+        centers, rates, errors, total, total_error = get_rate_history(times, bin_width)
+        return {'centers': centers, 'rates': rates, 'errors': errors,
+                'total': np.array(total), 'total_error': np.array(total_error)}
+
+    run = server.get_run(request['run'])
+    state = request['state']
+    bin_width = float(request['bin_width'])
+    key = ('rate_history', run.name, get_state_key(state), bin_width)
+    return get_cached_key(key, compute)
+
+
+def query_timestamps(server, request):
+    from filters import decimate_min_max
+    from Plotting.Cache import get_cached_key
+
+    def compute():
+        timestamps = run.events['srs_timestamp'].values
+        indices = decimate_min_max(timestamps, nbr_points // 2)
+        return {'indices': indices, 'timestamps': timestamps[indices]}
+
+    run = server.get_run(request['run'])
+    nbr_points = int(request.get('nbr_points', 4000))
+    key = ('timestamps', run.name, nbr_points)
+    return get_cached_key(key, compute)
+
+
+# =============================================================================
+# Client
+# =============================================================================
+
+
+def request_server(path, values=None, port=PORT):
+    """
+    Sends a query to a histogram server on this machine and returns the
+    answer, lists in the answer are converted to numpy arrays. Raises a
+    ServerError with the message of the server if the query failed, and a
+    URLError if no server is running.
+    """
+    url = 'http://%s:%d%s' % (HOST, port, path)
+    try:
+        if values is None:
+            answer = urllib.request.urlopen(url)
+        else:
+            data = json.dumps(values, default=to_json).encode()
+            answer = urllib.request.urlopen(urllib.request.Request(
+                url, data=data, headers={'Content-Type': 'application/json'}))
+    except urllib.error.HTTPError as error:
+        try:
+            message = json.loads(error.read())['error']
+        except (ValueError, KeyError, TypeError):
+            message = '%d %s' % (error.code, error.reason)
+        raise ServerError(message, error.code) from error
+    values = json.loads(answer.read())
+    if isinstance(values, dict):
+        values = {key: np.array(value) if isinstance(value, list) else value
+                  for key, value in values.items()}
+    return values
+
+
+# =============================================================================
+# Helper Functions
+# =============================================================================
+
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('%s is not JSON serializable' % type(value).__name__)
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else PORT
+    server = HistogramServer((HOST, port))
+    print('[server] Listening on http://%s:%d' % (HOST, port))
+    server.serve_forever()
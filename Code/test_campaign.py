@@ -0,0 +1,93 @@
+import os
+import subprocess
+import sys
+import numpy as np
+import pytest
+
+import campaign
+import cluster
+import filters
+import memory
+from conftest import Window, get_hits, write_raw_file
+
+
+def assert_histograms_equal(histograms, other):
+    assert histograms.keys() == other.keys()
+    for key in histograms:
+        np.testing.assert_array_equal(histograms[key], other[key], err_msg=key)
+
+
+@pytest.mark.parametrize('chunk_size', [700, 2500])
+def test_store_equals_raw_files(tmp_path, chunk_size):
+    # The timestamps of each file restart at zero
+    file_paths = [write_raw_file(tmp_path / ('raw_%d.h5' % i), get_hits(3000, i))
+                  for i in range(3)]
+    store_path = str(tmp_path / 'store.h5')
+    window = Window()
+    campaign.cluster_to_store(file_paths, store_path, window, chunk_size=1000)
+    assert_histograms_equal(campaign.run_campaign([store_path], window, chunk_size),
+                            campaign.run_campaign(file_paths, window, 1000))
+
+
+@pytest.mark.parametrize('chunk_size', [700, 1000, 2500, 10000])
+def test_chunks_equal_in_memory(tmp_path, chunk_size):
+    hits = get_hits(5000)
+    file_path = write_raw_file(tmp_path / 'raw.h5', hits)
+    window = Window(ADC=(100, 900), wM=(1, 5))
+    clusters, events = cluster.cluster_data(hits, window, 1, 1,
+                                            cluster.new_clustering_session())
+    state = filters.get_filter_state(window)
+    histograms = campaign.new_histograms(50)
+    campaign.fill_event_histograms(histograms, events, state)
+    campaign.fill_cluster_histograms(histograms, clusters, state)
+    assert_histograms_equal(campaign.run_campaign([file_path], window, chunk_size),
+                            histograms)
+
+
+def test_filter_on_read_with_calibration(tmp_path):
+    file_path = write_raw_file(tmp_path / 'raw.h5', get_hits(3000))
+    window = Window(ADC=(100, 400))
+    window.calibration = {'gain': np.full((6, 80), 0.5), 'offset': np.zeros((6, 80))}
+    histograms = campaign.run_campaign([file_path], window)
+    # The ADC filter refers to the calibrated ADC, not to the ADC read
+    window.filter_on_read = True
+    assert_histograms_equal(campaign.run_campaign([file_path], window), histograms)
+
+
+def test_hits_time_unfiltered(tmp_path):
+    hits = get_hits(3000)
+    file_path = write_raw_file(tmp_path / 'raw.h5', hits)
+    histograms = campaign.run_campaign([file_path], Window(ADC=(500, 600)), 700)
+    clusters, events = cluster.cluster_data(hits, Window(), 1, 1)
+    timestamps = events['srs_timestamp']
+    np.testing.assert_array_equal(histograms['hits_time'],
+                                  [timestamps.min(), timestamps.max()])
+    assert histograms['events_time'][1] - histograms['events_time'][0] < \
+        timestamps.max() - timestamps.min()
+
+
+def test_chunk_size_over_budget(tmp_path, monkeypatch):
+    file_path = write_raw_file(tmp_path / 'raw.h5', get_hits(3000))
+    budget = memory.get_rss() + 10000
+    monkeypatch.setattr(memory, 'MEMORY_BUDGET', budget)
+    with pytest.raises(memory.MemoryBudgetError):
+        campaign.run_campaign([file_path], Window())
+
+
+def test_worker_budget(monkeypatch):
+    monkeypatch.setattr(memory, 'MEMORY_BUDGET', memory.MEMORY_BUDGET)
+    monkeypatch.setattr(cluster, 'NBR_THREADS', cluster.NBR_THREADS)
+    monkeypatch.setattr(filters, 'NBR_THREADS', filters.NBR_THREADS)
+    campaign.init_worker(1e9, 1)
+    # Checked by every stage of the worker, not only by the campaign
+    assert memory.MEMORY_BUDGET == 1e9
+    with pytest.raises(memory.MemoryBudgetError):
+        memory.check_memory_budget('Test', 1e9)
+
+
+def test_workers_without_matplotlib():
+    # Spawned workers import campaign, the server its query modules
+    code = ('import sys, campaign, columnar, server, Plotting.Cache; '
+            'sys.exit("matplotlib.pyplot" in sys.modules)')
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pytest
+
+import campaign
+import catalog
+from conftest import Window, get_hits, write_raw_file
+
+
+@pytest.fixture
+def connection(tmp_path):
+    hits = get_hits(3000)
+    write_raw_file(tmp_path / 'raw_0.h5', hits)
+    write_raw_file(tmp_path / 'raw_1.h5', hits[hits['chip_id'] != 5])
+    campaign.cluster_to_store([str(tmp_path / 'raw_0.h5')], str(tmp_path / 'store.h5'),
+                              Window(), chunk_size=1000)
+    connection = catalog.open_catalog(str(tmp_path / catalog.CATALOG_NAME))
+    catalog.update_catalog(connection, str(tmp_path))
+    yield connection
+    connection.close()
+
+
+def get_names(file_paths):
+    return [os.path.basename(file_path) for file_path in file_paths]
+
+
+def test_select_files(connection):
+    assert get_names(catalog.select_files(connection, [('kind', '=', 'raw')])) \
+        == ['raw_0.h5', 'raw_1.h5']
+    assert get_names(catalog.select_files(connection, [('chip_id', '=', 5)])) \
+        == ['raw_0.h5', 'store.h5']
+    assert get_names(catalog.select_files(
+        connection, catalog.parse_conditions("kind = 'raw' AND clustered = 0"))) \
+        == ['raw_1.h5']
+    # Values are parameters, columns and operators are checked
+    assert catalog.select_files(connection, [('name', '=', "x' OR '1' = '1")]) == []
+    with pytest.raises(ValueError):
+        catalog.select_files(connection, [('1 OR path', '=', 1)])
+    with pytest.raises(ValueError):
+        catalog.parse_conditions('kind raw')
+
+
+def test_sampled_chip_counts(tmp_path, monkeypatch):
+    hits = get_hits(20000)
+    file_path = write_raw_file(tmp_path / 'raw.h5', hits)
+    exact = np.bincount(hits['chip_id'])
+    assert catalog.scan_file(file_path)[1] == {chip_id: count for chip_id, count
+                                               in enumerate(exact) if count > 0}
+    monkeypatch.setattr(catalog, 'SCAN_SAMPLE_SIZE', 1000)
+    monkeypatch.setattr(catalog, 'SCAN_SAMPLES', 4)
+    chip_counts = catalog.scan_file(file_path)[1]
+    assert chip_counts.keys() == {2, 3, 4, 5}
+    assert sum(chip_counts.values()) == pytest.approx(len(hits), rel=0.01)
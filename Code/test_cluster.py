@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pytest
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+import cluster
+from conftest import Window, get_hits, write_raw_file
+
+
+def cluster_files(hits, use_jit, nbr_files):
+    """Clusters the hits split in files, in one session if nbr_files > 1."""
+    cluster.USE_JIT = use_jit
+    window = Window(4e3)
+    if nbr_files == 1:
+        return cluster.cluster_data(hits, window, 1, 1)
+    session = cluster.new_clustering_session()
+    clusters, events = [], []
+    bounds = np.linspace(0, len(hits), nbr_files + 1).astype(int)
+    for i in range(nbr_files):
+        file_hits = hits.iloc[bounds[i]:bounds[i+1]].reset_index(drop=True)
+        file_clusters, file_events = cluster.cluster_data(
+            file_hits, window, i+1, nbr_files, session)
+        cluster.shift_cluster_index(file_clusters, file_events,
+                                    sum(len(table) for table in clusters),
+                                    sum(len(table) for table in events))
+        clusters.append(file_clusters)
+        events.append(file_events)
+    return (pd.concat(clusters, ignore_index=True),
+            pd.concat(events, ignore_index=True))
+
+
+@pytest.mark.skipif(cluster.numba is None, reason='Numba is not installed')
+@pytest.mark.parametrize('nbr_files', [1, 3])
+def test_kernel_equals_loop(nbr_files):
+    hits = get_hits(5000)
+    clusters_jit, events_jit = cluster_files(hits, True, nbr_files)
+    clusters_loop, events_loop = cluster_files(hits, False, nbr_files)
+    assert len(clusters_jit) > 0
+    pd.testing.assert_frame_equal(clusters_jit, clusters_loop)
+    pd.testing.assert_frame_equal(events_jit, events_loop)
+
+
+@pytest.mark.parametrize('use_jit', [True, False])
+@pytest.mark.parametrize('chip_id, channel, error', [(1, 20, KeyError),
+                                                     (6, 20, IndexError),
+                                                     (3, 80, IndexError)])
+def test_unknown_channels(use_jit, chip_id, channel, error):
+    if use_jit and cluster.numba is None:
+        pytest.skip('Numba is not installed')
+    hits = get_hits(100)
+    hits.loc[50, ['chip_id', 'channel']] = chip_id, channel
+    with pytest.raises(error):
+        cluster_files(hits, use_jit, 1)
+
+
+def test_channel_stats_table():
+    clusters, events = cluster.cluster_data(get_hits(3000), Window(), 1, 1)
+    stats = cluster.new_channel_stats()
+    cluster.update_channel_stats(stats, events)
+    table = cluster.channel_stats_table(stats)
+    # One row per channel, the hits are counted once
+    assert len(table) == cluster.NBR_WIRES + cluster.NBR_GRIDS
+    for typeCh in ['wCh', 'gCh']:
+        rows = table['type'] == typeCh
+        assert table['count'][rows].sum() == (events[typeCh] >= 0).sum()
+
+
+def test_sweep_equals_clustering():
+    hits = get_hits(5000)
+    # Only mapped channels, all hits belong to a wire or grid
+    hits['channel'] = hits['channel'] % 60 + 10
+    time_windows = [100, 500, 4e3]
+    results = cluster.sweep_time_window(cluster.get_times(hits), hits['chip_id'],
+                                        time_windows)
+    for k, time_window in enumerate(time_windows):
+        clusters, events = cluster.cluster_data(hits, Window(time_window), 1, 1,
+                                                cluster.new_clustering_session())
+        assert results['clusters'][k] == len(clusters)
+        assert results['coincidences'][k] == ((clusters['wM'] > 0)
+                                              & (clusters['gM'] > 0)).sum()
+        for typeM in ['wM', 'gM']:
+            multiplicity = np.minimum(clusters[typeM], cluster.MAX_MULTIPLICITY)
+            np.testing.assert_array_equal(
+                results[typeM][k],
+                np.bincount(multiplicity, minlength=cluster.MAX_MULTIPLICITY + 1))
+
+
+@pytest.mark.parametrize('options', [{},
+                                     {'shuffle': False},
+                                     {'compression': None, 'shuffle': False},
+                                     {'compression': 'lzf'},
+                                     {'chunks': None, 'compression': None,
+                                      'shuffle': False}])
+def test_read_columns(tmp_path, options):
+    file_path = write_raw_file(tmp_path / 'raw.h5', get_hits(3500), **options)
+    with h5py.File(file_path, 'r') as h5_file:
+        srs_hits = h5_file['srs_hits']
+        # Chunk aligned, inside one chunk, across chunks and the partial last chunk
+        for start, stop in [(0, None), (1000, 2000), (10, 20), (999, 1001),
+                            (1234, 3456), (2500, 5000)]:
+            records = srs_hits[start:stop]
+            columns = cluster.read_columns(srs_hits, start, stop, nbr_threads=4)
+            assert columns.keys() == set(srs_hits.dtype.names)
+            for field in srs_hits.dtype.names:
+                np.testing.assert_array_equal(columns[field], records[field])
+            columns = cluster.read_columns(srs_hits, start, stop, ['adc', 'chip_id'])
+            assert list(columns) == ['adc', 'chip_id']
+
+
+def test_read_hits(tmp_path):
+    hits = get_hits(3500)
+    file_path = write_raw_file(tmp_path / 'raw.h5', hits)
+    window = Window(ADC=(100, 900), chip=(3, 4))
+    with h5py.File(file_path, 'r') as h5_file:
+        data = cluster.read_hits(h5_file['srs_hits'], cluster.get_read_state(window),
+                                 1234, 3456)
+    hits = hits.iloc[1234:3456]
+    expected = hits[hits['adc'].between(100, 900) & hits['chip_id'].between(3, 4)]
+    pd.testing.assert_frame_equal(data, expected[list(data.columns)]
+                                  .reset_index(drop=True), check_dtype=False)
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+import pytest
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+pytest.importorskip('pyarrow')
+import campaign
+import columnar
+from conftest import Window, get_hits, write_raw_file
+
+
+def read_store(store_path):
+    with h5py.File(store_path, 'r') as store:
+        return (pd.DataFrame(store['events'][:]),
+                pd.DataFrame(store['clusters'][:]))
+
+
+def check_cluster_index(events, clusters):
+    """The hits of cluster k are the rows HitStart[k] to HitStop[k]."""
+    cluster_ids = np.full(events.shape[0], -1)
+    for k, (start, stop) in enumerate(zip(clusters['HitStart'], clusters['HitStop'])):
+        cluster_ids[start:stop] = k
+    np.testing.assert_array_equal(events['ClusterID'].values, cluster_ids)
+
+
+def test_store_round_trip(tmp_path):
+    # The timestamps of each file restart at zero
+    file_paths = [write_raw_file(tmp_path / ('raw_%d.h5' % i), get_hits(3000, i))
+                  for i in range(3)]
+    window = Window()
+    tables = {}
+    for run in ['a', 'b']:
+        store_path = str(tmp_path / ('store_%s.h5' % run))
+        campaign.cluster_to_store(file_paths, store_path, window, chunk_size=1000)
+        tables[run] = read_store(store_path)
+        columnar.export_to_parquet(*tables[run], str(tmp_path / 'parquet'), run,
+                                   time_slice=1e6)
+    window.data_version = 0
+    columnar.load_window_from_parquet(str(tmp_path / 'parquet'), window)
+    events, clusters = window.Events_16_layers, window.Clusters_16_layers
+    check_cluster_index(events, clusters)
+    # Both runs, in the order of the stores
+    nbr_events = tables['a'][0].shape[0]
+    pd.testing.assert_frame_equal(events.iloc[:nbr_events].reset_index(drop=True),
+                                  tables['a'][0], check_dtype=False)
+    pd.testing.assert_frame_equal(clusters.iloc[:tables['a'][1].shape[0]]
+                                  .reset_index(drop=True),
+                                  tables['a'][1], check_dtype=False)
+
+
+def test_reexport_replaces_run(tmp_path):
+    clusters = pd.DataFrame({'Time': np.arange(10) * 40, 'HitStart': np.arange(10),
+                             'HitStop': np.arange(10) + 1, 'wCh': 1, 'gCh': 1})
+    events = pd.DataFrame({'srs_timestamp': np.arange(10) * 40,
+                           'ClusterID': np.arange(10), 'wCh': 1, 'gCh': 1})
+    directory = str(tmp_path)
+    columnar.export_to_parquet(events, clusters, directory, 'run', time_slice=150)
+    columnar.export_to_parquet(events[:2], clusters[:2], directory, 'run', time_slice=150)
+    assert columnar.load_from_parquet(directory, 'clusters').shape[0] == 2
@@ -0,0 +1,33 @@
+import threading
+import urllib.error
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def histogram_server():
+    histogram_server = server.HistogramServer((server.HOST, 0))
+    thread = threading.Thread(target=histogram_server.serve_forever, daemon=True)
+    thread.start()
+    yield histogram_server
+    histogram_server.shutdown()
+    histogram_server.server_close()
+
+
+def test_error_message(histogram_server):
+    port = histogram_server.server_address[1]
+    assert server.request_server('/runs', port=port) == []
+    with pytest.raises(server.ServerError, match='Run "a" is not loaded') as error:
+        server.request_server('/histograms', {'run': 'a', 'state': {},
+                                              'number_bins': 10}, port=port)
+    assert error.value.status == 400
+
+
+def test_no_server(histogram_server):
+    port = histogram_server.server_address[1]
+    histogram_server.shutdown()
+    histogram_server.server_close()
+    with pytest.raises(urllib.error.URLError):
+        server.request_server('/runs', port=port)
@@ -0,0 +1,18 @@
+import numpy as np
+
+import cluster
+import tof
+from conftest import Window, get_hits, write_raw_file
+
+
+def test_pulse_channel(tmp_path):
+    hits = get_hits(3000)
+    file_path = write_raw_file(tmp_path / 'raw.h5', hits)
+    pulse = (hits['chip_id'] == 3) & (hits['channel'] == 20)
+    expected = np.sort(hits['srs_timestamp'][pulse].values
+                       + hits['chiptime'][pulse].values)
+    np.testing.assert_array_equal(tof.read_pulse_times(file_path, 3, 20), expected)
+    # The pulse hits are not clustered
+    window = Window()
+    window.pulse_channel = (3, 20)
+    assert cluster.mask_channels(hits, window).shape[0] == hits.shape[0] - pulse.sum()
@@ -0,0 +1,82 @@
+import os
+import numpy as np
+import warnings
+with warnings.catch_warnings():
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    import h5py
+
+from cluster import read_columns, READ_BLOCK_SIZE
+
+# =============================================================================
+# Pulse times
+# =============================================================================
+
+
+def load_pulse_times(file_path):
+    """
+    Imports reference pulse (chopper) times in ns from a '.npy' file or a
+    text file with one time per line.
+    """
+    if os.path.splitext(file_path)[1] == '.npy':
+        pulse_times = np.load(file_path)
+    else:
+        pulse_times = np.loadtxt(file_path, ndmin=1)
+    return np.sort(pulse_times.astype(np.int64))
+
+
+def read_pulse_times(file_path, chip_id, channel):
+    """
+    Returns the times in ns of the hits on the VMM chip and channel which
+    record the pulse (chopper) signal, read block by block from 'srs_hits'
+    of a raw file, before any channel mask, filter or clustering. Files
+    without 'srs_hits' (clustered stores) have no pulses.
+    """
+    pulse_times = []
+    with h5py.File(file_path, 'r') as h5_file:
+        if 'srs_hits' in h5_file:
+            srs_hits = h5_file['srs_hits']
+            for start in range(0, srs_hits.shape[0], READ_BLOCK_SIZE):
+                hits = read_columns(srs_hits, start, start + READ_BLOCK_SIZE,
+                                    ['srs_timestamp', 'chiptime', 'chip_id',
+                                     'channel'])
+                pulse_times.append(get_pulse_times_from_hits(hits, chip_id, channel))
+    if len(pulse_times) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.sort(np.concatenate(pulse_times))
+
+
+def get_pulse_times_from_hits(hits, chip_id, channel):
+    """
+    Returns the times in ns of the hits on the VMM chip and channel which
+    record the pulse (chopper) signal. 'hits' can be a DataFrame or a
+    dictionary of column arrays.
+    """
+    pulse = ((np.asarray(hits['chip_id']) == chip_id)
+             & (np.asarray(hits['channel']) == channel))
+    pulse_times = (np.asarray(hits['srs_timestamp'])[pulse].astype(np.int64)
+                   + np.asarray(hits['chiptime'])[pulse].astype(np.int64))
+    return np.sort(pulse_times)
+
+
+# =============================================================================
+# Time-of-flight
+# =============================================================================
+
+
+def get_tof(times, pulse_times):
+    """
+    Returns the time-of-flight in ns of each time with respect to its
+    preceding pulse, and a mask which is False for times before the first
+    pulse. Vectorized with np.searchsorted, 'pulse_times' must be sorted.
+    """
+    pulse_index = np.searchsorted(pulse_times, times, side='right') - 1
+    valid = pulse_index >= 0
+    tof = times - pulse_times[np.maximum(pulse_index, 0)]
+    return tof, valid
+
+
+def get_pulse_period(pulse_times):
+    """Returns the median time in ns between consecutive pulses."""
+    if len(pulse_times) < 2:
+        return None
+    return np.median(np.diff(pulse_times))